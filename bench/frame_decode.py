@@ -0,0 +1,104 @@
+"""
+Microbenchmark cho decode_afk_frame.
+
+    python bench/frame_decode.py                      # corpus tổng hợp
+    python bench/frame_decode.py frames.txt ...       # corpus ghi lại: mỗi dòng một frame
+
+In ra µs/frame và CPU (% một core) cho 1000 kết nối, mỗi kết nối --rate frame/giây.
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import main  # noqa: E402
+
+
+def synthetic_corpus(n, afk_ratio, seed=1):
+    rnd    = random.Random(seed)
+    frames = []
+    for i in range(n):
+        if rnd.random() < afk_ratio:
+            frames.append(json.dumps({
+                'type': 'afk_state', 'coinsPerMinute': round(rnd.uniform(0.1, 3), 2),
+                'nextRewardIn': rnd.randint(0, 60000), 'afkTime': rnd.randint(0, 86400),
+                'multiplier': 1, 'online': rnd.randint(100, 5000), 'active': True,
+            }))
+        else:
+            frames.append(json.dumps(rnd.choice([
+                {'type': 'ping', 't': i},
+                {'type': 'online_count', 'count': rnd.randint(100, 5000)},
+                {'type': 'notification', 'id': i, 'title': 'Maintenance', 'body': 'x' * rnd.randint(20, 400)},
+            ])))
+    return frames
+
+
+def load_corpus(paths):
+    frames = []
+    for path in paths:
+        with open(path, encoding='utf-8') as f:
+            for line in f:
+                line = line.rstrip('\n')
+                if line:
+                    frames.append(line)
+    return frames
+
+
+def legacy(raw):
+    """Cách cũ: json.loads mọi frame"""
+    try:
+        data = json.loads(raw)
+    except ValueError:
+        return None
+    if data.get('type') != 'afk_state':
+        return None
+    return data.get('coinsPerMinute', 0), data.get('nextRewardIn', 0)
+
+
+def measure(decode, frames, rounds):
+    best = float('inf')
+    for _ in range(rounds):
+        t0 = time.process_time()
+        for raw in frames:
+            decode(raw)
+        best = min(best, time.process_time() - t0)
+    return best / len(frames)
+
+
+def main_():
+    ap = argparse.ArgumentParser()
+    ap.add_argument('corpus', nargs='*')
+    ap.add_argument('-n', type=int, default=50000, help='số frame corpus tổng hợp')
+    ap.add_argument('--afk-ratio', type=float, default=0.5)
+    ap.add_argument('--rate', type=float, default=1.0, help='frame/giây mỗi kết nối')
+    ap.add_argument('--rounds', type=int, default=5)
+    args = ap.parse_args()
+
+    frames = load_corpus(args.corpus) if args.corpus else synthetic_corpus(args.n, args.afk_ratio)
+    afk    = sum(1 for f in frames if legacy(f) is not None)
+    print(f'{len(frames)} frames, {afk / len(frames):.0%} afk_state\n')
+
+    decoders = [('legacy', legacy)]
+    for name in ('json', 'orjson'):
+        if name == 'orjson' and main.orjson is None:
+            continue
+        for prefilter in (False, True):
+            dec = main.make_frame_decoder(name, prefilter)
+            decoders.append((dec.name, dec))
+
+    expected = [legacy(f) for f in frames]
+    base     = None
+    print(f"{'decoder':<20}{'µs/frame':>10}{'CPU%/1k conn':>14}{'speedup':>9}")
+    for name, dec in decoders:
+        assert [dec(f) for f in frames] == expected, f'{name} disagrees with legacy decoder'
+        per   = measure(dec, frames, args.rounds)
+        base  = base or per
+        print(f'{name:<20}{per * 1e6:>10.2f}{per * 1000 * args.rate * 100:>14.2f}{base / per:>8.1f}x')
+
+
+if __name__ == '__main__':
+    main_()
+    os._exit(0)
@@ -0,0 +1,247 @@
+"""
+Load test offline: chạy bench/mock_platform.py ở process riêng, trỏ N account giả vào đó
+và đo CPU, RSS, số thread, số file descriptor, độ trễ xử lý frame afk_state.
+
+    python bench/loadtest.py --hyperhub 200 --overnode 200 --altare 50 --duration 120 --engine reactor
+    python bench/loadtest.py ... --out bench/baseline.json        # lưu baseline
+    python bench/loadtest.py ... --compare bench/baseline.json    # exit 1 nếu tệ hơn baseline quá --tolerance
+
+Độ trễ = lúc worker decode xong frame − sentAt do mock gắn vào frame (cùng máy nên chung đồng hồ).
+--faults k: k account mỗi platform mang hậu tố +dup/+expire để có reconnect thật trong lúc đo.
+--replay rec.jsonl.gz: thay mock bằng bench/replay.py — account và traffic lấy từ bản ghi AFK_RECORD,
+--speed tăng tốc; so sánh engine trên cùng một chuỗi frame (không đo độ trễ vì frame thật không có sentAt).
+"""
+import argparse
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.request
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(HERE)
+
+# chỉ số so với baseline — với cả năm, giá trị lớn hơn là tệ hơn
+REGRESSION_KEYS = ('cpu_avg', 'rss_peak_mb', 'threads_peak', 'fds_peak', 'latency_p95_ms')
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def start_mock(args, port):
+    if args.replay:
+        cmd = [sys.executable, os.path.join(HERE, 'replay.py'), *args.replay, '--port', str(port),
+               '--speed', str(args.speed)]
+    else:
+        cmd = [sys.executable, os.path.join(HERE, 'mock_platform.py'), '--port', str(port),
+               '--cycle', str(args.cycle), '--tick', str(args.tick), '--latency', str(args.latency),
+               '--chaos', str(args.chaos), '--fault-after', str(args.fault_after)]
+    proc = subprocess.Popen(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    deadline = time.monotonic() + 15
+    while time.monotonic() < deadline:
+        try:
+            urllib.request.urlopen(f'http://127.0.0.1:{port}/stats', timeout=1).read()
+            return proc
+        except OSError:
+            if proc.poll() is not None:
+                sys.exit(f'mock platform exited: {proc.stderr.read().decode()}')
+            time.sleep(0.2)
+    proc.kill()
+    sys.exit('mock platform did not start')
+
+
+def proc_sample():
+    rss = 0
+    with open('/proc/self/status') as f:
+        for line in f:
+            if line.startswith('VmRSS:'):
+                rss = int(line.split()[1]) / 1024
+    return {'rss_mb': rss, 'threads': threading.active_count(), 'fds': len(os.listdir('/proc/self/fd'))}
+
+
+def percentile(values, q):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+def make_accounts(args):
+    def fault(i):
+        return ('+dup', '+expire')[i % 2] if i < args.faults else ''
+    return {
+        'hyperhub': [{'email': f'hh{i}{fault(i)}@loadtest', 'password': 'x'} for i in range(args.hyperhub)],
+        'overnode': [{'email': f'on{i}@loadtest', 'cookie': f'session=on{i}{fault(i)}'} for i in range(args.overnode)],
+        'altare':   [{'email': f'al{i}@loadtest', 'password': 'x', 'tenant_id': f't-al{i}@loadtest'}
+                     for i in range(args.altare)],
+    }
+
+
+def run(args):
+    port = free_port()
+    mock = start_mock(args, port)
+    base = f'http://127.0.0.1:{port}'
+    os.environ.update({
+        'AFK_HYPERHUB_URL': base, 'AFK_OVERNODE_URL': base, 'AFK_ALTARE_API': base, 'AFK_ALTARE_WEB': base,
+        'AFK_ENGINE': args.engine, 'AFK_DATA_DIR': tempfile.mkdtemp(prefix='afk-loadtest-'),
+        'AFK_LOG_LEVEL': 'warn',
+    })
+    sys.path.insert(0, ROOT)
+    import main
+    main.open_recorder()   # AFK_RECORD=... khi muốn ghi lại chính lần chạy này
+
+    latencies = []
+    frames    = [0]
+    decode    = main.decode_afk_frame
+
+    def timed_decode(raw):
+        frame = decode(raw)
+        if frame is not None:
+            frames[0] += 1
+            text = raw if isinstance(raw, str) else raw.decode()
+            i = text.rfind('"sentAt":')
+            if i >= 0 and not args.replay:
+                try:
+                    latencies.append(time.time() - float(text[i + 9:].rstrip('} ')))
+                except ValueError:
+                    pass
+        return frame
+
+    main.decode_afk_frame = timed_decode
+
+    if args.replay:
+        from replay import Recording, make_accounts as replay_accounts
+        accounts = replay_accounts(Recording(args.replay))
+        source   = f"replay {' '.join(args.replay)} x{args.speed}"
+    else:
+        accounts = make_accounts(args)
+        source   = 'mock'
+    total    = sum(len(v) for v in accounts.values())
+    print(f'{total} accounts → {source} {base}, engine={args.engine}, duration={args.duration}s', flush=True)
+
+    t_start = time.monotonic()
+    for tool, accs in accounts.items():
+        for acc in accs:
+            main.start_worker_thread(tool, acc)
+            if args.stagger:
+                time.sleep(args.stagger)
+
+    samples  = []
+    cpu_prev = time.process_time()
+    t_prev   = time.monotonic()
+    end      = t_start + args.duration
+    while time.monotonic() < end:
+        time.sleep(args.interval)
+        now, cpu = time.monotonic(), time.process_time()
+        sample = proc_sample()
+        sample['cpu'] = (cpu - cpu_prev) / (now - t_prev) * 100
+        sample['connected'] = sum(1 for st in main.app_state['hyperhub'].values()
+                                  if st.get('connection') == 'connected') + \
+                              sum(1 for st in main.app_state['overnode'].values()
+                                  if st.get('connection') == 'connected') + \
+                              sum(1 for st in main.app_state['altare'].values()
+                                  if st.get('connection') == 'connected')
+        samples.append(sample)
+        cpu_prev, t_prev = cpu, now
+        if not args.quiet:
+            print(f"t={now - t_start:5.0f}s cpu={sample['cpu']:5.1f}% rss={sample['rss_mb']:6.1f}MB "
+                  f"threads={sample['threads']:4d} fds={sample['fds']:5d} connected={sample['connected']}/{total}",
+                  flush=True)
+
+    server  = json.loads(urllib.request.urlopen(f'{base}/stats', timeout=5).read())
+    # bỏ 1/5 thời gian đầu (ramp-up) khi tính trung bình CPU
+    steady  = samples[len(samples) // 5:] or samples
+    lat_ms  = [x * 1000 for x in latencies]
+    metrics = {m.name: sum(v if not isinstance(v, list) else v[-2] for v in m._merged().values())
+               for m in main.METRICS if isinstance(m, main.Counter)}
+    result = {
+        'engine':          args.engine,
+        'replay':          args.replay,
+        'accounts':        total,
+        'duration':        args.duration,
+        'cpu_avg':         round(sum(s['cpu'] for s in steady) / len(steady), 2),
+        'cpu_peak':        round(max(s['cpu'] for s in samples), 2),
+        'rss_peak_mb':     round(max(s['rss_mb'] for s in samples), 1),
+        'threads_peak':    max(s['threads'] for s in samples),
+        'fds_peak':        max(s['fds'] for s in samples),
+        'connected_final': samples[-1]['connected'],
+        'frames':          frames[0],
+        'frames_per_sec':  round(frames[0] / args.duration, 1),
+        'latency_p50_ms':  round(percentile(lat_ms, 0.50), 2),
+        'latency_p95_ms':  round(percentile(lat_ms, 0.95), 2),
+        'latency_p99_ms':  round(percentile(lat_ms, 0.99), 2),
+        'latency_max_ms':  round(max(lat_ms, default=0), 2),
+        'reward_events':   metrics.get('afk_reward_events_total', 0),
+        'ws_connects':     metrics.get('afk_ws_connects_total', 0),
+        'upstream_requests': metrics.get('afk_upstream_requests_total', 0),
+        'server':          server,
+    }
+    mock.terminate()
+    if main.recorder is not None:
+        main.recorder.close()   # os._exit bỏ qua atexit — đóng để file gzip đủ footer
+    return result
+
+
+def compare(result, baseline, tolerance):
+    failed = []
+    print(f"\n{'metric':<18}{'baseline':>12}{'now':>12}{'change':>10}")
+    for key in REGRESSION_KEYS:
+        old, new = baseline.get(key), result.get(key)
+        if old is None or new is None:
+            continue
+        change = (new - old) / old * 100 if old else 0.0
+        flag   = ''
+        if change > tolerance:
+            failed.append(key)
+            flag = '  ✗'
+        print(f'{key:<18}{old:>12}{new:>12}{change:>9.1f}%{flag}')
+    return failed
+
+
+def parse_args(argv=None):
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument('--hyperhub', type=int, default=50)
+    ap.add_argument('--overnode', type=int, default=50)
+    ap.add_argument('--altare', type=int, default=10)
+    ap.add_argument('--engine', default='thread', choices=('thread', 'asyncio', 'reactor'))
+    ap.add_argument('--duration', type=float, default=60)
+    ap.add_argument('--interval', type=float, default=2, help='chu kỳ lấy mẫu (giây)')
+    ap.add_argument('--stagger', type=float, default=0.005, help='giãn cách giữa hai lần start account (giây)')
+    ap.add_argument('--cycle', type=int, default=20, help='reward cycle của mock (giây)')
+    ap.add_argument('--tick', type=float, default=1.0)
+    ap.add_argument('--latency', type=float, default=20, help='độ trễ REST của mock (ms)')
+    ap.add_argument('--chaos', type=float, default=0)
+    ap.add_argument('--faults', type=int, default=0)
+    ap.add_argument('--fault-after', type=float, default=30)
+    ap.add_argument('--replay', nargs='+', help='phát lại bản ghi AFK_RECORD thay cho mock')
+    ap.add_argument('--speed', type=float, default=1.0, help='hệ số tăng tốc khi --replay (0 = nhanh hết mức)')
+    ap.add_argument('--out', help='ghi kết quả JSON (baseline)')
+    ap.add_argument('--compare', help='so với baseline JSON, exit 1 nếu tệ hơn --tolerance %%')
+    ap.add_argument('--tolerance', type=float, default=20)
+    ap.add_argument('--quiet', action='store_true')
+    return ap.parse_args(argv)
+
+
+if __name__ == '__main__':
+    args   = parse_args()
+    result = run(args)
+    print(json.dumps(result, indent=2))
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump(result, f, indent=2)
+    code = 0
+    if args.compare:
+        with open(args.compare) as f:
+            failed = compare(result, json.load(f), args.tolerance)
+        if failed:
+            print(f"\nregression: {', '.join(failed)}")
+            code = 1
+    sys.stdout.flush()
+    os._exit(code)   # bỏ qua atexit của main (dừng worker từng account) — process kết thúc luôn
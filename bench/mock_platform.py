@@ -0,0 +1,240 @@
+"""
+Server giả lập hyper-hub.nl, altare.sh và overnode.fr trên một cổng — dùng để load test offline.
+
+    python bench/mock_platform.py --port 8765 --cycle 60 --tick 1
+
+Trỏ worker sang đây:
+    AFK_HYPERHUB_URL=http://127.0.0.1:8765 AFK_OVERNODE_URL=http://127.0.0.1:8765 \\
+    AFK_ALTARE_API=http://127.0.0.1:8765 python main.py
+
+Đường dẫn của ba platform không trùng nhau nên dùng chung một origin:
+    hyperhub  POST /auth/login, GET /wallet/balance, WS /ws
+    overnode  GET /api/wallet/balance, WS /api/afk/ws
+    altare    POST /api/auth/login, GET /api/tenants, POST /api/tenants/<id>/rewards/afk/<start|stop|heartbeat>,
+              GET /subscribe?token= (SSE)
+
+Hành vi lỗi chọn theo email / cookie của account (sau --fault-after giây kể từ lúc kết nối):
+    +expire   đóng WS với 4001 (hyperhub phải login lại, overnode dừng hẳn)
+    +dup      đóng WS với 4002
+    +suspend  đóng WS với 4003
+    +badlogin login trả 401
+--chaos p: mỗi phút, mỗi kết nối có xác suất p bị cắt ngang (không gửi close frame).
+GET /stats trả số kết nối / request phía server.
+"""
+import argparse
+import asyncio
+import base64
+import json
+import random
+import time
+
+from aiohttp import web
+
+FAULT_CODES = (('+expire', 4001), ('+dup', 4002), ('+suspend', 4003))
+
+
+class Platform:
+    def __init__(self, args):
+        self.args     = args
+        self.balances = {}
+        self.sockets  = {}
+        self.afk_on   = set()
+        self.stats    = {'ws_open': 0, 'ws_total': 0, 'sse_open': 0, 'requests': 0, 'frames': 0, 'rewards': 0}
+
+    # ── tiện ích ────────────────────────────────────────────────────────────
+    async def delay(self):
+        if self.args.latency:
+            await asyncio.sleep(random.uniform(0.5, 1.5) * self.args.latency / 1000)
+
+    def credit(self, key):
+        self.balances[key] = round(self.balances.get(key, 0.0) + self.args.cpm * self.args.cycle / 60, 4)
+        self.stats['rewards'] += 1
+
+    def make_token(self, email):
+        payload = {'sub': email, 'exp': int(time.time()) + self.args.token_ttl}
+        body    = base64.urlsafe_b64encode(json.dumps(payload).encode()).decode().rstrip('=')
+        return f'mock.{body}.sig'
+
+    def token_subject(self, raw):
+        try:
+            body    = raw.replace('Bearer ', '').split('.')[1]
+            payload = json.loads(base64.urlsafe_b64decode(body + '=' * (-len(body) % 4)))
+        except (IndexError, ValueError):
+            return None
+        return payload['sub'] if payload.get('exp', 0) > time.time() else None
+
+    @staticmethod
+    def cookie_key(request, name='session'):
+        return request.cookies.get(name) or request.headers.get('Cookie', '')
+
+    # ── REST ────────────────────────────────────────────────────────────────
+    @web.middleware
+    async def count(self, request, handler):
+        self.stats['requests'] += 1
+        return await handler(request)
+
+    async def hyperhub_login(self, request):
+        await self.delay()
+        body = await request.json()
+        if '+badlogin' in body.get('email', ''):
+            return web.json_response({'error': 'invalid credentials'}, status=401)
+        resp = web.json_response({'ok': True})
+        resp.set_cookie('session', body.get('email', ''))
+        return resp
+
+    async def hyperhub_balance(self, request):
+        await self.delay()
+        key = self.cookie_key(request)
+        if not key:
+            return web.json_response({'error': 'unauthorized'}, status=401)
+        return web.json_response({'XPL': self.balances.get(key, 0.0)})
+
+    async def overnode_balance(self, request):
+        await self.delay()
+        return web.json_response({'balance': self.balances.get(self.cookie_key(request), 0.0)})
+
+    async def altare_login(self, request):
+        await self.delay()
+        body = await request.json()
+        if '+badlogin' in body.get('identifier', ''):
+            return web.json_response({'error': 'invalid credentials'}, status=401)
+        return web.json_response({'token': self.make_token(body.get('identifier', ''))})
+
+    async def altare_tenants(self, request):
+        await self.delay()
+        email = self.token_subject(request.headers.get('Authorization', ''))
+        if email is None:
+            return web.json_response({'error': 'unauthorized'}, status=401)
+        cents = int(self.balances.get(email, 0.0) * 100)
+        return web.json_response({'items': [{'id': f't-{email}', 'name': email, 'creditsCents': cents}]})
+
+    async def altare_afk(self, request):
+        await self.delay()
+        email = self.token_subject(request.headers.get('Authorization', ''))
+        if email is None:
+            return web.json_response({'error': 'unauthorized'}, status=401)
+        action = request.match_info['action']
+        if action == 'start':
+            self.afk_on.add(email)
+        elif action == 'stop':
+            self.afk_on.discard(email)
+        return web.Response(status=204)
+
+    # ── WebSocket ───────────────────────────────────────────────────────────
+    async def websocket(self, request, key):
+        ws = web.WebSocketResponse(heartbeat=None)
+        await ws.prepare(request)
+        old = self.sockets.get(key)
+        if old is not None and not old.closed:
+            await old.close(code=4002, message=b'already connected')
+        self.sockets[key] = ws
+        self.stats['ws_open']  += 1
+        self.stats['ws_total'] += 1
+        fault   = next((code for mark, code in FAULT_CODES if mark in key), None)
+        started = time.monotonic()
+        nri     = random.randint(1, self.args.cycle) * 1000
+        tick    = 0
+        try:
+            while not ws.closed:
+                if fault and time.monotonic() - started >= self.args.fault_after:
+                    await ws.close(code=fault)
+                    break
+                if self.args.chaos and random.random() < self.args.chaos * self.args.tick / 60:
+                    request.transport.abort()
+                    break
+                nri -= int(self.args.tick * 1000)
+                if nri <= 0:
+                    self.credit(key)
+                    nri = self.args.cycle * 1000
+                await ws.send_str(json.dumps({'type': 'afk_state', 'coinsPerMinute': self.args.cpm,
+                                              'nextRewardIn': max(nri, 0), 'sentAt': time.time()}))
+                tick += 1
+                if tick % 5 == 0:
+                    await ws.send_str(json.dumps({'type': 'online_count', 'count': self.stats['ws_open']}))
+                self.stats['frames'] += 1
+                await asyncio.sleep(self.args.tick)
+        except (ConnectionResetError, RuntimeError):
+            pass
+        finally:
+            self.stats['ws_open'] -= 1
+            if self.sockets.get(key) is ws:
+                del self.sockets[key]
+        return ws
+
+    async def hyperhub_ws(self, request):
+        key = self.cookie_key(request)
+        if not key:
+            return web.Response(status=401)
+        return await self.websocket(request, key)
+
+    async def overnode_ws(self, request):
+        return await self.websocket(request, self.cookie_key(request))
+
+    # ── SSE ─────────────────────────────────────────────────────────────────
+    async def altare_subscribe(self, request):
+        email = self.token_subject(request.query.get('token', ''))
+        if email is None:
+            return web.Response(status=401)
+        resp = web.StreamResponse(headers={'Content-Type': 'text/event-stream', 'Cache-Control': 'no-cache'})
+        await resp.prepare(request)
+        self.stats['sse_open'] += 1
+        seq      = int(request.headers.get('Last-Event-ID') or 0)
+        last_ka  = last_credit = time.monotonic()
+        try:
+            await resp.write(b'retry: 3000\n\n')
+            while True:
+                await asyncio.sleep(1)
+                now = time.monotonic()
+                if now - last_credit >= self.args.cycle:
+                    last_credit = now
+                    if email in self.afk_on:
+                        self.credit(email)
+                    seq += 1
+                    data = json.dumps({'creditsCents': int(self.balances.get(email, 0.0) * 100)})
+                    await resp.write(f'id: {seq}\nevent: credits\ndata: {data}\n\n'.encode())
+                elif now - last_ka >= self.args.sse_keepalive:
+                    last_ka = now
+                    await resp.write(b': keepalive\n\n')
+        except (ConnectionResetError, asyncio.CancelledError):
+            pass
+        finally:
+            self.stats['sse_open'] -= 1
+        return resp
+
+    async def get_stats(self, request):
+        return web.json_response(self.stats)
+
+    def app(self):
+        app = web.Application(middlewares=[self.count])
+        app.router.add_post('/auth/login', self.hyperhub_login)
+        app.router.add_get('/wallet/balance', self.hyperhub_balance)
+        app.router.add_get('/ws', self.hyperhub_ws)
+        app.router.add_get('/api/wallet/balance', self.overnode_balance)
+        app.router.add_get('/api/afk/ws', self.overnode_ws)
+        app.router.add_post('/api/auth/login', self.altare_login)
+        app.router.add_get('/api/tenants', self.altare_tenants)
+        app.router.add_post('/api/tenants/{tenant}/rewards/afk/{action}', self.altare_afk)
+        app.router.add_get('/subscribe', self.altare_subscribe)
+        app.router.add_get('/stats', self.get_stats)
+        return app
+
+
+def parse_args(argv=None):
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument('--host', default='127.0.0.1')
+    ap.add_argument('--port', type=int, default=8765)
+    ap.add_argument('--cycle', type=int, default=60, help='độ dài một reward cycle (giây)')
+    ap.add_argument('--tick', type=float, default=1.0, help='khoảng cách giữa hai frame afk_state (giây)')
+    ap.add_argument('--cpm', type=float, default=1.0, help='coinsPerMinute gửi trong frame')
+    ap.add_argument('--latency', type=float, default=0, help='độ trễ REST trung bình (ms)')
+    ap.add_argument('--chaos', type=float, default=0, help='xác suất cắt ngang mỗi kết nối mỗi phút')
+    ap.add_argument('--fault-after', type=float, default=30, help='giây trước khi account +expire/+dup/+suspend bị đóng')
+    ap.add_argument('--token-ttl', type=int, default=1800)
+    ap.add_argument('--sse-keepalive', type=float, default=15)
+    return ap.parse_args(argv)
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    web.run_app(Platform(args).app(), host=args.host, port=args.port, access_log=None,
+                print=lambda *_: print(f'mock platform on http://{args.host}:{args.port}', flush=True))
@@ -0,0 +1,324 @@
+"""
+Phát lại file ghi bởi AFK_RECORD (main.TrafficRecorder) như một upstream thật — worker của cả ba
+engine chạy nguyên vẹn và nhận đúng chuỗi nextRewardIn, event SSE, close code đã ghi.
+
+    AFK_RECORD=rec.jsonl.gz python main.py                     # ghi traffic thật
+    python bench/replay.py rec.jsonl.gz --info                 # tóm tắt bản ghi
+    python bench/replay.py rec.jsonl.gz --port 8766 --speed 10
+    python bench/replay.py rec.*.jsonl.gz                      # nhiều gunicorn worker: mỗi worker một file
+    python bench/loadtest.py --replay rec.jsonl.gz --speed 10 --engine reactor
+
+Cùng bảng đường dẫn với bench/mock_platform.py. Account của bản ghi được giả lập theo email:
+    hyperhub  login đặt cookie replay=<email>
+    overnode  cookie replay=<email>
+    altare    token replay.<b64>.sig, tenant t-<email>
+Mỗi lần worker mở WS/SSE nhận phiên ghi kế tiếp của account đó: frame phát đúng khoảng cách đã ghi
+chia cho --speed (0 = nhanh hết mức), rồi đóng bằng close code đã ghi (null = cắt ngang không close
+frame). Hết phiên ghi thì giữ kết nối im lặng. REST trả lần lượt các response đã ghi theo
+(platform, method, endpoint) với latency đã ghi / --speed.
+"""
+import argparse
+import asyncio
+import base64
+import gzip
+import json
+import time
+from collections import Counter, defaultdict
+
+from aiohttp import web
+
+
+class Session:
+    """Một kết nối WS/SSE đã ghi: [(offset, item)] và close (offset, code) nếu có"""
+    __slots__ = ('items', 'close')
+
+    def __init__(self):
+        self.items = []
+        self.close = None
+
+
+def read_records(path):
+    """Các dòng của bản ghi; file bị cắt ngang (process chết khi đang ghi) thì dừng ở dòng đủ cuối cùng"""
+    with (gzip.open if path.endswith('.gz') else open)(path, 'rt', encoding='utf-8') as f:
+        try:
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+        except (EOFError, ValueError):
+            return
+
+
+class Recording:
+    def __init__(self, paths):
+        self.paths = paths
+        self.http  = defaultdict(list)   # (tool, method, endpoint) → [(status, elapsed, body)]
+        self.ws    = defaultdict(list)   # (tool, account) → [Session]
+        self.sse   = defaultdict(list)
+        self.start = None
+        opened     = {}                  # (kind, tool, account) → (t0, Session) đang mở
+        # các file (một file mỗi process ghi) chứa account rời nhau — offset trong phiên vẫn đúng
+        records = (rec for path in paths for rec in read_records(path))
+        for t, kind, tool, account, *payload in records:
+            if kind == 'start':
+                self.start = payload[0] if self.start is None else min(self.start, payload[0])
+            elif kind == 'http':
+                method, endpoint, status, elapsed, body = payload
+                self.http[(tool, method, endpoint)].append((status, elapsed, body))
+            elif kind in ('ws_open', 'sse_open'):
+                stream  = kind[:-5]
+                session = Session()
+                getattr(self, stream)[(tool, account)].append(session)
+                opened[(stream, tool, account)] = (t, session)
+            elif kind in ('ws', 'sse'):
+                cur = opened.get((kind, tool, account))
+                if cur is not None:
+                    cur[1].items.append((t - cur[0], payload[0] if kind == 'ws' else payload))
+            elif kind == 'ws_close':
+                cur = opened.pop(('ws', tool, account), None)
+                if cur is not None:
+                    cur[1].close = (t - cur[0], payload[0])
+
+    def accounts(self):
+        out = defaultdict(set)
+        for tool, account in list(self.ws) + list(self.sse):
+            out[tool].add(account)
+        return {tool: sorted(accs) for tool, accs in out.items()}
+
+    def summary(self):
+        return {
+            'paths':    self.paths,
+            'started':  self.start,
+            'accounts': {tool: len(accs) for tool, accs in self.accounts().items()},
+            'ws_sessions': sum(len(v) for v in self.ws.values()),
+            'ws_frames':   sum(len(s.items) for v in self.ws.values() for s in v),
+            'ws_closes':   dict(Counter(str(s.close[1]) for v in self.ws.values() for s in v if s.close)),
+            'sse_sessions': sum(len(v) for v in self.sse.values()),
+            'sse_events':   sum(len(s.items) for v in self.sse.values() for s in v),
+            'http': {' '.join(k): len(v) for k, v in sorted(self.http.items())},
+        }
+
+
+def make_accounts(rec):
+    """Account cho main.start_worker_thread trỏ vào server replay"""
+    accounts = rec.accounts()
+    return {
+        'hyperhub': [{'email': a, 'password': 'x'} for a in accounts.get('hyperhub', ())],
+        'overnode': [{'email': a, 'cookie': f'replay={a}'} for a in accounts.get('overnode', ())],
+        'altare':   [{'email': a, 'password': 'x', 'tenant_id': f't-{a}'} for a in accounts.get('altare', ())],
+    }
+
+
+class Replay:
+    def __init__(self, rec, speed):
+        self.rec   = rec
+        self.speed = speed
+        self.pos   = defaultdict(int)
+        self.stats = {'ws_open': 0, 'ws_total': 0, 'sse_open': 0, 'requests': 0, 'frames': 0,
+                      'sse_events': 0, 'closes': 0, 'exhausted': 0}
+
+    # ── tiện ích ────────────────────────────────────────────────────────────
+    async def until(self, started, offset):
+        """Chờ tới started + offset/speed — lịch tuyệt đối nên không trôi dần theo độ trễ gửi"""
+        if self.speed > 0:
+            delay = started + offset / self.speed - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+
+    def next_session(self, stream, tool, account):
+        sessions = getattr(self.rec, stream).get((tool, account), ())
+        i = self.pos[(stream, tool, account)]
+        self.pos[(stream, tool, account)] += 1
+        return sessions[i] if i < len(sessions) else None
+
+    async def respond(self, tool, method, endpoint, body=None, status=200):
+        """Response đã ghi kế tiếp của (tool, method, endpoint), quay vòng; không có thì dùng mặc định"""
+        recorded = self.rec.http.get((tool, method, endpoint))
+        if recorded:
+            key = ('http', tool, method, endpoint)
+            status, elapsed, rec_body = recorded[self.pos[key] % len(recorded)]
+            self.pos[key] += 1
+            if self.speed > 0:
+                await asyncio.sleep(elapsed / self.speed)
+            if rec_body is not None:
+                body = rec_body
+        return status, body
+
+    @staticmethod
+    def make_token(email):
+        payload = {'sub': email, 'exp': int(time.time()) + 86400}
+        return 'replay.' + base64.urlsafe_b64encode(json.dumps(payload).encode()).decode().rstrip('=') + '.sig'
+
+    @staticmethod
+    def token_subject(raw):
+        try:
+            body = raw.replace('Bearer ', '').split('.')[1]
+            return json.loads(base64.urlsafe_b64decode(body + '=' * (-len(body) % 4)))['sub']
+        except (IndexError, KeyError, ValueError):
+            return None
+
+    @staticmethod
+    def json_response(status, body):
+        return web.Response(status=status, text=body if body is not None else '{}',
+                            content_type='application/json')
+
+    # ── REST ────────────────────────────────────────────────────────────────
+    @web.middleware
+    async def count(self, request, handler):
+        self.stats['requests'] += 1
+        return await handler(request)
+
+    async def hyperhub_login(self, request):
+        email = (await request.json()).get('email', '')
+        status, body = await self.respond('hyperhub', 'POST', 'login', '{"ok": true}')
+        resp = self.json_response(status, body)
+        if status < 400:
+            resp.set_cookie('replay', email)
+        return resp
+
+    async def hyperhub_balance(self, request):
+        return self.json_response(*await self.respond('hyperhub', 'GET', 'wallet/balance', '{"XPL": 0}'))
+
+    async def overnode_balance(self, request):
+        return self.json_response(*await self.respond('overnode', 'GET', 'wallet/balance', '{"balance": 0}'))
+
+    async def altare_login(self, request):
+        email = (await request.json()).get('identifier', '')
+        status, _ = await self.respond('altare', 'POST', 'login')
+        if status >= 400:
+            return self.json_response(status, '{"error": "invalid credentials"}')
+        return web.json_response({'token': self.make_token(email)})
+
+    async def altare_tenants(self, request):
+        email = self.token_subject(request.headers.get('Authorization', ''))
+        if email is None:
+            return web.json_response({'error': 'unauthorized'}, status=401)
+        status, body = await self.respond('altare', 'GET', 'tenants', '{"items": [{"creditsCents": 0}]}')
+        try:
+            data = json.loads(body)
+            # id tenant thật trong bản ghi → tenant giả của account replay
+            data['items'][0]['id'] = f't-{email}'
+            body = json.dumps(data)
+        except (ValueError, KeyError, IndexError, TypeError):
+            pass
+        return self.json_response(status, body)
+
+    async def altare_afk(self, request):
+        action   = request.match_info['action']
+        endpoint = 'heartbeat' if action == 'heartbeat' else f'afk/{action}'
+        status, body = await self.respond('altare', 'POST', endpoint, status=204)
+        if status == 204:
+            return web.Response(status=204)
+        return self.json_response(status, body)
+
+    # ── WebSocket ───────────────────────────────────────────────────────────
+    async def websocket(self, request, tool, account):
+        ws = web.WebSocketResponse(heartbeat=None)
+        await ws.prepare(request)
+        self.stats['ws_open']  += 1
+        self.stats['ws_total'] += 1
+        session = self.next_session('ws', tool, account)
+        started = time.monotonic()
+        try:
+            if session is None:
+                self.stats['exhausted'] += 1
+            else:
+                for offset, raw in session.items:
+                    await self.until(started, offset)
+                    if ws.closed:
+                        break
+                    await ws.send_str(raw)
+                    self.stats['frames'] += 1
+                if session.close is not None and not ws.closed:
+                    offset, code = session.close
+                    await self.until(started, offset)
+                    self.stats['closes'] += 1
+                    if code is None or code == 1006:
+                        request.transport.abort()
+                        return ws
+                    await ws.close(code=code)
+                    return ws
+            async for _ in ws:   # hết phiên ghi: giữ kết nối tới khi client đóng
+                pass
+        except (ConnectionResetError, RuntimeError):
+            pass
+        finally:
+            self.stats['ws_open'] -= 1
+        return ws
+
+    async def hyperhub_ws(self, request):
+        account = request.cookies.get('replay')
+        if not account:
+            return web.Response(status=401)
+        return await self.websocket(request, 'hyperhub', account)
+
+    async def overnode_ws(self, request):
+        return await self.websocket(request, 'overnode', request.cookies.get('replay', ''))
+
+    # ── SSE ─────────────────────────────────────────────────────────────────
+    async def altare_subscribe(self, request):
+        email = self.token_subject(request.query.get('token', ''))
+        if email is None:
+            return web.Response(status=401)
+        resp = web.StreamResponse(headers={'Content-Type': 'text/event-stream', 'Cache-Control': 'no-cache'})
+        await resp.prepare(request)
+        self.stats['sse_open'] += 1
+        session = self.next_session('sse', 'altare', email)
+        started = time.monotonic()
+        try:
+            for offset, (event, data, event_id) in (session.items if session else ()):
+                await self.until(started, offset)
+                lines = f'id: {event_id}\n' if event_id else ''
+                if event and event != 'message':
+                    lines += f'event: {event}\n'
+                lines += ''.join(f'data: {part}\n' for part in data.split('\n'))
+                await resp.write((lines + '\n').encode())
+                self.stats['sse_events'] += 1
+            if session is None:
+                self.stats['exhausted'] += 1
+            while True:
+                await asyncio.sleep(15)
+                await resp.write(b': keepalive\n\n')
+        except (ConnectionResetError, asyncio.CancelledError):
+            pass
+        finally:
+            self.stats['sse_open'] -= 1
+        return resp
+
+    async def get_stats(self, request):
+        return web.json_response(self.stats)
+
+    def app(self):
+        app = web.Application(middlewares=[self.count])
+        app.router.add_post('/auth/login', self.hyperhub_login)
+        app.router.add_get('/wallet/balance', self.hyperhub_balance)
+        app.router.add_get('/ws', self.hyperhub_ws)
+        app.router.add_get('/api/wallet/balance', self.overnode_balance)
+        app.router.add_get('/api/afk/ws', self.overnode_ws)
+        app.router.add_post('/api/auth/login', self.altare_login)
+        app.router.add_get('/api/tenants', self.altare_tenants)
+        app.router.add_post('/api/tenants/{tenant}/rewards/afk/{action}', self.altare_afk)
+        app.router.add_get('/subscribe', self.altare_subscribe)
+        app.router.add_get('/stats', self.get_stats)
+        return app
+
+
+def parse_args(argv=None):
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument('recording', nargs='+', help='file ghi bởi AFK_RECORD (.jsonl hoặc .jsonl.gz)')
+    ap.add_argument('--host', default='127.0.0.1')
+    ap.add_argument('--port', type=int, default=8766)
+    ap.add_argument('--speed', type=float, default=1.0, help='hệ số tăng tốc; 0 = không chờ giữa các frame')
+    ap.add_argument('--info', action='store_true', help='in tóm tắt bản ghi rồi thoát')
+    return ap.parse_args(argv)
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    rec  = Recording(args.recording)
+    name = ' '.join(args.recording)
+    if args.info:
+        print(json.dumps(rec.summary(), indent=2))
+    else:
+        web.run_app(Replay(rec, args.speed).app(), host=args.host, port=args.port, access_log=None,
+                    print=lambda *_: print(f'replaying {name} x{args.speed} on '
+                                           f'http://{args.host}:{args.port}', flush=True))
@@ -0,0 +1,3 @@
+def post_worker_init(worker):
+    import main
+    main.post_worker_init(worker)
@@ -6,10 +6,40 @@ import time
 import requests
 import websocket
 import ssl
+import socket
 import urllib3
+from http.cookiejar import DefaultCookiePolicy
+from requests.adapters import HTTPAdapter
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
 import atexit
 import signal
 import sys
+import sqlite3
+import asyncio
+import heapq
+import selectors
+import itertools
+import random
+import bisect
+import hashlib
+from array import array
+import gzip
+import base64
+import csv
+import io
+import uuid
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 
@@ -20,17 +50,14 @@ from flask import Flask, render_template_string, request, jsonify
 app = Flask(__name__)
 
                                                                                 
-DATA_DIR = os.path.dirname(os.path.abspath(__file__))
+DATA_DIR = os.environ.get('AFK_DATA_DIR') or os.path.dirname(os.path.abspath(__file__))
 FILES = {
     'hyperhub': os.path.join(DATA_DIR, 'data_hyperhub.json'),
     'altare':   os.path.join(DATA_DIR, 'data_altare.json'),
     'overnode': os.path.join(DATA_DIR, 'data_overnode.json'),
 }
-
-for path in FILES.values():
-    if not os.path.exists(path):
-        with open(path, 'w') as f:
-            json.dump([], f)
+DB_PATH = os.environ.get('AFK_DB_PATH') or os.path.join(DATA_DIR, 'accounts.db')
+STORAGE = os.environ.get('AFK_STORAGE', 'sqlite').strip().lower()
 
 def read_data(tool):
     try:
@@ -39,66 +66,1151 @@ def read_data(tool):
     except Exception:
         return []
 
-_file_lock = threading.Lock()
+_file_lock = threading.RLock()
+FSYNC      = os.environ.get('AFK_FSYNC', 'normal').strip().lower()
 
 def write_data(tool, data):
+    """
+    Ghi ra file tạm rồi os.replace — reader không bao giờ thấy file ghi dở. Tên file tạm riêng
+    cho từng lần ghi: _file_lock chỉ có tác dụng trong một process (gunicorn --workers N).
+    """
+    path = FILES[tool]
+    tmp  = f'{path}.{os.getpid()}.{uuid.uuid4().hex[:8]}.tmp'
     with _file_lock:
-        with open(FILES[tool], 'w') as f:
-            json.dump(data, f, indent=4)
+        try:
+            with open(tmp, 'w') as f:
+                json.dump(data, f, indent=4)
+                if FSYNC != 'off':
+                    f.flush()
+                    os.fsync(f.fileno())
+            os.replace(tmp, path)
+        except BaseException:
+            try:
+                os.unlink(tmp)
+            except OSError:
+                pass
+            raise
+        if FSYNC == 'full':
+            fd = os.open(os.path.dirname(path), os.O_RDONLY)
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+
+class JsonStore:
+    """Backend cũ: mỗi tool một file data_<tool>.json, ghi lại cả file mỗi lần thay đổi"""
+
+    name = 'json'
+
+    def __init__(self):
+        for path in FILES.values():
+            if not os.path.exists(path):
+                with open(path, 'w') as f:
+                    json.dump([], f)
+
+    def list(self, tool):
+        return read_data(tool)
+
+    def get(self, tool, email):
+        return next((a for a in read_data(tool) if a.get('email') == email), None)
+
+    def insert(self, tool, acc):
+        with _file_lock:
+            accounts = read_data(tool)
+            if any(a.get('email') == acc.get('email') for a in accounts):
+                return False
+            accounts.append(acc)
+            write_data(tool, accounts)
+        return True
+
+    def update(self, tool, email, fields):
+        with _file_lock:
+            accounts = read_data(tool)
+            for acc in accounts:
+                if acc.get('email') == email:
+                    acc.update(fields)
+                    write_data(tool, accounts)
+                    return True
+        return False
+
+    def delete(self, tool, email):
+        with _file_lock:
+            accounts = read_data(tool)
+            kept     = [a for a in accounts if a.get('email') != email]
+            if len(kept) == len(accounts):
+                return False
+            write_data(tool, kept)
+        return True
+
+    def commit(self, tool, ops, snapshot):
+        write_data(tool, snapshot)
+
+class SqliteStore:
+    """
+    SQLite (WAL) — một dòng cho mỗi account, unique index (tool, email).
+    Insert/update/delete chỉ đụng tới đúng một dòng; lần mở đầu tiên import
+    dữ liệu từ các file JSON cũ.
+    """
+
+    name = 'sqlite'
+
+    def __init__(self, path):
+        self._lock = threading.Lock()
+        self._db   = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute(f"PRAGMA synchronous={ {'full': 'FULL', 'off': 'OFF'}.get(FSYNC, 'NORMAL') }")
+        self._db.execute('PRAGMA busy_timeout=5000')
+        self._db.executescript("""
+            CREATE TABLE IF NOT EXISTS accounts (
+                id    INTEGER PRIMARY KEY AUTOINCREMENT,
+                tool  TEXT NOT NULL,
+                email TEXT NOT NULL,
+                data  TEXT NOT NULL
+            );
+            CREATE UNIQUE INDEX IF NOT EXISTS accounts_tool_email ON accounts (tool, email);
+            CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+        """)
+        self.migrate_json()
+
+    def migrate_json(self):
+        """
+        Nhập data_<tool>.json cũ một lần. Đọc strict (không qua read_data, vốn nuốt lỗi trả []):
+        file hỏng/ghi dở thì lỗi bay ra lúc khởi động thay vì bị đánh dấu đã migrate với 0 account.
+        Chưa có file thì không ghi marker — file xuất hiện sau vẫn được nhập.
+        """
+        for tool, path in FILES.items():
+            key = f'migrated:{tool}'
+            with self._lock:
+                if self._db.execute('SELECT 1 FROM meta WHERE key = ?', (key,)).fetchone():
+                    continue
+                if not os.path.exists(path):
+                    continue
+                with open(path, 'r') as f:
+                    rows = json.load(f)
+                if not isinstance(rows, list):
+                    raise ValueError(f'{path}: expected a JSON list of accounts')
+                self._db.execute('BEGIN IMMEDIATE')
+                self._db.executemany(
+                    'INSERT OR IGNORE INTO accounts (tool, email, data) VALUES (?, ?, ?)',
+                    [(tool, a.get('email', ''), json.dumps(a)) for a in rows if isinstance(a, dict)])
+                self._db.execute('INSERT INTO meta (key, value) VALUES (?, ?)', (key, str(time.time())))
+                self._db.execute('COMMIT')
+            if rows:
+                print(f'[INFO] Migrated {len(rows)} {tool} account(s) from {os.path.basename(path)} to SQLite')
+
+    def list(self, tool):
+        with self._lock:
+            rows = self._db.execute('SELECT data FROM accounts WHERE tool = ? ORDER BY id', (tool,)).fetchall()
+        return [json.loads(r[0]) for r in rows]
+
+    def get(self, tool, email):
+        with self._lock:
+            row = self._db.execute('SELECT data FROM accounts WHERE tool = ? AND email = ?',
+                                   (tool, email)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def insert(self, tool, acc):
+        with self._lock:
+            cur = self._db.execute('INSERT OR IGNORE INTO accounts (tool, email, data) VALUES (?, ?, ?)',
+                                   (tool, acc.get('email', ''), json.dumps(acc)))
+        return cur.rowcount == 1
+
+    def update(self, tool, email, fields):
+        with self._lock:
+            self._db.execute('BEGIN IMMEDIATE')
+            row = self._db.execute('SELECT data FROM accounts WHERE tool = ? AND email = ?',
+                                   (tool, email)).fetchone()
+            if row:
+                acc = json.loads(row[0])
+                acc.update(fields)
+                self._db.execute('UPDATE accounts SET data = ? WHERE tool = ? AND email = ?',
+                                 (json.dumps(acc), tool, email))
+            self._db.execute('COMMIT')
+        return row is not None
+
+    def delete(self, tool, email):
+        with self._lock:
+            cur = self._db.execute('DELETE FROM accounts WHERE tool = ? AND email = ?', (tool, email))
+        return cur.rowcount > 0
+
+    def commit(self, tool, ops, snapshot):
+        upserts = [(tool, email, json.dumps(acc)) for email, acc in ops.items() if acc is not None]
+        deletes = [(tool, email) for email, acc in ops.items() if acc is None]
+        with self._lock:
+            self._db.execute('BEGIN IMMEDIATE')
+            try:
+                self._db.executemany('DELETE FROM accounts WHERE tool = ? AND email = ?', deletes)
+                self._db.executemany(
+                    'INSERT INTO accounts (tool, email, data) VALUES (?, ?, ?) '
+                    'ON CONFLICT (tool, email) DO UPDATE SET data = excluded.data', upserts)
+                self._db.execute('COMMIT')
+            except Exception:
+                self._db.execute('ROLLBACK')
+                raise
+
+def open_store():
+    if STORAGE == 'sqlite':
+        try:
+            return SqliteStore(DB_PATH)
+        except (sqlite3.Error, OSError) as e:
+            # JSON cũ hỏng (ValueError từ migrate_json) không fallback: JsonStore sẽ đọc ra [] rồi ghi đè
+            print(f'[WARN] SQLite storage unavailable ({e}) — falling back to JSON files')
+    return JsonStore()
+
+store = open_store()
+
+FLUSH_DELAY = float(os.environ.get('AFK_FLUSH_DELAY', 0.5))
+
+class AccountRegistry:
+    """
+    Nguồn dữ liệu chính trong RAM: {tool: {email: account}}. Đọc không bao giờ chạm đĩa;
+    ghi được ghi vào journal (mỗi email chỉ giữ thao tác cuối) rồi thread nền gom lại
+    sau FLUSH_DELAY giây và commit một lần xuống store.
+    """
+
+    def __init__(self, backend):
+        self.backend   = backend
+        self._lock     = threading.Lock()
+        self._accounts = {tool: {a.get('email', ''): a for a in backend.list(tool)} for tool in FILES}
+        self._pending  = {tool: {} for tool in FILES}
+        self._dirty    = threading.Event()
+        self._flushing = threading.Lock()
+        self._thread   = None
+        self.on_flush  = []
+        self.generation = {tool: 0 for tool in FILES}
+
+    def list(self, tool):
+        with self._lock:
+            return [dict(a) for a in self._accounts[tool].values()]
+
+    def get(self, tool, email):
+        with self._lock:
+            acc = self._accounts[tool].get(email)
+            return dict(acc) if acc is not None else None
+
+    def count(self, tool):
+        return len(self._accounts[tool])
+
+    def emails(self, tool):
+        with self._lock:
+            return list(self._accounts[tool])
+
+    def reload(self):
+        """Đọc lại từ store (process khác vừa ghi), giữ nguyên các thay đổi chưa flush"""
+        fresh = {tool: {a.get('email', ''): a for a in self.backend.list(tool)} for tool in FILES}
+        with self._lock:
+            for tool, ops in self._pending.items():
+                for email, acc in ops.items():
+                    if acc is None:
+                        fresh[tool].pop(email, None)
+                    else:
+                        fresh[tool][email] = dict(acc)
+            self._accounts = fresh
+            for tool in FILES:
+                self.generation[tool] += 1
+
+    def insert(self, tool, acc):
+        email = acc.get('email', '')
+        with self._lock:
+            if email in self._accounts[tool]:
+                return False
+            self._accounts[tool][email] = dict(acc)
+            self._pending[tool][email]  = dict(acc)
+            self.generation[tool] += 1
+        self._schedule()
+        return True
+
+    def insert_many(self, tool, accounts):
+        """Thêm cả lô dưới một lần khoá → một lần commit xuống store. Trả về các account đã thêm"""
+        added = []
+        with self._lock:
+            for acc in accounts:
+                email = acc.get('email', '')
+                if email in self._accounts[tool]:
+                    continue
+                self._accounts[tool][email] = dict(acc)
+                self._pending[tool][email]  = dict(acc)
+                added.append(acc)
+            if added:
+                self.generation[tool] += 1
+        if added:
+            self._schedule()
+        return added
+
+    def update(self, tool, email, fields):
+        with self._lock:
+            acc = self._accounts[tool].get(email)
+            if acc is None:
+                return False
+            acc.update(fields)
+            self._pending[tool][email] = dict(acc)
+            self.generation[tool] += 1
+        self._schedule()
+        return True
+
+    def delete(self, tool, email):
+        with self._lock:
+            if self._accounts[tool].pop(email, None) is None:
+                return False
+            self._pending[tool][email] = None
+            self.generation[tool] += 1
+        self._schedule()
+        return True
+
+    def delete_many(self, tool, emails):
+        deleted = []
+        with self._lock:
+            for email in emails:
+                if self._accounts[tool].pop(email, None) is not None:
+                    self._pending[tool][email] = None
+                    deleted.append(email)
+            if deleted:
+                self.generation[tool] += 1
+        if deleted:
+            self._schedule()
+        return deleted
+
+    def _schedule(self):
+        if self._thread is None:
+            with self._lock:
+                if self._thread is None:
+                    self._thread = threading.Thread(target=self._run, name='afk-registry-flush', daemon=True)
+                    self._thread.start()
+        self._dirty.set()
+
+    def _run(self):
+        while True:
+            self._dirty.wait()
+            time.sleep(FLUSH_DELAY)
+            self._dirty.clear()
+            try:
+                self.flush()
+            except Exception:
+                # flush() đã log theo từng tool lỗi, chỉ cần thử lại
+                time.sleep(1)
+                self._dirty.set()
+
+    def flush(self):
+        with self._flushing:
+            with self._lock:
+                batches  = {t: ops for t, ops in self._pending.items() if ops}
+                self._pending = {tool: {} for tool in FILES}
+                snapshot = {t: [dict(a) for a in self._accounts[t].values()] for t in batches}
+            # commit từng tool độc lập: một tool lỗi không làm mất op của các tool khác
+            failed, committed = None, False
+            for tool, ops in batches.items():
+                try:
+                    self.backend.commit(tool, ops, snapshot[tool])
+                    committed = True
+                except Exception as e:
+                    failed = failed or e
+                    add_log(tool, 'Storage flush failed: {error}', level=ERROR, event='storage_error',
+                            error=str(e), ops=len(ops))
+                    with self._lock:
+                        for email, acc in ops.items():
+                            self._pending[tool].setdefault(email, acc)
+            if committed:
+                for fn in self.on_flush:
+                    fn()
+            if failed is not None:
+                raise failed
+
+registry = AccountRegistry(store)
+
+def persist_account(tool, email, fields):
+    """Lưu thay đổi của account từ worker. Farm process gửi về web process ghi hộ vì registry của nó không phải bản chuẩn"""
+    if farm_link is not None:
+        farm_link.export_update(tool, email, fields)
+    else:
+        registry.update(tool, email, fields)
+
+                                                                               
+METRIC_SHARDS   = 16
+LATENCY_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+METRICS         = []
+_metric_slots   = itertools.count()
+_metric_local   = threading.local()
+
+def _metric_shard():
+    """Mỗi thread ghi vào một shard cố định (gán vòng tròn) → lock của shard gần như không bị tranh"""
+    try:
+        return _metric_local.slot
+    except AttributeError:
+        _metric_local.slot = slot = next(_metric_slots) % METRIC_SHARDS
+        return slot
+
+def _label_value(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _label_str(names, values, le=None):
+    pairs = [f'{n}="{_label_value(v)}"' for n, v in zip(names, values)]
+    if le is not None:
+        pairs.append(f'le="{le}"')
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+class Metric:
+    """
+    Metric kiểu Prometheus. Giá trị chia theo METRIC_SHARDS shard, mỗi shard một lock:
+    hot path chỉ khoá shard của thread mình, /metrics mới gộp các shard.
+    AFK_MODE=supervisor: snapshot cộng dồn của từng farm process nằm trong _remote và được
+    gộp vào lúc render; farm đã thoát thì số của nó chuyển vào 'retired' để counter không giảm.
+    """
+
+    kind = 'untyped'
+
+    def __init__(self, name, help, labels=()):
+        self.name    = name
+        self.help    = help
+        self.labels  = labels
+        self._shards = [{} for _ in range(METRIC_SHARDS)]
+        self._locks  = [threading.Lock() for _ in range(METRIC_SHARDS)]
+        self._remote = {}
+        METRICS.append(self)
+
+    def _local(self):
+        out = {}
+        for values, lock in zip(self._shards, self._locks):
+            with lock:
+                items = [(k, list(v) if isinstance(v, list) else v) for k, v in values.items()]
+            for key, value in items:
+                out[key] = value if key not in out else self._merge(out[key], value)
+        return out
+
+    def _merged(self):
+        out = self._local()
+        for values in list(self._remote.values()):
+            for key, value in values.items():
+                out[key] = value if key not in out else self._merge(out[key], value)
+        return out
+
+    def export(self):
+        """Giá trị của riêng process này, gửi từ farm về web process"""
+        return self._local()
+
+    def absorb(self, source, values):
+        self._remote[source] = values
+
+    def retire(self, source):
+        values = self._remote.pop(source, None)
+        if values:
+            retired = dict(self._remote.get('retired', {}))
+            for key, value in values.items():
+                retired[key] = value if key not in retired else self._merge(retired[key], value)
+            self._remote['retired'] = retired
+
+    def render(self):
+        yield f'# HELP {self.name} {self.help}'
+        yield f'# TYPE {self.name} {self.kind}'
+        yield from self.samples()
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, *labels, value=1):
+        i = _metric_shard()
+        with self._locks[i]:
+            values = self._shards[i]
+            values[labels] = values.get(labels, 0) + value
+
+    @staticmethod
+    def _merge(a, b):
+        return a + b
+
+    def samples(self):
+        for labels, value in sorted(self._merged().items()):
+            yield f'{self.name}{_label_str(self.labels, labels)} {value:g}'
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = buckets
+
+    def observe(self, value, *labels):
+        idx = bisect.bisect_left(self.buckets, value)
+        i   = _metric_shard()
+        with self._locks[i]:
+            row = self._shards[i].get(labels)
+            if row is None:
+                # số đếm từng bucket (không cộng dồn) + bucket +Inf + tổng
+                row = self._shards[i][labels] = [0] * (len(self.buckets) + 1) + [0.0]
+            row[idx] += 1
+            row[-1]  += value
+
+    @staticmethod
+    def _merge(a, b):
+        return [x + y for x, y in zip(a, b)]
+
+    def samples(self):
+        for labels, row in sorted(self._merged().items()):
+            total = 0
+            for bound, count in zip((*self.buckets, '+Inf'), row):
+                total += count
+                le = bound if bound == '+Inf' else f'{bound:g}'
+                yield f'{self.name}_bucket{_label_str(self.labels, labels, le)} {total}'
+            yield f'{self.name}_sum{_label_str(self.labels, labels)} {row[-1]:.6f}'
+            yield f'{self.name}_count{_label_str(self.labels, labels)} {total}'
+
+class Gauge(Metric):
+    """
+    Giá trị đọc lúc scrape: fn() → số, hoặc dict {tuple label: số}. per_process=False: web
+    process đã thấy đủ (vd. account đồng bộ từ farm) nên không cộng thêm số của farm.
+    """
+
+    kind = 'gauge'
+
+    def __init__(self, name, help, fn, labels=(), per_process=True):
+        super().__init__(name, help, labels)
+        self.fn          = fn
+        self.per_process = per_process
+
+    def _values(self):
+        value = self.fn()
+        return dict(value) if isinstance(value, dict) else {(): value}
+
+    def export(self):
+        return self._values() if self.per_process else None
+
+    def retire(self, source):
+        # gauge là giá trị hiện tại — farm đã thoát thì không còn gì để cộng
+        self._remote.pop(source, None)
+
+    def samples(self):
+        try:
+            values = self._values()
+        except Exception:
+            return
+        for remote in list(self._remote.values()):
+            for labels, v in remote.items():
+                values[labels] = values.get(labels, 0) + v
+        for labels, v in sorted(values.items()):
+            yield f'{self.name}{_label_str(self.labels, labels)} {v:g}'
+
+def render_metrics():
+    return '\n'.join(line for m in METRICS for line in m.render()) + '\n'
+
+def export_metrics():
+    """{tên metric: giá trị của process này} — farm gửi định kỳ qua FarmLink"""
+    out = {}
+    for m in METRICS:
+        try:
+            values = m.export()
+        except Exception:
+            continue
+        if values:
+            out[m.name] = values
+    return out
+
+def absorb_metrics(source, snapshot):
+    by_name = {m.name: m for m in METRICS}
+    for name, values in snapshot.items():
+        if name in by_name:
+            by_name[name].absorb(source, values)
+
+def retire_metrics(source):
+    for m in METRICS:
+        m.retire(source)
+
+UPSTREAM_LATENCY  = Histogram('afk_upstream_request_seconds',
+                              'Upstream HTTP time to response headers', ('platform', 'endpoint'))
+UPSTREAM_REQUESTS = Counter('afk_upstream_requests_total', 'Upstream HTTP requests by status',
+                            ('platform', 'endpoint', 'status'))
+WS_CONNECTS       = Counter('afk_ws_connects_total', 'WebSocket connections opened', ('platform',))
+WS_CLOSES         = Counter('afk_ws_closes_total', 'WebSocket connections closed by close code', ('platform', 'code'))
+REWARD_EVENTS     = Counter('afk_reward_events_total', 'Reward events detected', ('platform',))
+LOG_DROPS         = Counter('afk_log_dropped_total', 'Log entries SSE subscribers skipped because they fell behind',
+                            ('tool',))
+STATUS_RESYNCS    = Counter('afk_status_resync_total', 'SSE subscribers that lost status deltas and had to resync')
+
+UPSTREAM_ENDPOINTS = (
+    ('/auth/login', 'login'), ('/api/tenants', 'tenants'), ('/afk/start', 'afk/start'),
+    ('/afk/heartbeat', 'heartbeat'), ('/afk/stop', 'afk/stop'), ('/wallet/balance', 'wallet/balance'),
+    ('/subscribe', 'subscribe'),
+)
+
+def upstream_endpoint(path):
+    """Gom URL upstream về vài tên cố định — không để id tenant/email lọt vào label"""
+    path = path.split('?', 1)[0].rstrip('/')
+    for suffix, name in UPSTREAM_ENDPOINTS:
+        if path.endswith(suffix):
+            return name
+    return 'other'
+
+def observe_upstream(tool, path, status, seconds):
+    endpoint = upstream_endpoint(path)
+    UPSTREAM_LATENCY.observe(seconds, tool, endpoint)
+    UPSTREAM_REQUESTS.inc(tool, endpoint, str(status))
 
                                                                                
 from collections import deque
-MAX_LOGS  = 300
+MAX_LOGS  = int(os.environ.get('AFK_MAX_LOGS', 300))
 _log_lock = threading.Lock()
-                                             
-                                                                            
-_log_seq  = {'hyperhub': 0, 'altare': 0, 'overnode': 0}                     
-app_logs  = {
-    'hyperhub': deque(maxlen=MAX_LOGS),
-    'altare':   deque(maxlen=MAX_LOGS),
-    'overnode': deque(maxlen=MAX_LOGS),
-}
 
-                                                                                
-import queue as _queue
-_client_queues     = []
-_client_queues_lock = threading.Lock()
+DEBUG, INFO, WARNING, ERROR = 10, 20, 30, 40
+LEVEL_NAMES = {DEBUG: 'debug', INFO: 'info', WARNING: 'warn', ERROR: 'error'}
+LOG_LEVEL   = {'debug': DEBUG, 'info': INFO, 'warn': WARNING, 'warning': WARNING, 'error': ERROR}.get(
+    os.environ.get('AFK_LOG_LEVEL', 'info').strip().lower(), INFO)
 
-def add_log(tool, msg):
-    if tool not in app_logs:
+class LogEntry:
+    """
+    Log có cấu trúc: template + fields (balance, delta, code, ...). Chuỗi hiển thị chỉ được
+    format khi có consumer cần text, JSON cho SSE chỉ serialize một lần.
+    """
+
+    __slots__ = ('tool', 'seq', 'timestamp', 'template', 'account', 'level', 'event', 'fields',
+                 '_message', '_json')
+
+    def __init__(self, tool, seq, timestamp, template, account=None, level=INFO, event=None, fields=None):
+        self.tool      = tool
+        self.seq       = seq
+        self.timestamp = timestamp
+        self.template  = template
+        self.account   = account
+        self.level     = level
+        self.event     = event
+        self.fields    = fields
+        self._message  = None
+        self._json     = None
+
+    @property
+    def message(self):
+        if self._message is None:
+            text = self.template
+            if self.fields:
+                try:
+                    text = text.format(**self.fields)
+                except (KeyError, IndexError, ValueError):
+                    pass
+            self._message = f'[{self.account}] {text}' if self.account else text
+        return self._message
+
+    def record(self):
+        """Dạng gọn để gửi sang process khác — bên nhận vẫn format lười"""
+        return (self.tool, self.timestamp, self.template, self.account, self.level, self.event, self.fields)
+
+    def as_dict(self):
+        d = {'tool': self.tool, 'seq': self.seq, 'timestamp': self.timestamp, 'message': self.message,
+             'account': self.account, 'level': LEVEL_NAMES.get(self.level, 'info'), 'event': self.event}
+        if self.fields:
+            for k, v in self.fields.items():
+                d.setdefault(k, v)
+        return d
+
+    def json(self):
+        """Serialize đúng một lần, dùng chung cho mọi subscriber"""
+        if self._json is None:
+            self._json = json.dumps(self.as_dict())
+        return self._json
+
+class LogRing:
+    """
+    Ring buffer của một tool. seq tăng liên tục; subscriber giữ cursor (seq kế tiếp cần đọc)
+    nên publish chỉ là ghi một ô — không copy cho từng client. Cursor tụt quá xa thì
+    read() trả về số dòng bị bỏ qua thay vì ngắt client.
+    """
+
+    def __init__(self, maxlen):
+        self.maxlen   = maxlen
+        self.next_seq = 0
+        self._buf     = [None] * maxlen
+
+    def append(self, entry):
+        self._buf[entry.seq % self.maxlen] = entry
+        self.next_seq = entry.seq + 1
+
+    @property
+    def oldest(self):
+        return max(0, self.next_seq - self.maxlen)
+
+    def read(self, cursor):
+        start = max(cursor, self.oldest)
+        return start - cursor if cursor >= 0 else 0, [self._buf[s % self.maxlen] for s in range(start, self.next_seq)]
+
+    def __iter__(self):
+        return iter(self.read(0)[1])
+
+    def __len__(self):
+        return self.next_seq - self.oldest
+
+app_logs = {tool: LogRing(MAX_LOGS) for tool in ('hyperhub', 'altare', 'overnode')}
+_log_subscribers = [0]
+_log_watchers    = {tool: set() for tool in app_logs}   # tool → Event của từng SSE client đang xem tool đó
+
+def _wake(tool):
+    """Đánh thức đúng các SSE client đang xem tool — gọi khi đang giữ _log_lock"""
+    for event in _log_watchers.get(tool, ()):
+        event.set()
+
+def log_enabled(level):
+    return level >= LOG_LEVEL
+
+def add_log(tool, msg, account=None, level=INFO, event=None, **fields):
+    """
+    msg là template, chỉ được format (msg.format(**fields)) khi cần hiển thị.
+    Log dưới AFK_LOG_LEVEL bị bỏ ngay từ đầu — nhưng dict fields đã được dựng lúc gọi, nên
+    log DEBUG trên hot path bọc trong `if log_enabled(DEBUG):`.
+    """
+    if level < LOG_LEVEL or tool not in app_logs:
         return
-    ts = time.time()
+    entry = publish_log((tool, time.time(), msg, account, level, event, fields or None))
+    if account is not None:
+        note_account_event(tool, account, entry)
+    if coordinator is not None:
+        coordinator.export_log(entry)
+    if farm_link is not None:
+        farm_link.export_log(entry)
+    if level >= WARNING:
+        print(f"[{time.strftime('%H:%M:%S')}] [{tool.upper()}] {entry.message}")
+
+def note_account_event(tool, email, entry):
+    """Lỗi gần nhất và thời điểm nhận thưởng gần nhất của account — phục vụ lọc/sắp xếp danh sách"""
+    st = app_state[tool].get(email)
+    if st is None:
+        return
+    if entry.level >= ERROR:
+        st['error'] = entry.message
+    elif entry.event == 'connected':
+        st['error'] = None
+    elif entry.event in ('reward', 'balance') and entry.fields and 'delta' in entry.fields:
+        st['last_reward'] = entry.timestamp
+
+def publish_log(record):
+    """Đưa log (LogEntry.record()) vào ring buffer của process này, không gửi sang process khác"""
+    tool = record[0]
     with _log_lock:
-        seq = _log_seq[tool]
-        _log_seq[tool] += 1
-        entry = {'seq': seq, 'timestamp': ts, 'message': msg}
-        app_logs[tool].append(entry)
-                                               
-    payload = json.dumps({'tool': tool, 'seq': seq, 'timestamp': ts, 'message': msg})
-    with _client_queues_lock:
-        dead = []
-        for q in _client_queues:
+        ring  = app_logs[tool]
+        entry = LogEntry(tool, ring.next_seq, *record[1:])
+        ring.append(entry)
+        _wake(tool)
+    return entry
+
+                                                                                
+class StopEvent(threading.Event):
+    """
+    threading.Event gọi các callback ngay khi set() — dùng để huỷ job/timer tức thì.
+    Dùng một lần: callback đã chạy hết lúc set nên clear() rồi dùng lại sẽ để job cũ sống tiếp
+    mà không ai huỷ — run mới tạo event mới (WorkerRun).
+    """
+
+    def __init__(self):
+        super().__init__()
+        self._callbacks = []
+        self._cb_lock   = threading.Lock()
+
+    def add_callback(self, fn):
+        with self._cb_lock:
+            if not self.is_set():
+                self._callbacks.append(fn)
+                return
+        fn()
+
+    def remove_callback(self, fn):
+        with self._cb_lock:
+            try:
+                self._callbacks.remove(fn)
+            except ValueError:
+                pass
+
+    def clear(self):
+        raise RuntimeError('StopEvent is single-use — create a new one for the next run')
+
+    def set(self):
+        super().set()
+        with self._cb_lock:
+            callbacks, self._callbacks = self._callbacks, []
+        for fn in callbacks:
+            try:
+                fn()
+            except Exception:
+                pass
+
+class Job:
+    __slots__ = ('fn', 'interval', 'jitter', 'deadline', 'cancelled', 'name', 'stop_event')
+
+    def __init__(self, fn, interval, delay, stop_event, name, jitter=0.0):
+        self.fn         = fn
+        self.interval   = interval
+        self.jitter     = jitter
+        self.deadline   = time.monotonic() + delay
+        self.cancelled  = False
+        self.name       = name
+        self.stop_event = stop_event
+
+    def next_delay(self):
+        if not self.jitter:
+            return self.interval
+        return self.interval * (1 + random.uniform(-self.jitter, self.jitter))
+
+    def cancel(self):
+        self.cancelled = True
+
+    def dead(self):
+        return self.cancelled or self.stop_event is not None and self.stop_event.is_set()
+
+class Scheduler:
+    """
+    Heap scheduler dùng chung cho mọi worker: một thread chờ đúng tới deadline gần nhất
+    (không poll 1s), job chạy trên thread pool. Job gắn với stop_event của lần chạy worker
+    (WorkerRun) sẽ bị huỷ ngay khi run đó dừng — resume tạo run mới nên không hồi sinh job cũ.
+    """
+
+    def __init__(self, workers):
+        self._heap    = []
+        self._seq     = itertools.count()
+        self._cond    = threading.Condition()
+        self._workers = workers
+        self._pool    = None
+        self._thread  = None
+
+    def call_later(self, delay, fn, stop_event=None, name=''):
+        return self._push(Job(fn, None, delay, stop_event, name), register=True)
+
+    def every(self, interval, fn, stop_event=None, first=None, name='', jitter=0.0):
+        job = Job(fn, interval, 0, stop_event, name, jitter)
+        job.deadline += job.next_delay() if first is None else first
+        return self._push(job, register=True)
+
+    def pending(self):
+        with self._cond:
+            return sum(1 for _, _, job in self._heap if not job.dead())
+
+    def _push(self, job, register=False):
+        if register and job.stop_event is not None:
+            job.stop_event.add_callback(job.cancel)
+        with self._cond:
+            if self._thread is None:
+                self._pool   = ThreadPoolExecutor(max_workers=self._workers, thread_name_prefix='afk-job')
+                self._thread = threading.Thread(target=self._run, name='afk-scheduler', daemon=True)
+                self._thread.start()
+            heapq.heappush(self._heap, (job.deadline, next(self._seq), job))
+            self._cond.notify()
+        return job
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while True:
+                    while self._heap and self._heap[0][2].dead():
+                        self._discard(heapq.heappop(self._heap)[2])
+                    if not self._heap:
+                        self._cond.wait()
+                        continue
+                    delay = self._heap[0][0] - time.monotonic()
+                    if delay <= 0:
+                        break
+                    self._cond.wait(delay)
+                job = heapq.heappop(self._heap)[2]
             try:
-                q.put_nowait(payload)
-            except _queue.Full:
-                dead.append(q)
-        for q in dead:
-            _client_queues.remove(q)
-    if any(k in msg.lower() for k in ('error', 'fail', 'exception', 'lỗi', 'stuck', 'warn', 'timeout')):
-        print(f"[{time.strftime('%H:%M:%S')}] [{tool.upper()}] {msg}")
+                self._pool.submit(self._execute, job)
+            except RuntimeError:
+                return
+
+    def _execute(self, job):
+        if job.dead():
+            return self._discard(job)
+        try:
+            job.fn()
+        except Exception as e:
+            print(f"[{time.strftime('%H:%M:%S')}] [SCHEDULER] job {job.name or job.fn} failed: {e}")
+        if job.interval and not job.dead():
+            job.deadline = time.monotonic() + job.next_delay()
+            self._push(job)
+        else:
+            self._discard(job)
+
+    def _discard(self, job):
+        if job.stop_event is not None:
+            job.stop_event.remove_callback(job.cancel)
+
+scheduler = Scheduler(int(os.environ.get('AFK_SCHED_WORKERS', 32)))
 
                                                                                 
+STATUS_FIELDS    = ('running', 'balance', 'coins_per_min', 'connection', 'error', 'last_reward')
+STATUS_FEED_SIZE = int(os.environ.get('AFK_STATUS_FEED', 2048))
+
+class StatusDelta:
+    """Các field trạng thái vừa đổi của một account, kèm version của account đó"""
+
+    __slots__ = ('seq', 'tool', 'account', 'version', 'changes')
+
+    def __init__(self, seq, tool, account, version, changes):
+        self.seq     = seq
+        self.tool    = tool
+        self.account = account
+        self.version = version
+        self.changes = changes
+
+status_feed = LogRing(STATUS_FEED_SIZE)
+
+def _push_status(tool, email, version, changes):
+    # gọi khi đang giữ _log_lock
+    status_feed.append(StatusDelta(status_feed.next_seq, tool, email, version, changes))
+    _wake(tool)
+
+def publish_status(tool, email, version, changes):
+    """Delta của account thuộc process khác — version giữ nguyên theo process sở hữu"""
+    with _log_lock:
+        _push_status(tool, email, version, changes)
+
+STATE_COLUMNS  = os.environ.get('AFK_STATE_COLUMNS', '0') == '1'
+NUMERIC_FIELDS = ('balance', 'coins_per_min', 'last_reward')
+NAN            = float('nan')
+
+class RuntimeColumns:
+    """
+    AFK_STATE_COLUMNS=1: balance / coins_per_min / last_reward của mọi account một platform nằm
+    trong ba array('d') liền nhau (8 byte/giá trị, không phải float object) — tổng hợp chạy trên
+    mảng thay vì duyệt từng account. NaN = chưa có giá trị; row của account bị xoá được dùng lại.
+    """
+
+    def __init__(self):
+        self.balance       = array('d')
+        self.coins_per_min = array('d')
+        self.last_reward   = array('d')
+        self._free         = []
+        self._lock         = threading.Lock()
+
+    def acquire(self):
+        with self._lock:
+            if self._free:
+                return self._free.pop()
+            for name in NUMERIC_FIELDS:
+                getattr(self, name).append(NAN)
+            return len(self.balance) - 1
+
+    def release(self, row):
+        with self._lock:
+            for name in NUMERIC_FIELDS:
+                getattr(self, name)[row] = NAN
+            self._free.append(row)
+
+    def total(self, name):
+        return sum(v for v in getattr(self, name) if v == v)
+
+state_columns = {tool: RuntimeColumns() for tool in ('hyperhub', 'altare', 'overnode')} if STATE_COLUMNS else None
+
+def _numeric_field(name):
+    """Field số của AccountRuntime: slot riêng, hoặc một ô trong RuntimeColumns khi có row"""
+    slot = '_' + name
+
+    def fget(self):
+        if self._row is None:
+            return getattr(self, slot)
+        v = getattr(state_columns[self.tool], name)[self._row]
+        if v != v:
+            raise AttributeError(name)
+        return v
+
+    def fset(self, value):
+        if self._row is None:
+            setattr(self, slot, value)
+        else:
+            getattr(state_columns[self.tool], name)[self._row] = NAN if value is None else value
+
+    def fdel(self):
+        if self._row is None:
+            delattr(self, slot)
+        else:
+            getattr(state_columns[self.tool], name)[self._row] = NAN
+
+    return property(fget, fset, fdel)
+
+_MISSING = object()
+
+class AccountRuntime:
+    """
+    State runtime của một account: record __slots__ cố định thay cho dict + các list một phần tử
+    trong closure của worker (last_nri, earned). Vẫn đọc/ghi được kiểu dict (state['running'],
+    get, pop, in) — slot chưa gán coi như key chưa có.
+    Ghi vào field trong STATUS_FIELDS (khi giá trị thực sự đổi) sẽ tăng version và đẩy delta vào
+    status_feed — dashboard nhận qua SSE thay vì poll. Version bắt đầu từ epoch ms nên account
+    được nhận lại ở process khác vẫn tăng tiếp.
+    """
+
+    __slots__ = ('tool', 'email', 'version', 'running', 'connection', 'error', 'is_farming',
+                 'last_nri', 'earned', 'run', '_row', '_balance', '_coins_per_min', '_last_reward')
+
+    FIELDS = frozenset(('running', 'balance', 'coins_per_min', 'connection', 'error', 'last_reward',
+                        'is_farming', 'last_nri', 'earned'))
+
+    balance       = _numeric_field('balance')
+    coins_per_min = _numeric_field('coins_per_min')
+    last_reward   = _numeric_field('last_reward')
+
+    def __init__(self, tool, email, **fields):
+        self.tool    = tool
+        self.email   = email
+        self.version = int(time.time() * 1000)
+        self.run     = None
+        self._row    = state_columns[tool].acquire() if state_columns is not None else None
+        for key, value in fields.items():
+            setattr(self, key, value)
+
+    def get(self, key, default=None):
+        return getattr(self, key, default) if key in self.FIELDS else default
+
+    def __getitem__(self, key):
+        value = self.get(key, _MISSING)
+        if value is _MISSING:
+            raise KeyError(key)
+        return value
+
+    def __contains__(self, key):
+        return self.get(key, _MISSING) is not _MISSING
+
+    def __setitem__(self, key, value):
+        if key not in self.FIELDS:
+            raise KeyError(key)
+        if key in STATUS_FIELDS and self.get(key) != value:
+            setattr(self, key, value)
+            self._publish({key: value})
+        else:
+            setattr(self, key, value)
+
+    def pop(self, key, default=None):
+        value = self.get(key, _MISSING)
+        if value is _MISSING:
+            return default
+        delattr(self, key)
+        return value
+
+    def apply(self, fields, version=None):
+        """Gộp nhiều field một lần (vd. từ farm process) → tối đa một delta"""
+        changes = {k: v for k, v in fields.items() if k in self.FIELDS and self.get(k) != v}
+        if changes:
+            for key, value in changes.items():
+                setattr(self, key, value)
+            self._publish(changes, version)
+
+    def release(self):
+        """Trả row trong RuntimeColumns khi account bị dọn khỏi app_state (giá trị chuyển về slot)"""
+        if self._row is None:
+            return
+        values    = {name: self.get(name, _MISSING) for name in NUMERIC_FIELDS}
+        row       = self._row
+        self._row = None
+        state_columns[self.tool].release(row)
+        for name, value in values.items():
+            if value is not _MISSING:
+                setattr(self, name, value)
+
+    def _publish(self, changes, version=None):
+        with _log_lock:
+            self.version = max(self.version + 1, version or 0)
+            _push_status(self.tool, self.email, self.version, changes)
+
+WORKER_JOIN_TIMEOUT = float(os.environ.get('AFK_WORKER_JOIN_TIMEOUT', 5))
+
+class WorkerRun:
+    """
+    Một lần chạy worker của account — thứ worker nhận làm `state`. stop_event, thread, task và cờ
+    running là của riêng lần chạy này; field khác đọc/ghi thẳng vào AccountRuntime. Pause rồi
+    resume nhanh tạo run mới: event của run cũ đã set nên thread / task / SSE loop cũ vẫn thoát,
+    và run cũ (không còn là runtime.run) không ghi đè trạng thái của run mới được nữa.
+    """
+
+    __slots__ = ('runtime', 'stop_event', 'done', 'live', 'thread', 'task')
+
+    OWN = frozenset(('stop_event', 'thread', 'task'))
+
+    def __init__(self, runtime):
+        self.runtime    = runtime
+        self.stop_event = StopEvent()
+        self.done       = threading.Event()
+        self.live       = True
+        self.thread     = None
+        self.task       = None
+
+    def __getattr__(self, name):
+        return getattr(self.runtime, name)
+
+    def __setattr__(self, name, value):
+        if name in WorkerRun.__slots__:
+            object.__setattr__(self, name, value)
+        elif self.runtime.run is self:
+            setattr(self.runtime, name, value)
+
+    def get(self, key, default=None):
+        if key == 'running':
+            return self.live
+        if key in self.OWN:
+            value = getattr(self, key)
+            return default if value is None else value
+        return self.runtime.get(key, default)
+
+    def __getitem__(self, key):
+        value = self.get(key, _MISSING)
+        if value is _MISSING:
+            raise KeyError(key)
+        return value
+
+    def __contains__(self, key):
+        return self.get(key, _MISSING) is not _MISSING
+
+    def __setitem__(self, key, value):
+        if key == 'running' and not value:
+            self.live = False
+        if key in self.OWN:
+            setattr(self, key, value)
+        elif self.runtime.run is self:
+            self.runtime[key] = value
+
+    def pop(self, key, default=None):
+        if key in self.OWN:
+            value = self.get(key, default)
+            setattr(self, key, None)
+            return value
+        return self.runtime.pop(key, default) if self.runtime.run is self else default
+
+    def execute(self, fn, acc):
+        """Thân thread của worker đồng bộ — done báo cho lần start sau là run này đã thoát"""
+        try:
+            fn(acc, self)
+        finally:
+            self.done.set()
+
+    def stop(self):
+        self.live = False
+        self.stop_event.set()
+
+    def join(self, timeout):
+        return self.done.wait(timeout)
+
 app_state = {'hyperhub': {}, 'altare': {}, 'overnode': {}}
 
 def get_account_state(tool, email):
     if email not in app_state[tool]:
-        app_state[tool][email] = {
-            'running': False,
-            'balance': 0.0,
-            'stop_event': threading.Event(),
-        }
+        app_state[tool][email] = AccountRuntime(tool, email, running=False, balance=0.0)
     return app_state[tool][email]
 
+def drop_account_state(tool, email):
+    st = app_state[tool].pop(email, None)
+    if st is not None:
+        st.release()
+
+def runtime_totals():
+    """Số account đang chạy / đang kết nối, tổng balance và coins_per_min theo platform"""
+    out = {}
+    for tool, accounts in app_state.items():
+        states = list(accounts.values())
+        row    = {'accounts':  len(states),
+                  'running':   sum(1 for st in states if st.get('running')),
+                  'connected': sum(1 for st in states if st.get('connection') == 'connected')}
+        if state_columns is not None:
+            cols = state_columns[tool]
+            row['balance']       = round(cols.total('balance'), 4)
+            row['coins_per_min'] = round(cols.total('coins_per_min'), 4)
+        else:
+            row['balance']       = round(sum(st.get('balance') or 0.0 for st in states), 4)
+            row['coins_per_min'] = round(sum(st.get('coins_per_min') or 0.0 for st in states), 4)
+        out[tool] = row
+    return out
+
+def wait_stopped(state, secs):
+    """Ngủ tối đa secs giây, thức dậy ngay khi account bị dừng. True nếu vẫn còn chạy"""
+    return not state['stop_event'].wait(secs) and state['running']
+
                                                                                 
 HTML_TEMPLATE = r"""
 <!DOCTYPE html>
@@ -363,6 +1475,8 @@ HTML_TEMPLATE = r"""
     margin-top: 3px;
   }
   .acc-balance span { color: var(--accent-on); }
+  .acc-conn { font-style: normal; margin-left: 6px; }
+  .acc-conn.connected { color: var(--accent-on); }
 
   .acc-actions { display: flex; gap: 6px; flex-shrink: 0; }
   .btn-sm {
@@ -620,7 +1734,12 @@ HTML_TEMPLATE = r"""
     try {
       const res  = await fetch('/api/add_account', { method: 'POST', headers: {'Content-Type':'application/json'}, body: JSON.stringify(payload) });
       const data = await res.json();
-      if (data.success) {
+      if (data.success && data.queued) {
+        pendingJobs[data.job.id] = data.job.email;
+        toast('Login queued — progress is shown in the log');
+        if (currentTool === 'overnode') document.getElementById('cookie').value = '';
+        else { document.getElementById('email').value = ''; document.getElementById('password').value = ''; }
+      } else if (data.success) {
         toast('Account added successfully!');
         loadAccounts();
         if (currentTool === 'overnode') document.getElementById('cookie').value = '';
@@ -641,6 +1760,7 @@ HTML_TEMPLATE = r"""
       const accounts = await res.json();
       const listEl   = document.getElementById('account-list');
       listEl.innerHTML = '';
+      accVersions[currentTool] = {};
 
       if (!accounts || accounts.length === 0) {
         listEl.innerHTML = '<div class="empty-state">No accounts yet.</div>';
@@ -650,6 +1770,8 @@ HTML_TEMPLATE = r"""
       accounts.forEach((acc, idx) => {
         const item = document.createElement('div');
         item.className = `acc-item ${acc.running ? 'running' : 'paused'}`;
+        item.dataset.email = acc.email || '';
+        accVersions[currentTool][acc.email] = acc.version || 0;
 
         const name    = currentTool === 'overnode' ? (acc.email || 'Cookie Auth') : acc.email;
         const unit    = currentTool === 'hyperhub' ? 'XPL' : currentTool === 'altare' ? 'CR' : 'coins';
@@ -660,7 +1782,7 @@ HTML_TEMPLATE = r"""
         item.innerHTML = `
           <div class="acc-info">
             <div class="acc-email">${name}</div>
-            <div class="acc-balance">Balance: <span>${bal} ${unit}</span></div>
+            <div class="acc-balance">Balance: <span>${bal} ${unit}</span><em class="acc-conn ${acc.connection || ''}">${acc.connection || ''}</em></div>
           </div>
           <div class="acc-actions">
             <button class="btn-sm ${acc.running ? 'btn-pause' : 'btn-run'}"
@@ -680,8 +1802,7 @@ HTML_TEMPLATE = r"""
   async function toggleAccount(tool, email) {
     const res    = await fetch('/api/toggle', { method: 'POST', headers: {'Content-Type':'application/json'}, body: JSON.stringify({tool, email}) });
     const result = await res.json();
-    if (result.success) loadAccounts();
-    else toast('Toggle failed', true);
+    if (!result.success) toast('Toggle failed', true);
   }
 
   async function deleteAccount(tool, index, email) {
@@ -707,44 +1828,71 @@ HTML_TEMPLATE = r"""
 
   const liveBalances = {};
 
-  function extractBalanceFromLog(msg) {
-
-    const emailMatch = msg.match(/^\[([^\]]+)\]/);
-    if (!emailMatch) return;
-    const email = emailMatch[1];
-
-    let balance = null;
-
-    const incrMatch = msg.match(/increased:\s*[\d.]+\s*[→>]\s*([\d.]+)/i);
-    if (incrMatch) balance = parseFloat(incrMatch[1]);
-
-    if (balance === null) {
-      const balMatch = msg.match(/Balance:\s*([\d.]+)/i);
-      if (balMatch) balance = parseFloat(balMatch[1]);
+  // Job onboarding (altare login chạy nền) — kết quả đến qua log event='job'
+  const pendingJobs = {};
+
+  function applyJobEvent(log) {
+    if (log.event !== 'job' || !(log.job in pendingJobs)) return;
+    if (log.state === 'done') {
+      delete pendingJobs[log.job];
+      toast(`Account added: ${log.email}`);
+      loadAccounts();
+    } else if (log.state === 'failed') {
+      delete pendingJobs[log.job];
+      toast(log.detail || 'Login failed', true);
     }
+  }
 
-    if (balance === null) {
-      const curMatch = msg.match(/Current:\s*([\d.]+)/i);
-      if (curMatch) balance = parseFloat(curMatch[1]);
-    }
+  function applyLogBalance(log) {
+    if (!log.account || typeof log.balance !== 'number') return;
+    liveBalances[log.account] = log.balance;
+    updateBalanceDOM(log.account, log.balance);
+  }
 
-    if (balance !== null && !isNaN(balance)) {
-      liveBalances[email] = balance;
-      updateBalanceDOM(email, balance);
-    }
+  function findAccountItem(email) {
+    return Array.from(document.querySelectorAll('.acc-item')).find(item => item.dataset.email === email);
   }
 
   function updateBalanceDOM(email, balance) {
+    const item = findAccountItem(email);
+    const unit = currentTool === 'hyperhub' ? 'XPL' : currentTool === 'altare' ? 'CR' : 'coins';
+    const balEl = item && item.querySelector('.acc-balance span');
+    if (balEl) balEl.textContent = `${balance.toFixed(4)} ${unit}`;
+  }
 
-    const items = document.querySelectorAll('.acc-item');
-    const unit  = currentTool === 'hyperhub' ? 'XPL' : currentTool === 'altare' ? 'CR' : 'coins';
-    items.forEach(item => {
-      const emailEl = item.querySelector('.acc-email');
-      if (emailEl && emailEl.textContent.trim() === email) {
-        const balEl = item.querySelector('.acc-balance span');
-        if (balEl) balEl.textContent = `${balance.toFixed(4)} ${unit}`;
-      }
-    });
+  // Delta trạng thái từ SSE: chỉ sửa đúng phần tử đổi, bỏ qua delta cũ hơn version đang có
+  const accVersions = { hyperhub: {}, altare: {}, overnode: {} };
+  let _reloadTimer = null;
+
+  function reloadAccountsSoon() {
+    clearTimeout(_reloadTimer);
+    _reloadTimer = setTimeout(loadAccounts, 500);
+  }
+
+  function applyStatus(delta) {
+    if (delta.tool !== currentTool) return;
+    const item = findAccountItem(delta.account);
+    if (!item) { reloadAccountsSoon(); return; }
+    const known = accVersions[delta.tool][delta.account] || 0;
+    if (delta.version <= known) return;
+    accVersions[delta.tool][delta.account] = delta.version;
+
+    const c = delta.changes;
+    if ('running' in c) {
+      item.className = `acc-item ${c.running ? 'running' : 'paused'}`;
+      const btn = item.querySelector('.acc-actions .btn-sm');
+      btn.className   = `btn-sm ${c.running ? 'btn-pause' : 'btn-run'}`;
+      btn.textContent = c.running ? 'Pause' : 'Run';
+    }
+    if (typeof c.balance === 'number') {
+      liveBalances[delta.account] = c.balance;
+      updateBalanceDOM(delta.account, c.balance);
+    }
+    if ('connection' in c) {
+      const el = item.querySelector('.acc-conn');
+      el.className   = `acc-conn ${c.connection || ''}`;
+      el.textContent = c.connection || '';
+    }
   }
 
   const logBuffer = { hyperhub: [], altare: [], overnode: [] };
@@ -756,9 +1904,9 @@ HTML_TEMPLATE = r"""
     const ts  = new Date(log.timestamp * 1000).toLocaleTimeString('en-GB');
     const msg = log.message;
     let cls = '';
-    if (/error|lỗi|failed|exception/i.test(msg))      cls = 'err';
-    else if (/warn|stuck|conflict/i.test(msg))         cls = 'warn';
-    else if (/login|connect|start|success/i.test(msg)) cls = 'info';
+    if (log.level === 'error')                                  cls = 'err';
+    else if (log.level === 'warn')                              cls = 'warn';
+    else if (/^(login|connected|afk_start)$/.test(log.event))   cls = 'info';
     div.innerHTML = `<span class="log-ts">[${ts}]</span><span class="log-msg ${cls}">${msg}</span>`;
     term.appendChild(div);
     term.scrollTop = term.scrollHeight;
@@ -775,7 +1923,7 @@ HTML_TEMPLATE = r"""
         lastSeq[tool] = log.seq;
         logBuffer[tool].push(log);
         if (logBuffer[tool].length > MAX_BUFFER) logBuffer[tool].shift();
-        extractBalanceFromLog(log.message);
+        applyLogBalance(log);
       });
     } catch(e) {}
   }
@@ -787,12 +1935,14 @@ HTML_TEMPLATE = r"""
   }
 
   let _evtSource = null;
+  let _logCursor = '';
 
   function startSSE() {
     if (_evtSource) { _evtSource.close(); _evtSource = null; }
-    _evtSource = new EventSource('/api/stream_logs');
+    _evtSource = new EventSource('/api/stream_logs' + (_logCursor ? `?cursor=${encodeURIComponent(_logCursor)}` : ''));
 
     _evtSource.onmessage = function(e) {
+      if (e.lastEventId) _logCursor = e.lastEventId;
       if (!e.data || e.data.trim() === '') return;
       let log;
       try { log = JSON.parse(e.data); } catch { return; }
@@ -809,16 +1959,35 @@ HTML_TEMPLATE = r"""
       if (currentTool === tool) {
         renderLine(log, document.getElementById('terminal'));
       }
-      extractBalanceFromLog(log.message);
+      applyLogBalance(log);
+      applyJobEvent(log);
     };
 
+    _evtSource.addEventListener('lag', function(e) {
+      if (e.lastEventId) _logCursor = e.lastEventId;
+      let info;
+      try { info = JSON.parse(e.data); } catch { return; }
+      if (currentTool === info.tool) {
+        renderLine({ timestamp: Date.now() / 1000, message: `… ${info.skipped} log line(s) skipped (client lagging)` },
+                   document.getElementById('terminal'));
+      }
+    });
+
+    _evtSource.addEventListener('status', function(e) {
+      if (e.lastEventId) _logCursor = e.lastEventId;
+      try { applyStatus(JSON.parse(e.data)); } catch {}
+    });
+
+    _evtSource.addEventListener('resync', function(e) {
+      if (e.lastEventId) _logCursor = e.lastEventId;
+      loadAccounts();
+    });
+
     _evtSource.onerror = function() {
       if (_evtSource) { _evtSource.close(); _evtSource = null; }
-      setTimeout(startSSE, 3000);
+      setTimeout(() => { startSSE(); loadAccounts(); }, 3000);
     };
   }
-
-  setInterval(loadAccounts, 15000);
 </script>
 </body>
 </html>
@@ -829,20 +1998,214 @@ HTML_TEMPLATE = r"""
 def index():
     return render_template_string(HTML_TEMPLATE)
 
+def account_status(tool, email):
+    st = app_state[tool].get(email)
+    if st is None:
+        st = coordinator.remote_status(tool, email) if coordinator is not None else {}
+    return st
+
+def status_version(st):
+    return st.version if isinstance(st, AccountRuntime) else st.get('version', 0)
+
+ACCOUNT_SORTS = {
+    'email':       lambda email, st: email,
+    'balance':     lambda email, st: st.get('balance') or 0.0,
+    'last_reward': lambda email, st: st.get('last_reward') or 0.0,
+}
+MAX_PAGE = 500
+
+def encode_cursor(key):
+    return base64.urlsafe_b64encode(json.dumps(key).encode()).decode().rstrip('=')
+
+def decode_cursor(raw):
+    try:
+        key = json.loads(base64.urlsafe_b64decode(raw + '=' * (-len(raw) % 4)))
+    except (ValueError, TypeError):
+        return None
+    return key if isinstance(key, list) and len(key) == 2 else None
+
+def filter_accounts(tool, args):
+    """(email, status) của các account khớp bộ lọc, theo thứ tự trong registry"""
+    status = args.get('status')
+    errors = args.get('error')
+    q      = (args.get('q') or '').lower()
+    lo     = float(args['min_balance']) if args.get('min_balance') else None
+    hi     = float(args['max_balance']) if args.get('max_balance') else None
+    rows = []
+    for email in registry.emails(tool):
+        if q and q not in email.lower():
+            continue
+        st = account_status(tool, email)
+        if status == 'running' and not st.get('running') or status == 'paused' and st.get('running'):
+            continue
+        if errors == '1' and not st.get('error') or errors == '0' and st.get('error'):
+            continue
+        balance = st.get('balance') or 0.0
+        if lo is not None and balance < lo or hi is not None and balance > hi:
+            continue
+        rows.append((email, st))
+    return rows
+
 @app.route('/api/get_accounts')
 def get_accounts():
+    """
+    Không có limit → mảng toàn bộ account (đã lọc) như cũ. ?limit=&cursor= phân trang keyset,
+    lọc ?status=running|paused ?min_balance= ?max_balance= ?error=1|0 ?q=, sắp xếp
+    ?sort=email|balance|last_reward (thêm '-' để giảm dần). ETag theo version → 304.
+    """
     tool = request.args.get('tool')
     if tool not in FILES:
         return jsonify([])
-    accounts = read_data(tool)
-    for acc in accounts:
-        email = acc.get('email', '')
-        st    = app_state[tool].get(email, {})
-        acc['running'] = st.get('running', False)
-        acc['balance'] = st.get('balance', 0.0)
+    args  = request.args
+    paged = 'limit' in args
+    sort  = args.get('sort') or ('email' if paged else '')
+    desc  = sort.startswith('-')
+    field = sort.lstrip('-')
+    if sort and field not in ACCOUNT_SORTS:   # kể cả '-' trơn: field rỗng sẽ không có keys để phân trang
+        return jsonify({'success': False, 'message': 'Invalid sort'}), 400
+    try:
+        limit = min(max(int(args.get('limit') or MAX_PAGE), 1), MAX_PAGE)
+        rows  = filter_accounts(tool, args)
+    except ValueError:
+        return jsonify({'success': False, 'message': 'Invalid filter'}), 400
+
+    total = len(rows)
+    if field:
+        keyfn = ACCOUNT_SORTS[field]
+        keyed = sorted(((keyfn(email, st), email), email, st) for email, st in rows)
+        if desc:
+            keyed.reverse()
+        after = decode_cursor(args['cursor']) if args.get('cursor') else None
+        if args.get('cursor') and after is None:
+            return jsonify({'success': False, 'message': 'Invalid cursor'}), 400
+        if after is not None:
+            after = tuple(after)
+            try:
+                keyed = [r for r in keyed if (r[0] < after if desc else r[0] > after)]
+            except TypeError:
+                return jsonify({'success': False, 'message': 'Invalid cursor'}), 400
+        rows = [(email, st) for _, email, st in keyed]
+        keys = [k for k, _, _ in keyed]
+    next_cursor = None
+    if paged:
+        if len(rows) > limit:
+            next_cursor = encode_cursor(list(keys[limit - 1]))
+        rows = rows[:limit]
+
+    etag = hashlib.md5(repr((tool, sorted(args.items(multi=True)), registry.generation[tool], next_cursor,
+                             [(email, status_version(st)) for email, st in rows])).encode()).hexdigest()
+    if etag in request.if_none_match:
+        return '', 304, {'ETag': f'"{etag}"'}
+
+    accounts = []
+    for email, st in rows:
+        acc = registry.get(tool, email)
+        if acc is None:
+            continue
+        acc['running']     = st.get('running', False)
+        acc['balance']     = st.get('balance', 0.0)
+        acc['connection']  = st.get('connection')
+        acc['error']       = st.get('error')
+        acc['last_reward'] = st.get('last_reward')
+        acc['version']     = status_version(st)
         acc.pop('password', None)
         acc.pop('cookie', None)
-    return jsonify(accounts)
+        accounts.append(acc)
+    resp = jsonify({'accounts': accounts, 'total': total, 'next_cursor': next_cursor} if paged else accounts)
+    resp.set_etag(etag)
+    resp.headers['Cache-Control'] = 'no-cache'
+    return resp
+
+def prepare_account(tool, data):
+    """
+    Kiểm tra + đăng nhập (altare) để dựng record account từ input của user.
+    Trả về (account, None, False) hoặc (None, lý do lỗi, lỗi có tạm thời không — mạng,
+    5xx, 429 — để hàng đợi onboarding quyết định thử lại). Không ghi gì vào registry.
+    """
+    email = data.get('email', '')
+
+    if tool == 'overnode':
+        return {'email': email, 'cookie': data.get('cookie')}, None, False
+
+    if tool != 'altare':
+        return {'email': email, 'password': data.get('password', '')}, None, False
+
+    password = data.get('password', '')
+    try:
+        http          = http_pool('altare')
+        token, status = altare_login(email, password)
+        if status != 200:
+            return None, f'Login failed: HTTP {status}', transient_status(status)
+        if not token:
+            return None, 'No token returned', False
+
+        t_r = http.get(
+            f'{ALTARE_API}/api/tenants',
+            headers={'Authorization': token, 'Accept': 'application/json',
+                     'Origin': ALTARE_WEB},
+            timeout=10,
+        )
+        if transient_status(t_r.status_code):
+            return None, f'Tenant lookup failed: HTTP {t_r.status_code}', True
+        tenant_id = ''
+        if t_r.status_code == 200 and t_r.json().get('items'):
+            tenant_id = t_r.json()['items'][0].get('id', '')
+
+        if not tenant_id:
+            return None, 'No tenant ID found for this account', False
+
+        return {
+            'email':     email,
+            'password':  password,
+            'token':     token,
+            'tenant_id': tenant_id,
+        }, None, False
+    except Exception as e:
+        return None, f'Login error: {e}', True
+
+def transient_status(code):
+    return code == 429 or code >= 500
+
+def forget_account(tool, email):
+    """Dừng worker và dọn state của account vừa bị xoá khỏi registry"""
+    rampup.cancel(tool, email)
+    stop_worker_thread(tool, email, forget=True)
+    drop_account_state(tool, email)
+    if coordinator is not None:
+        coordinator.release(tool, email)
+
+def set_running(tool, email, running):
+    """Bật/tắt một account, kể cả khi account đang chạy ở process khác. True nếu có thay đổi"""
+    st = app_state[tool].get(email)
+    if not running and rampup.cancel(tool, email):
+        registry.update(tool, email, {'paused': True})
+        return True
+    if st is None and coordinator is not None:
+        if bool(coordinator.remote_status(tool, email).get('running')) == running:
+            return False
+        if coordinator.send(tool, email, 'toggle'):
+            return True
+        if not running:
+            return False
+        # không process nào giữ lease (account pause không được node nào nhận) → process này nhận
+    if running:
+        if st is not None and st['running']:
+            return False
+        acc = registry.get(tool, email)
+        if not acc:
+            return False
+        rampup.cancel(tool, email)
+        add_log(tool, 'AFK resumed by user.', account=email, event='resumed')
+        if acc.get('paused'):
+            registry.update(tool, email, {'paused': False})
+        start_worker_thread(tool, acc)
+        return True
+    if st is None or not st['running']:
+        return False
+    stop_worker_thread(tool, email)
+    registry.update(tool, email, {'paused': True})
+    add_log(tool, 'AFK paused by user.', account=email, event='paused')
+    return True
 
 @app.route('/api/add_account', methods=['POST'])
 def add_account():
@@ -851,67 +2214,23 @@ def add_account():
     if tool not in FILES:
         return jsonify({'success': False, 'message': 'Invalid tool'})
 
-    accounts = read_data(tool)
-    email    = data.get('email', '')
+    email = data.get('email', '')
 
                     
-    if any(a.get('email') == email for a in accounts):
+    if registry.get(tool, email) is not None:
         return jsonify({'success': False, 'message': 'Account already exists'})
 
-    if tool == 'overnode':
-        new_acc = {'email': email, 'cookie': data.get('cookie')}
-
-    elif tool == 'altare':
-                                                                       
-        password = data.get('password', '')
-        try:
-            login_r = requests.post(
-                'https://api.altare.sh/api/auth/login',
-                headers={
-                    'Content-Type': 'application/json',
-                    'Accept':       'application/json',
-                    'Origin':       'https://altare.sh',
-                    'User-Agent':   'Mozilla/5.0 (Windows NT 10.0; Win64; x64)',
-                },
-                json={'identifier': email, 'password': password},
-                timeout=15,
-            )
-            if login_r.status_code != 200:
-                return jsonify({'success': False, 'message': f'Login failed: HTTP {login_r.status_code}'})
-
-            token = f"Bearer {login_r.json().get('token', '')}"
-            if not token or token == 'Bearer ':
-                return jsonify({'success': False, 'message': 'No token returned'})
-
-                           
-            t_r = requests.get(
-                'https://api.altare.sh/api/tenants',
-                headers={'Authorization': token, 'Accept': 'application/json',
-                         'Origin': 'https://altare.sh'},
-                timeout=10,
-            )
-            tenant_id = ''
-            if t_r.status_code == 200 and t_r.json().get('items'):
-                tenant_id = t_r.json()['items'][0].get('id', '')
-
-            if not tenant_id:
-                return jsonify({'success': False, 'message': 'No tenant ID found for this account'})
-
-            new_acc = {
-                'email':     email,
-                'password':  password,
-                'token':     token,
-                'tenant_id': tenant_id,
-            }
-        except Exception as e:
-            return jsonify({'success': False, 'message': f'Login error: {e}'})
+    if tool == 'altare':
+        job = onboarding.submit(tool, data)
+        return jsonify({'success': True, 'queued': True, 'job': job.as_dict()}), 202
 
-    else:
-        new_acc = {'email': email, 'password': data.get('password', '')}
+    new_acc, error, _ = prepare_account(tool, data)
+    if error:
+        return jsonify({'success': False, 'message': error})
 
-    accounts.append(new_acc)
-    write_data(tool, accounts)
-    add_log(tool, f"Account added: {email}")
+    if not registry.insert(tool, new_acc):
+        return jsonify({'success': False, 'message': 'Account already exists'})
+    add_log(tool, 'Account added: {email}', event='account_added', email=email)
     start_worker_thread(tool, new_acc)
     return jsonify({'success': True})
 
@@ -922,17 +2241,15 @@ def delete_account():
     idx   = data.get('index')
     email = data.get('email')
     try:
-        if tool in FILES and isinstance(idx, int):
-            accounts = read_data(tool)
+        if tool in FILES and email is None and isinstance(idx, int):
+            accounts = registry.list(tool)
             if 0 <= idx < len(accounts):
-                del_email = accounts[idx].get('email', email)
-                stop_worker_thread(tool, del_email)
-                app_state[tool].pop(del_email, None)
-                accounts.pop(idx)
-                write_data(tool, accounts)
-                add_log(tool, f"Account deleted: {del_email}")
-                return jsonify({'success': True})
-        return jsonify({'success': False, 'message': 'Index out of bounds'})
+                email = accounts[idx].get('email')
+        if tool in FILES and email is not None and registry.delete(tool, email):
+            forget_account(tool, email)
+            add_log(tool, 'Account deleted: {email}', event='account_deleted', email=email)
+            return jsonify({'success': True})
+        return jsonify({'success': False, 'message': 'Account not found'})
     except Exception as e:
         return jsonify({'success': False, 'message': str(e)})
 
@@ -941,62 +2258,382 @@ def toggle_account():
     data  = request.json
     tool  = data.get('tool')
     email = data.get('email')
-    if tool not in app_state or email not in app_state[tool]:
+    if tool not in app_state:
         return jsonify({'success': False})
-    st = app_state[tool][email]
-    if st['running']:
-        st['running'] = False
-        st['stop_event'].set()
-        add_log(tool, f"[{email}] AFK paused by user.")
-    else:
-        st['running'] = True
-        st['stop_event'].clear()
-        add_log(tool, f"[{email}] AFK resumed by user.")
-        acc = next((a for a in read_data(tool) if a.get('email') == email), None)
-        if acc:
-            start_worker_thread(tool, acc)
+    st      = app_state[tool].get(email)
+    pending = rampup.is_pending(tool, email)
+    if coordinator is not None and st is None and not pending:
+        return jsonify({'success': coordinator.send(tool, email, 'toggle')})
+    if st is None and not pending:
+        return jsonify({'success': False})
+    set_running(tool, email, not (pending or st['running']))
     return jsonify({'success': True})
 
-@app.route('/api/logs')
-def get_logs():
-    """Fallback HTTP endpoint — dùng khi SSE không available"""
-    tool       = request.args.get('tool', 'hyperhub')
-    after_seq  = int(request.args.get('after', -1))
-    if tool not in app_logs:
-        return jsonify({'logs': [], 'last_seq': 0})
-    with _log_lock:
-        entries  = [e for e in app_logs[tool] if e['seq'] > after_seq]
-        next_seq = _log_seq[tool] - 1
-    return jsonify({'logs': entries, 'last_seq': next_seq})
+                                                                                
+ONBOARD_CONCURRENCY = int(os.environ.get('AFK_ONBOARD_CONCURRENCY', 4))
+ONBOARD_RETRIES     = int(os.environ.get('AFK_ONBOARD_RETRIES', 3))
+ONBOARD_BACKOFF     = float(os.environ.get('AFK_ONBOARD_BACKOFF', 2))
+JOB_TTL             = 3600
+
+class OnboardJob:
+    __slots__ = ('id', 'tool', 'email', 'data', 'state', 'attempts', 'detail', 'created', 'updated')
+
+    def __init__(self, tool, data):
+        self.id       = uuid.uuid4().hex
+        self.tool     = tool
+        self.email    = data.get('email', '')
+        self.data     = data
+        self.state    = 'queued'
+        self.attempts = 0
+        self.detail   = None
+        self.created  = self.updated = time.time()
+
+    def as_dict(self):
+        return {'id': self.id, 'tool': self.tool, 'email': self.email, 'state': self.state,
+                'attempts': self.attempts, 'detail': self.detail, 'created': self.created, 'updated': self.updated}
+
+class OnboardQueue:
+    """
+    Onboarding chạy nền: login + tenant lookup không chiếm request handler nữa.
+    Tối đa `concurrency` job chạy cùng lúc; lỗi tạm thời được thử lại sau
+    backoff * 2^(n-1) giây (±20% jitter) qua scheduler. Mỗi lần đổi trạng thái job
+    là một log event='job' nên SSE thấy tiến độ ở mọi process.
+    """
 
-@app.route('/api/stream_logs')
-def stream_logs():
-    """SSE endpoint — server push, không polling"""
+    def __init__(self, concurrency, retries, backoff):
+        self.retries = retries
+        self.backoff = backoff
+        self._pool   = ThreadPoolExecutor(max_workers=max(concurrency, 1), thread_name_prefix='afk-onboard')
+        self._lock   = threading.Lock()
+        self._jobs   = {}
+        self._active = {}
+
+    def submit(self, tool, data):
+        with self._lock:
+            job_id = self._active.get((tool, data.get('email', '')))
+            if job_id is not None:
+                return self._jobs[job_id]
+            job = OnboardJob(tool, data)
+            self._jobs[job.id] = job
+            self._active[(tool, job.email)] = job.id
+            self._prune()
+        self._update(job, 'queued')
+        self._pool.submit(self._run, job)
+        return job
+
+    def get(self, job_id):
+        job = self._jobs.get(job_id)
+        if job is not None:
+            return job.as_dict()
+        return coordinator.get_job(job_id) if coordinator is not None else None
+
+    def _run(self, job):
+        job.attempts += 1
+        try:
+            self._update(job, 'running')
+            acc, error, transient = prepare_account(job.tool, job.data)
+            if error is None:
+                if registry.insert(job.tool, acc):
+                    add_log(job.tool, 'Account added: {email}', event='account_added', email=job.email)
+                    start_worker_thread(job.tool, acc)
+                    self._finish(job, 'done')
+                else:
+                    self._finish(job, 'failed', 'Account already exists')
+            elif transient and job.attempts <= self.retries:
+                delay = self.backoff * 2 ** (job.attempts - 1) * random.uniform(0.8, 1.2)
+                self._update(job, 'retrying', f'{error} — retry in {delay:.0f}s')
+                scheduler.call_later(delay, lambda: self._pool.submit(self._run, job), name=f'onboard.retry:{job.id}')
+            else:
+                self._finish(job, 'failed', error)
+        except Exception as e:
+            # Không để job kẹt ở 'running' và giữ chỗ trong _active mãi
+            self._finish(job, 'failed', str(e) or type(e).__name__)
+
+    def _finish(self, job, state, detail=None):
+        job.data = None
+        with self._lock:
+            self._active.pop((job.tool, job.email), None)
+        self._update(job, state, detail)
+
+    def _update(self, job, state, detail=None):
+        job.state, job.detail, job.updated = state, detail, time.time()
+        add_log(job.tool, 'Onboarding {email}: {state}' + (' — {detail}' if detail else ''),
+                level=ERROR if state == 'failed' else INFO, event='job', job=job.id, email=job.email,
+                state=state, attempt=job.attempts, detail=detail)
+        if coordinator is not None:
+            coordinator.put_job(job.as_dict())
+
+    def _prune(self):
+        cutoff = time.time() - JOB_TTL
+        for job_id, job in list(self._jobs.items()):
+            if job.updated < cutoff and job.state in ('done', 'failed'):
+                del self._jobs[job_id]
+
+onboarding = OnboardQueue(ONBOARD_CONCURRENCY, ONBOARD_RETRIES, ONBOARD_BACKOFF)
+
+@app.route('/api/jobs/<job_id>')
+def get_job(job_id):
+    job = onboarding.get(job_id)
+    if job is None:
+        return jsonify({'success': False, 'message': 'Job not found'}), 404
+    return jsonify({'success': True, 'job': job})
+
+IMPORT_CONCURRENCY = int(os.environ.get('AFK_IMPORT_CONCURRENCY', 8))
+IMPORT_FIELDS      = ('email', 'password', 'cookie')
+SECRET_FIELDS      = ('password', 'cookie', 'token')
+
+def parse_import(body, fmt):
+    """CSV (header email,password,cookie) hoặc JSONL → list dict; dòng hỏng thành {'_error': ...}"""
+    rows = []
+    if fmt == 'csv':
+        for row in csv.DictReader(io.StringIO(body)):
+            rows.append({k: row[k].strip() for k in IMPORT_FIELDS if row.get(k)})
+        return rows
+    for n, line in enumerate(body.splitlines(), 1):
+        if not line.strip():
+            continue
+        try:
+            row = json.loads(line)
+        except ValueError:
+            rows.append({'_error': f'line {n}: invalid JSON'})
+            continue
+        if not isinstance(row, dict):
+            rows.append({'_error': f'line {n}: expected an object'})
+            continue
+        rows.append({k: str(row[k]).strip() for k in IMPORT_FIELDS if row.get(k)})
+    return rows
+
+@app.route('/api/import', methods=['POST'])
+def import_accounts():
+    """
+    Nhập hàng loạt: body là CSV hoặc JSONL (?format=csv|jsonl, mặc định theo Content-Type).
+    Đăng nhập song song tối đa AFK_IMPORT_CONCURRENCY account, trả về NDJSON tiến độ
+    từng dòng; các account hợp lệ được thêm vào registry một lần ở cuối.
+    """
     from flask import Response
-                                                                             
-    tool = request.args.get('tool', '')
-
-    def event_stream(tool):
-        q = _queue.Queue(maxsize=200)
-        with _client_queues_lock:
-            _client_queues.append(q)
-                                                                  
-                                                
+    tool = request.args.get('tool')
+    if tool not in FILES:
+        return jsonify({'success': False, 'message': 'Invalid tool'}), 400
+    fmt  = request.args.get('format') or ('csv' if 'csv' in (request.content_type or '') else 'jsonl')
+    rows = parse_import(request.get_data(as_text=True), fmt)
+
+    def progress():
+        seen, accepted, failed = set(), [], 0
+        pool    = ThreadPoolExecutor(max_workers=max(IMPORT_CONCURRENCY, 1), thread_name_prefix='afk-import')
+        pending = {}
+        try:
+            for i, row in enumerate(rows):
+                email = row.get('email', '')
+                if '_error' in row or not email or (tool == 'overnode' and not row.get('cookie')):
+                    error = row.get('_error') or ('missing email' if not email else 'missing cookie')
+                elif email in seen or registry.get(tool, email) is not None:
+                    error = 'Account already exists'
+                else:
+                    seen.add(email)
+                    pending[pool.submit(prepare_account, tool, row)] = (i, email)
+                    continue
+                failed += 1
+                yield json.dumps({'index': i, 'email': email, 'success': False, 'message': error}) + '\n'
+            for future in as_completed(list(pending)):
+                i, email   = pending.pop(future)
+                acc, error, _ = future.result()
+                if error:
+                    failed += 1
+                else:
+                    accepted.append(acc)
+                yield json.dumps({'index': i, 'email': email, 'success': not error, 'message': error}) + '\n'
+        finally:
+            pool.shutdown(wait=False, cancel_futures=True)
+            added = registry.insert_many(tool, accepted)
+            for acc in added:
+                add_log(tool, 'Account added: {email}', event='account_added', email=acc['email'])
+                start_worker_thread(tool, acc)
+        yield json.dumps({'done': True, 'added': len(added), 'failed': failed + len(accepted) - len(added)}) + '\n'
+
+    return Response(progress(), mimetype='application/x-ndjson', headers={'X-Accel-Buffering': 'no'})
+
+@app.route('/api/export')
+def export_accounts():
+    """
+    Xuất account (cùng bộ lọc với /api/get_accounts) dạng JSONL hoặc CSV. API không có xác thực
+    nên không bao giờ kèm password/cookie/token — giống get_accounts.
+    """
+    from flask import Response
+    tool = request.args.get('tool')
+    fmt  = request.args.get('format', 'jsonl')
+    if tool not in FILES or fmt not in ('jsonl', 'csv'):
+        return jsonify({'success': False, 'message': 'Invalid tool or format'}), 400
+    try:
+        rows = filter_accounts(tool, request.args)
+    except ValueError:
+        return jsonify({'success': False, 'message': 'Invalid filter'}), 400
+    accounts = []
+    for email, _ in rows:
+        acc = registry.get(tool, email)
+        if acc is not None:
+            for k in SECRET_FIELDS:
+                acc.pop(k, None)
+            accounts.append(acc)
+
+    if fmt == 'csv':
+        out    = io.StringIO()
+        fields = sorted({k for acc in accounts for k in acc}, key=lambda k: (k != 'email', k))
+        writer = csv.DictWriter(out, fieldnames=fields or ['email'])
+        writer.writeheader()
+        writer.writerows(accounts)
+        body, mimetype = out.getvalue(), 'text/csv'
+    else:
+        body, mimetype = ''.join(json.dumps(acc) + '\n' for acc in accounts), 'application/x-ndjson'
+    return Response(body, mimetype=mimetype,
+                    headers={'Content-Disposition': f'attachment; filename={tool}-accounts.{fmt}'})
+
+@app.route('/api/batch', methods=['POST'])
+def batch_accounts():
+    """
+    {tool, action: start|stop|delete, emails: [...]} hoặc {tool, action, filter: {...}}
+    (filter giống query của /api/get_accounts; filter rỗng phải kèm "all": true).
+    """
+    data   = request.json or {}
+    tool   = data.get('tool')
+    action = data.get('action')
+    if tool not in FILES or action not in ('start', 'stop', 'delete'):
+        return jsonify({'success': False, 'message': 'Invalid tool or action'}), 400
+    if data.get('emails') is not None:
+        if not isinstance(data['emails'], list) or not all(isinstance(e, str) for e in data['emails']):
+            return jsonify({'success': False, 'message': 'emails must be a list of strings'}), 400
+        known  = set(registry.emails(tool))
+        emails = [e for e in data['emails'] if e in known]
+    else:
+        filters = {k: str(v) for k, v in (data.get('filter') or {}).items()}
+        if not filters and not data.get('all'):
+            return jsonify({'success': False, 'message': 'Empty filter — pass "all": true to target every account'}), 400
+        try:
+            emails = [email for email, _ in filter_accounts(tool, filters)]
+        except ValueError:
+            return jsonify({'success': False, 'message': 'Invalid filter'}), 400
+
+    if action == 'delete':
+        affected = registry.delete_many(tool, emails)
+        for email in affected:
+            forget_account(tool, email)
+        if affected:
+            add_log(tool, 'Batch deleted {count} account(s)', event='account_deleted', count=len(affected))
+        return jsonify({'success': True, 'affected': len(affected)})
+
+    affected = sum(1 for email in emails if set_running(tool, email, action == 'start'))
+    return jsonify({'success': True, 'affected': affected})
+
+@app.route('/api/logs')
+def get_logs():
+    """Fallback HTTP endpoint — dùng khi SSE không available"""
+    tool       = request.args.get('tool', 'hyperhub')
+    after_seq  = int(request.args.get('after', -1))
+    if tool not in app_logs:
+        return jsonify({'logs': [], 'last_seq': 0})
+    with _log_lock:
+        _, entries = app_logs[tool].read(after_seq + 1)
+        next_seq   = app_logs[tool].next_seq - 1
+    return jsonify({'logs': [e.as_dict() for e in entries], 'last_seq': next_seq})
+
+def parse_log_cursor(raw, tools):
+    """
+    'hyperhub:12,altare:5,status:40' → {tool: seq kế tiếp}; tool thiếu thì bắt đầu từ log
+    mới nhất. 'status' là cursor của status_feed.
+    """
+    cursors = {}
+    for part in (raw or '').split(','):
+        tool, _, seq = part.partition(':')
+        if (tool in tools or tool == 'status') and seq.lstrip('-').isdigit():
+            cursors[tool] = int(seq)
+    with _log_lock:
+        for tool in tools:
+            cursors.setdefault(tool, app_logs[tool].next_seq)
+        cursors.setdefault('status', status_feed.next_seq)
+    return cursors
+
+def coalesce_status(deltas, tools, account=None):
+    """Gộp các delta của cùng một account thành một event, version lấy bản mới nhất"""
+    merged = {}
+    for d in deltas:
+        if d.tool not in tools or (account is not None and d.account != account):
+            continue
+        m = merged.get((d.tool, d.account))
+        if m is None:
+            m = merged[(d.tool, d.account)] = {'tool': d.tool, 'account': d.account, 'changes': {}}
+        m['version'] = d.version
+        m['changes'].update(d.changes)
+    return list(merged.values())
+
+@app.route('/api/stream_logs')
+def stream_logs():
+    """
+    SSE endpoint — server push, không polling.
+    ?tool=hyperhub,altare lọc theo tool, ?account=email lọc theo account,
+    resume bằng Last-Event-ID (hoặc ?cursor=) để không mất log khi reconnect.
+    Thay đổi trạng thái account đi kèm dưới dạng `event: status` (chỉ field đã đổi);
+    `event: resync` nghĩa là cursor đã quá cũ, client cần tải lại danh sách.
+    """
+    from flask import Response
+    tools   = [t for t in request.args.get('tool', '').split(',') if t in app_logs] or list(app_logs)
+    account = request.args.get('account') or None
+    cursors = parse_log_cursor(request.headers.get('Last-Event-ID') or request.args.get('cursor'), tools)
+
+    def event_stream():
+        # Event riêng của client này, chỉ bị set bởi log/status của các tool nó xem
+        wakeup = threading.Event()
+        with _log_lock:
+            _log_subscribers[0] += 1
+            for t in tools:
+                _log_watchers[t].add(wakeup)
         try:
             while True:
-                try:
-                    data = q.get(timeout=25)
-                    yield f"data: {data}\n\n"
-                except _queue.Empty:
-                    yield f": ping\n\n"             
+                batch = []
+                with _log_lock:
+                    idle = (status_feed.next_seq <= cursors['status']
+                            and all(app_logs[t].next_seq <= cursors[t] for t in tools))
+                    if idle:
+                        wakeup.clear()
+                if idle:
+                    wakeup.wait(25)
+                with _log_lock:
+                    for t in tools:
+                        skipped, entries = app_logs[t].read(cursors[t])
+                        cursors[t] = app_logs[t].next_seq
+                        if skipped or entries:
+                            batch.append((t, skipped, entries))
+                    lost, deltas = status_feed.read(cursors['status'])
+                    cursors['status'] = status_feed.next_seq
+                if not batch and not lost and not deltas:
+                    yield ": ping\n\n"
+                    continue
+                out = []
+                if lost:
+                    STATUS_RESYNCS.inc()
+                    out.append(f"event: resync\ndata: {json.dumps({'skipped': lost})}\n")
+                for change in coalesce_status(deltas, tools, account):
+                    out.append(f"event: status\ndata: {json.dumps(change)}\n")
+                for t, skipped, entries in batch:
+                    if skipped:
+                        LOG_DROPS.inc(t, value=skipped)
+                        out.append(f"event: lag\ndata: {json.dumps({'tool': t, 'skipped': skipped})}\n")
+                    for e in entries:
+                        if account is None or e.account == account:
+                            out.append(f"data: {e.json()}\n")
+                cursor_id = ','.join(f'{t}:{cursors[t]}' for t in (*tools, 'status'))
+                if out:
+                    out[-1] += f"id: {cursor_id}\n"
+                else:
+                    out.append(f"id: {cursor_id}\n")
+                yield '\n'.join(out) + '\n'
         except GeneratorExit:
             pass
         finally:
-            with _client_queues_lock:
-                if q in _client_queues:
-                    _client_queues.remove(q)
+            with _log_lock:
+                _log_subscribers[0] -= 1
+                for t in tools:
+                    _log_watchers[t].discard(wakeup)
     return Response(
-        event_stream(tool),
+        event_stream(),
         mimetype='text/event-stream',
         headers={
             'Cache-Control':     'no-cache',
@@ -1005,13 +2642,70 @@ def stream_logs():
         }
     )
 
+@app.route('/api/pool_stats')
+def pool_stats():
+    out = {tool: adapter.snapshot() for tool, adapter in HTTP_ADAPTERS.items()}
+    out.update({f'{tool}:stream': adapter.snapshot() for tool, adapter in STREAM_ADAPTERS.items()})
+    return jsonify(out)
+
+@app.route('/api/rampup')
+def rampup_progress():
+    return jsonify({'pending': rampup.pending(), 'tools': rampup.progress()})
+
+@app.route('/api/reconnects')
+def reconnect_metrics():
+    return jsonify(reconnect_stats())
+
+def _account_gauge():
+    out = {}
+    for tool, accounts in app_state.items():
+        for st in list(accounts.values()):
+            if st.get('running'):
+                out[(tool, 'running')] = out.get((tool, 'running'), 0) + 1
+            if st.get('connection') == 'connected':
+                out[(tool, 'connected')] = out.get((tool, 'connected'), 0) + 1
+    return out
+
+Gauge('afk_threads', 'Live Python threads', threading.active_count)
+Gauge('afk_accounts', 'Accounts by platform and state', _account_gauge, ('platform', 'state'), per_process=False)
+Gauge('afk_ws_sockets', 'Sockets held by the WebSocket reactor',
+      lambda: _reactor.stats()['sockets'] if _reactor is not None else 0)
+Gauge('afk_sse_subscribers', 'Dashboard SSE subscribers', lambda: _log_subscribers[0], per_process=False)
+Gauge('afk_scheduler_jobs', 'Pending scheduler jobs', scheduler.pending)
+Gauge('afk_http_in_flight', 'Upstream HTTP requests in flight',
+      lambda: {(tool, ): a.stats.in_flight + (STREAM_ADAPTERS[tool].stats.in_flight if tool in STREAM_ADAPTERS else 0)
+               for tool, a in HTTP_ADAPTERS.items()}, ('platform',))
+
+@app.route('/metrics')
+def metrics():
+    from flask import Response
+    return Response(render_metrics(), mimetype='text/plain; version=0.0.4')
+
+@app.route('/api/balances')
+def balance_stats():
+    return jsonify(dict(balance_reconciler.stats(), altare=altare_balances.stats()))
+
+@app.route('/api/totals')
+def account_totals():
+    return jsonify(runtime_totals())
+
+@app.route('/api/reactor')
+def reactor_stats():
+    return jsonify(_reactor.stats() if _reactor is not None else {'sockets': 0, 'reactors': []})
+
+@app.route('/api/shards')
+def shard_stats():
+    if supervisor is None:
+        return jsonify({'mode': AFK_MODE or 'single', 'shards': {}})
+    return jsonify({'mode': 'supervisor', 'shards': supervisor.stats()})
+
 @app.route('/api/add_log', methods=['POST'])
 def handle_add_log():
     data = request.json
     tool = data.get('tool')
     msg  = data.get('message', '')
     if msg and tool:
-        add_log(tool, f"[WebUI] {msg}")
+        add_log(tool, '[WebUI] {text}', event='webui', text=msg)
     return jsonify({'success': True})
 
                                                                                 
@@ -1022,22 +2716,540 @@ def start_worker_thread(tool, acc):
     st = get_account_state(tool, email)
     if st['running']:
         return
-    st['stop_event'].clear()
-    st['running'] = True
+    if coordinator is not None and not coordinator.acquire(tool, email):
+        return
+    if supervisor is not None:
+        st['running'] = True
+        supervisor.start(tool, acc)
+        return
     targets = {'hyperhub': hyperhub_worker, 'altare': altare_worker, 'overnode': overnode_worker}
     if tool not in targets:
         return
-    t = threading.Thread(target=targets[tool], args=(acc, st), daemon=True)
-    st['thread'] = t
+    old = st.run
+    if old is not None:
+        # pause → resume nhanh: chờ run cũ thoát hẳn rồi mới mở kết nối mới
+        old.stop()
+        if not old.join(WORKER_JOIN_TIMEOUT):
+            add_log(tool, 'Previous worker still stopping after {timeout}s — starting anyway', account=email,
+                    level=WARNING, event='worker_overlap', timeout=WORKER_JOIN_TIMEOUT)
+    run = st.run = WorkerRun(st)
+    st['running'] = True
+    if AFK_ENGINE == 'reactor' and tool in REACTOR_WORKERS:
+        REACTOR_WORKERS[tool](acc, run, get_reactor())
+        run.done.set()   # chỉ còn callback trên reactor, đã bị chặn bởi stop_event của run
+        return
+    engine = get_engine()
+    if engine is not None:
+        engine.start(tool, acc, run)
+        return
+    t = threading.Thread(target=run.execute, args=(targets[tool], acc), daemon=True)
+    run.thread = t
     t.start()
 
-def stop_worker_thread(tool, email):
+def stop_worker_thread(tool, email, forget=False):
+    if supervisor is not None:
+        supervisor.stop(tool, email, forget)
     if tool in app_state and email in app_state[tool]:
         st = app_state[tool][email]
         st['running'] = False
-        st['stop_event'].set()
+        if st.run is not None:
+            st.run.stop()
+
+                                                                                
+def ws_url(url):
+    return 'ws' + url[len('http'):] if url.startswith('http') else url
+
+# AFK_*_URL trỏ worker sang server khác, vd. bench/mock_platform.py khi load test
+ALTARE_API    = os.environ.get('AFK_ALTARE_API', 'https://api.altare.sh').rstrip('/')
+ALTARE_WEB    = os.environ.get('AFK_ALTARE_WEB', 'https://altare.sh').rstrip('/')
+HYPERHUB_URL  = os.environ.get('AFK_HYPERHUB_URL', 'https://hyper-hub.nl').rstrip('/')
+HYPERHUB_WS   = ws_url(HYPERHUB_URL) + '/ws'
+HYPERHUB_HOST = HYPERHUB_URL.split('://', 1)[-1]
+HYPERHUB_UA  = ('Mozilla/5.0 (Windows NT 10.0; Win64; x64) '
+                'AppleWebKit/537.36 (KHTML, like Gecko) '
+                'Chrome/120.0.0.0 Safari/537.36')
+OVERNODE_URL  = os.environ.get('AFK_OVERNODE_URL', 'https://console.overnode.fr').rstrip('/')
+OVERNODE_WS   = ws_url(OVERNODE_URL) + '/api/afk/ws'
+OVERNODE_HOST = OVERNODE_URL.split('://', 1)[-1]
+OVERNODE_UA   = 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/124.0.0.0 Safari/537.36'
+
+
+RECORD_PATH     = os.environ.get('AFK_RECORD', '')
+RECORD_REDACTED = ('login', 'subscribe')   # body chứa token/cookie — không ghi
+
+class TrafficRecorder:
+    """
+    AFK_RECORD=<file>: ghi traffic upstream ra JSON Lines (gzip nếu tên kết thúc .gz), mỗi dòng
+    một mảng [t, kind, tool, account, ...] với t = giây kể từ lúc bắt đầu ghi:
+        http      [.., method, endpoint, status, elapsed, body]   (account = None)
+        ws_open   [..]              ws  [.., raw]                 ws_close [.., code]
+        sse_open  [..]              sse [.., event, data, id]
+    Không ghi header, cookie, token. bench/replay.py phát lại file này cho worker thật.
+    Chỉ process sở hữu bản ghi mở file (open_recorder); farm process tạo recorder path=None,
+    gom record rồi gửi qua FarmLink — t tính theo epoch của process sở hữu nên khớp nhau.
+    """
+
+    def __init__(self, path, epoch=None):
+        self.path   = path
+        self.epoch  = epoch or time.time()
+        self.t0     = time.monotonic() - (time.time() - self.epoch)
+        self.lines  = 0
+        self._queue = deque()
+        self._lock  = threading.Lock()
+        self._file  = None
+        if path is not None:
+            self._file = (gzip.open if path.endswith('.gz') else open)(path, 'wt', encoding='utf-8')
+            self._emit('start', None, None, self.epoch)
+            threading.Thread(target=self._run, daemon=True, name='recorder').start()
+
+    def _emit(self, kind, tool, account, *payload):
+        # deque.append là thread-safe — worker không phải chờ I/O ghi file
+        self._queue.append([round(time.monotonic() - self.t0, 3), kind, tool, account, *payload])
+
+    def http(self, tool, method, path, status, elapsed, body=None):
+        endpoint = upstream_endpoint(path)
+        if body is not None:
+            body = None if endpoint in RECORD_REDACTED else body.decode('utf-8', 'replace')
+        self._emit('http', tool, None, method, endpoint, status, round(elapsed, 4), body)
+
+    def ws_open(self, tool, account):
+        self._emit('ws_open', tool, account)
+
+    def ws_frame(self, tool, account, raw):
+        self._emit('ws', tool, account, raw if isinstance(raw, str) else raw.decode('utf-8', 'replace'))
+
+    def ws_close(self, tool, account, code):
+        self._emit('ws_close', tool, account, code)
+
+    def sse_open(self, tool, account):
+        self._emit('sse_open', tool, account)
+
+    def sse_event(self, tool, account, event):
+        self._emit('sse', tool, account, event.event, event.data, event.id)
+
+    def drain(self):
+        """Record đang chờ — farm process gửi chúng về web process"""
+        q, out = self._queue, []
+        while q:
+            out.append(q.popleft())
+        return out
+
+    def extend(self, records):
+        self._queue.extend(records)
+
+    def flush(self):
+        with self._lock:
+            if self._file is None:
+                return
+            q = self._queue
+            while q:
+                self._file.write(json.dumps(q.popleft(), separators=(',', ':')) + '\n')
+                self.lines += 1
+            self._file.flush()
+
+    def _run(self):
+        while self._file is not None:
+            time.sleep(0.5)
+            self.flush()
+
+    def close(self):
+        self.flush()
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+recorder = None
+
+def open_recorder(per_process=False):
+    """
+    Mở AFK_RECORD trong process gọi hàm này (web process / main.py). Không chạy lúc import vì
+    farm process spawn sẽ import lại main và mở 'wt' làm mất bản ghi. per_process: nhiều web
+    worker cùng ghi → mỗi worker một file rec.<pid>.jsonl.gz (bench/replay.py nhận nhiều file).
+    """
+    global recorder
+    if not RECORD_PATH or recorder is not None:
+        return recorder
+    path = RECORD_PATH
+    if per_process:
+        folder, name = os.path.split(path)
+        stem, dot, ext = name.partition('.')
+        path = os.path.join(folder, f'{stem}.{os.getpid()}{dot}{ext}')
+    recorder = TrafficRecorder(path)
+    os.environ['AFK_RECORD_EPOCH'] = str(recorder.epoch)   # farm process spawn sau đó kế thừa
+    return recorder
+
+                                                                                
+HTTP_POOL_SIZE  = int(os.environ.get('AFK_HTTP_POOL_SIZE', 64))
+HTTP_POOL_BLOCK = os.environ.get('AFK_HTTP_POOL_BLOCK', '1') == '1'
+HTTP_POOL_WAIT  = float(os.environ.get('AFK_HTTP_POOL_WAIT', 10))   # pool đầy: chờ tối đa rồi báo lỗi
+HTTP_KEEPALIVE  = int(os.environ.get('AFK_HTTP_KEEPALIVE', 60))
+
+class PoolStats:
+    """Bộ đếm của một PooledAdapter — nhiều thread cùng gửi request nên chỉ đổi dưới lock"""
+
+    __slots__ = ('requests', 'opened', 'waited', 'in_flight', 'errors', '_lock')
+
+    FIELDS = ('requests', 'opened', 'waited', 'in_flight', 'errors')
+
+    def __init__(self):
+        self.requests = self.opened = self.waited = self.in_flight = self.errors = 0
+        self._lock = threading.Lock()
+
+    def begin(self):
+        with self._lock:
+            self.requests  += 1
+            self.in_flight += 1
+
+    def end(self, error=False):
+        with self._lock:
+            self.in_flight -= 1
+            if error:
+                self.errors += 1
+
+    def bump(self, name):
+        with self._lock:
+            setattr(self, name, getattr(self, name) + 1)
+
+    def copy(self):
+        with self._lock:
+            return {name: getattr(self, name) for name in self.FIELDS}
+
+class PooledAdapter(HTTPAdapter):
+    """
+    HTTPAdapter dùng chung cho mọi account của một platform: keep-alive TCP,
+    pool giới hạn (block khi đầy, tối đa AFK_HTTP_POOL_WAIT giây rồi EmptyPoolError thay vì
+    treo mãi) và đếm số connection mở / tái sử dụng / phải chờ.
+    """
+
+    def __init__(self, tool, pool_size=HTTP_POOL_SIZE, block=HTTP_POOL_BLOCK):
+        self.tool  = tool
+        self.stats = PoolStats()
+        super().__init__(pool_connections=4, pool_maxsize=pool_size, pool_block=block)
+
+    def init_poolmanager(self, connections, maxsize, block=False, **pool_kwargs):
+        opts = list(HTTPConnectionPool.ConnectionCls.default_socket_options)
+        opts.append((socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1))
+        if hasattr(socket, 'TCP_KEEPIDLE'):
+            opts += [(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE,  HTTP_KEEPALIVE),
+                     (socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, max(HTTP_KEEPALIVE // 4, 5)),
+                     (socket.IPPROTO_TCP, socket.TCP_KEEPCNT,   4)]
+        pool_kwargs['socket_options'] = opts
+        super().init_poolmanager(connections, maxsize, block=block, **pool_kwargs)
+        stats = self.stats
+
+        class Counting:
+            def _new_conn(self):
+                stats.bump('opened')
+                return super()._new_conn()
+
+            def _get_conn(self, timeout=None):
+                if self.block and self.pool is not None and self.pool.empty():
+                    stats.bump('waited')
+                return super()._get_conn(HTTP_POOL_WAIT if timeout is None else timeout)
+
+        self.poolmanager.pool_classes_by_scheme = {
+            'http':  type('CountingHTTPConnectionPool',  (Counting, HTTPConnectionPool),  {}),
+            'https': type('CountingHTTPSConnectionPool', (Counting, HTTPSConnectionPool), {}),
+        }
+
+    def send(self, request, **kwargs):
+        st    = self.stats
+        error = False
+        st.begin()
+        t0 = time.monotonic()
+        try:
+            r = super().send(request, **kwargs)
+            elapsed = time.monotonic() - t0
+            observe_upstream(self.tool, request.path_url, r.status_code, elapsed)
+            if recorder is not None:
+                recorder.http(self.tool, request.method, request.path_url, r.status_code, elapsed,
+                              None if kwargs.get('stream') else r.content)
+            return r
+        except Exception:
+            error = True
+            observe_upstream(self.tool, request.path_url, 'error', time.monotonic() - t0)
+            raise
+        finally:
+            st.end(error)
+
+    def snapshot(self):
+        st    = self.stats.copy()
+        idle  = 0
+        pools = list(self.poolmanager.pools._container.values())
+        for pool in pools:
+            if pool.pool is not None:
+                idle += sum(1 for c in list(pool.pool.queue) if c is not None)
+        return {
+            'pools':       len(pools),
+            'max_size':    self._pool_maxsize,
+            'open':        idle + st['in_flight'],
+            'idle':        idle,
+            'in_flight':   st['in_flight'],
+            'requests':    st['requests'],
+            'opened':      st['opened'],
+            'reused':      max(st['requests'] - st['opened'], 0),
+            'waited':      st['waited'],
+            'errors':      st['errors'],
+        }
+
+HTTP_ADAPTERS   = {tool: PooledAdapter(tool) for tool in ('hyperhub', 'altare', 'overnode')}
+# stream sống lâu (SSE /subscribe) giữ connection suốt đời stream — không được chiếm pool chung,
+# nên đi adapter riêng không block: mỗi stream một connection, thừa thì đóng khi trả về
+STREAM_ADAPTERS = {'altare': PooledAdapter('altare', block=False)}
+_http_pools     = {}
+
+def account_session(tool):
+    """Session riêng (cookie jar riêng) nhưng dùng chung connection pool của platform"""
+    s = requests.Session()
+    s.mount('https://', HTTP_ADAPTERS[tool])
+    s.mount('http://',  HTTP_ADAPTERS[tool])
+    return s
+
+def http_pool(tool, stream=False):
+    """Session dùng chung, không lưu cookie — auth header được gắn theo từng request"""
+    key = (tool, stream)
+    s   = _http_pools.get(key)
+    if s is None:
+        s = account_session(tool)
+        if stream:
+            s.mount('https://', STREAM_ADAPTERS[tool])
+            s.mount('http://',  STREAM_ADAPTERS[tool])
+        s.cookies.set_policy(DefaultCookiePolicy(allowed_domains=[]))
+        s = _http_pools.setdefault(key, s)
+    return s
 
                                                                                 
+ALTARE_BALANCE_INTERVAL = int(os.environ.get('AFK_ALTARE_BALANCE_INTERVAL', 120))
+
+class AltareBalancePoller:
+    """
+    Balance Altare của mọi account qua một job scheduler duy nhất. Mỗi `tick` giây account được
+    nhóm theo token đang dùng: account chung token (cùng login, nhiều tenant trên một login) chỉ
+    tốn một /api/tenants — response parse một lần rồi chia creditsCents theo tenant_id. Nhóm có
+    account tới hạn thì cả nhóm được đọc và dời hạn interval ±jitter; lệch pha ngẫu nhiên lúc
+    subscribe. Số request tỉ lệ với số token khác nhau chứ không phải số dòng account.
+    """
+
+    def __init__(self, interval, tick=5, jitter=0.1, concurrency=8):
+        self.interval = interval
+        self.tick     = tick
+        self.jitter   = jitter
+        self.fetches  = 0
+        self._members = {}
+        self._seq     = itertools.count()
+        self._job     = None
+        self._lock    = threading.Lock()
+        self._pool    = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='afk-altare-balance')
+
+    def subscribe(self, login, tenant_id, token_fn, callback, stop_event):
+        """token_fn() → token hiện hành của login; tự huỷ khi stop_event được set"""
+        key    = next(self._seq)
+        member = {'login': login, 'tenant_id': tenant_id, 'token_fn': token_fn, 'callback': callback,
+                  'due': time.monotonic() + random.uniform(0, self.interval * 0.25), 'busy': False}
+        with self._lock:
+            self._members[key] = member
+            if self._job is None:
+                self._job = scheduler.every(self.tick, self._run, first=self.tick, name='altare.balance')
+        stop_event.add_callback(lambda: self._unsubscribe(key))
+        return key
+
+    def _unsubscribe(self, key):
+        with self._lock:
+            self._members.pop(key, None)
+
+    def _run(self):
+        now = time.monotonic()
+        with self._lock:
+            members = [m for m in self._members.values() if not m['busy']]
+        groups = {}
+        for m in members:
+            try:
+                token = m['token_fn']()
+            except Exception:
+                continue
+            if token:
+                groups.setdefault(token, []).append(m)
+        with self._lock:
+            batch = [(token, group) for token, group in groups.items() if any(m['due'] <= now for m in group)]
+            for _, group in batch:
+                for m in group:
+                    m['busy'] = True
+        for token, group in batch:
+            self._pool.submit(self._fetch, token, group)
+
+    def _fetch(self, token, group):
+        credits = None
+        try:
+            r = http_pool('altare').get(f'{ALTARE_API}/api/tenants',
+                                        headers=make_altare_headers(token), timeout=10)
+            if r.status_code == 401:
+                for login in {m['login'] for m in group}:
+                    altare_tokens.refresh(login, token)
+            elif r.status_code == 200:
+                credits = {item.get('id'): item.get('creditsCents') for item in r.json().get('items', [])}
+        except Exception:
+            pass
+        with self._lock:
+            self.fetches += 1
+            # lỗi → thử lại sau 1/4 chu kỳ
+            span = self.interval * (random.uniform(1 - self.jitter, 1 + self.jitter) if credits is not None else 0.25)
+            for m in group:
+                m['busy'] = False
+                m['due']  = time.monotonic() + span
+        for m in group if credits else ():
+            cents = credits.get(m['tenant_id'])
+            if cents is not None:
+                try:
+                    m['callback'](round(cents / 100, 4))
+                except Exception:
+                    pass
+
+    def stats(self):
+        with self._lock:
+            return {'accounts': len(self._members), 'fetches': self.fetches, 'interval': self.interval}
+
+altare_balances = AltareBalancePoller(ALTARE_BALANCE_INTERVAL)
+
+def hyperhub_reward_cycle(last_nri, nri):
+    """nextRewardIn vừa reset (≤3s → >5s) — một reward đã được phát"""
+    return last_nri is not None and last_nri <= 3000 and nri > 5000
+
+def overnode_reward_cycle(last_nri, nri):
+    """Giống source JS gốc: nextRewardIn > lastNextRewardIn + 5000"""
+    return last_nri is not None and nri > last_nri + 5000
+
+BALANCE_RECONCILE_INTERVAL    = int(os.environ.get('AFK_BALANCE_RECONCILE_INTERVAL', 900))
+BALANCE_RECONCILE_CONCURRENCY = int(os.environ.get('AFK_BALANCE_RECONCILE_CONCURRENCY', 8))
+BALANCE_RECONCILE_TICK        = 5
+
+class BalanceReconciler:
+    """
+    Balance hyperhub/overnode được cộng tại chỗ ở mỗi reward cycle (coinsPerMinute × độ dài
+    chu kỳ, lấy từ nextRewardIn ngay sau reset) thay vì gọi /wallet/balance mỗi reward.
+    Mỗi tool có một job gom các account đến hạn thành lô, đọc balance thật trên pool giới hạn
+    (AFK_BALANCE_RECONCILE_CONCURRENCY) và sửa drift. Hạn của từng account rải đều trong
+    AFK_BALANCE_RECONCILE_INTERVAL; lần đọc đầu tiên chạy ngay sau khi đăng ký.
+    """
+
+    def __init__(self, interval, concurrency, tick=BALANCE_RECONCILE_TICK):
+        self.interval = interval
+        self.tick     = tick
+        self.fetches  = 0
+        self.credits  = 0
+        self._entries = {}
+        self._jobs    = {}
+        self._lock    = threading.Lock()
+        self._pool    = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='afk-balance')
+
+    def register(self, tool, email, fetch, state):
+        """fetch() → balance thật hoặc None; gọi trên thread pool nên được phép block"""
+        entry = {'fetch': fetch, 'state': state, 'due': time.monotonic() + random.uniform(0, self.tick),
+                 'busy': False, 'synced': False}
+        with self._lock:
+            self._entries[(tool, email)] = entry
+            if tool not in self._jobs:
+                self._jobs[tool] = scheduler.every(self.tick, lambda: self._run(tool), first=self.tick,
+                                                   name=f'balance.reconcile:{tool}')
+        state['stop_event'].add_callback(lambda: self.unregister(tool, email, entry))
+
+    def unregister(self, tool, email, entry=None):
+        with self._lock:
+            if entry is None or self._entries.get((tool, email)) is entry:
+                self._entries.pop((tool, email), None)
+
+    def credit(self, state, cpm, nri):
+        """Cộng reward ước tính của chu kỳ vừa xong → (delta, balance mới)"""
+        delta = round(cpm * max(nri, 0) / 60000, 4)
+        REWARD_EVENTS.inc(state.tool)
+        with self._lock:
+            self.credits += 1
+            bal = round(state.get('balance', 0.0) + delta, 4)
+        state['balance'] = bal
+        return delta, bal
+
+    def reconcile(self, tool, email):
+        """Đưa account lên đầu lô kế tiếp (vd. sau khi reconnect lâu)"""
+        with self._lock:
+            entry = self._entries.get((tool, email))
+            if entry is not None:
+                entry['due'] = 0
+
+    def _run(self, tool):
+        now = time.monotonic()
+        with self._lock:
+            batch = [(email, e) for (t, email), e in self._entries.items()
+                     if t == tool and e['due'] <= now and not e['busy']]
+            for _, e in batch:
+                e['busy'] = True
+        for email, e in batch:
+            self._pool.submit(self._fetch, tool, email, e)
+
+    def _fetch(self, tool, email, entry):
+        state = entry['state']
+        try:
+            bal = entry['fetch']() if state['running'] else None
+        except Exception:
+            bal = None
+        with self._lock:
+            self.fetches += 1
+            entry['busy'] = False
+            # lỗi → thử lại sau 1/4 chu kỳ; thành công → hạn kế tiếp ±10%
+            span = self.interval * (random.uniform(0.9, 1.1) if bal is not None else 0.25)
+            entry['due'] = time.monotonic() + span
+            if bal is None:
+                return
+            drift = round(bal - state.get('balance', 0.0), 4)
+            first, entry['synced'] = not entry['synced'], True
+        state['balance'] = bal
+        if first:
+            add_log(tool, 'Balance: {balance}', account=email, event='balance', balance=bal)
+        elif abs(drift) >= 0.01 and log_enabled(DEBUG):
+            add_log(tool, 'Balance reconciled: {balance} (drift {drift})', account=email, level=DEBUG,
+                    event='balance', balance=bal, drift=drift)
+
+    def stats(self):
+        with self._lock:
+            per_tool = {}
+            for tool, _ in self._entries:
+                per_tool[tool] = per_tool.get(tool, 0) + 1
+            return {'accounts': per_tool, 'fetches': self.fetches, 'credits': self.credits,
+                    'interval': self.interval}
+
+balance_reconciler = BalanceReconciler(BALANCE_RECONCILE_INTERVAL, BALANCE_RECONCILE_CONCURRENCY)
+
+FRAME_DECODER   = os.environ.get('AFK_FRAME_DECODER', 'auto').strip().lower()
+FRAME_PREFILTER = os.environ.get('AFK_FRAME_PREFILTER', '1') != '0'
+
+def make_frame_decoder(name='auto', prefilter=True):
+    """
+    decode(raw) → (coinsPerMinute, nextRewardIn) nếu raw là frame afk_state, ngược lại None.
+    name: 'json' | 'orjson' | 'auto' (orjson nếu đã cài). prefilter bỏ qua frame không chứa
+    chữ afk_state trước khi parse — phần lớn frame khác không tốn json.loads nữa.
+    """
+    if name == 'auto':
+        name = 'orjson' if orjson is not None else 'json'
+    if name == 'orjson' and orjson is None:
+        print('[WARN] AFK_FRAME_DECODER=orjson requires orjson — falling back to json')
+        name = 'json'
+    loads = orjson.loads if name == 'orjson' else json.loads
+
+    def decode(raw):
+        if prefilter and ('afk_state' if isinstance(raw, str) else b'afk_state') not in raw:
+            return None
+        try:
+            data = loads(raw)
+        except ValueError:
+            return None
+        if type(data) is not dict or data.get('type') != 'afk_state':
+            return None
+        return data.get('coinsPerMinute', 0), data.get('nextRewardIn', 0)
+
+    decode.name = f"{name}{'+prefilter' if prefilter else ''}"
+    return decode
+
+decode_afk_frame = make_frame_decoder(FRAME_DECODER, FRAME_PREFILTER)
+
 def make_altare_headers(token, tenant_id=''):
     h = {
         'Authorization': token,
@@ -1051,24 +3263,282 @@ def make_altare_headers(token, tenant_id=''):
         h['altare-selected-tenant-id'] = tenant_id
     return h
 
+def altare_login(email, password, timeout=15):
+    """POST /api/auth/login → ('Bearer …' hoặc None, HTTP status). Lỗi mạng thì raise"""
+    r = http_pool('altare').post(
+        f'{ALTARE_API}/api/auth/login',
+        headers={
+            'Content-Type': 'application/json',
+            'Accept':       'application/json',
+            'Origin':       ALTARE_WEB,
+            'User-Agent':   'Mozilla/5.0 (Windows NT 10.0; Win64; x64)',
+        },
+        json={'identifier': email, 'password': password},
+        timeout=timeout,
+    )
+    if r.status_code != 200:
+        return None, r.status_code
+    token = r.json().get('token')
+    return (f'Bearer {token}' if token else None), 200
+
+def jwt_expiry(token):
+    """exp (epoch giây) trong payload JWT; None nếu token không đọc được"""
+    try:
+        payload = token.replace('Bearer ', '').split('.')[1]
+        exp     = json.loads(base64.urlsafe_b64decode(payload + '=' * (-len(payload) % 4))).get('exp')
+        return float(exp) if exp else None
+    except (IndexError, ValueError, TypeError, AttributeError):
+        return None
+
+ALTARE_TOKEN_MARGIN = int(os.environ.get('AFK_ALTARE_TOKEN_MARGIN', 300))
+ALTARE_TOKEN_TTL    = 1800
+ALTARE_TOKEN_FLOOR  = 30    # refresh sớm nhất sau ngần này giây kể từ lần login trước
+
+class AltareTokens:
+    """
+    Token Altare của các account đang chạy. Đọc exp trong JWT và refresh trước hạn
+    `margin` giây (không đọc được thì cứ `ttl` giây như trước); token vừa nhận mà đã nằm
+    trong margin thì refresh ở nửa thời gian còn lại, không dưới ALTARE_TOKEN_FLOOR giây. Sau 401 thì refresh
+    theo yêu cầu — single-flight: mọi caller cùng chờ một lần login. Token mới được
+    lưu lại nên restart không phải login lại hàng loạt.
+    """
+
+    def __init__(self, margin, ttl):
+        self.margin   = margin
+        self.ttl      = ttl
+        self._lock    = threading.Lock()
+        self._entries = {}
+
+    def track(self, email, password, token, stop_event):
+        entry = {'token': token, 'password': password, 'job': None, 'lock': threading.Lock(), 'stop': stop_event}
+        with self._lock:
+            self._entries[email] = entry
+        self._schedule(email, entry, startup=True)
+        stop_event.add_callback(lambda: self._untrack(email, entry))
+
+    def current(self, email):
+        entry = self._entries.get(email)
+        return entry['token'] if entry is not None else ''
+
+    def refresh(self, email, stale=None):
+        """
+        Login lại, trả về token hiện hành. stale là token caller vừa thấy bị từ chối:
+        nếu trong lúc chờ khoá token đã đổi thì thread khác vừa refresh xong → dùng luôn.
+        """
+        entry = self._entries.get(email)
+        if entry is None:
+            return ''
+        with entry['lock']:
+            if stale is not None and entry['token'] != stale:
+                return entry['token']
+            if not entry['password']:
+                return entry['token']
+            try:
+                token, status = altare_login(email, entry['password'], timeout=10)
+            except Exception:
+                token, status = None, 0
+            if token is None:
+                add_log('altare', 'Token refresh failed (HTTP {status})', account=email, level=WARNING,
+                        event='token_refresh_failed', status=status)
+                self._schedule(email, entry, retry=True)
+                return entry['token']
+            entry['token'] = token
+            persist_account('altare', email, {'token': token})
+            if log_enabled(DEBUG):
+                add_log('altare', 'Token refreshed', account=email, level=DEBUG, event='token_refresh',
+                        expires=jwt_expiry(token))
+            self._schedule(email, entry)
+        return token
+
+    def _schedule(self, email, entry, startup=False, retry=False):
+        if entry['job'] is not None:
+            entry['job'].cancel()
+        exp = jwt_expiry(entry['token'])
+        if retry:
+            delay = 60
+        elif exp is None:
+            delay = self.ttl
+        else:
+            left  = exp - time.time()
+            delay = left - self.margin
+            if delay <= 0 and startup:
+                # token lưu từ lần chạy trước đã hết hạn → rải các lần login ra
+                delay = random.uniform(1, 60)
+            elif delay <= 0:
+                # server cấp token sống ngắn hơn margin — không login lại mỗi giây
+                delay = max(left / 2, ALTARE_TOKEN_FLOOR)
+        entry['job'] = scheduler.call_later(delay, lambda: self.refresh(email, entry['token']),
+                                            entry['stop'], name=f'altare.token:{email}')
+
+    def _untrack(self, email, entry):
+        if entry['job'] is not None:
+            entry['job'].cancel()
+        with self._lock:
+            if self._entries.get(email) is entry:
+                del self._entries[email]
+
+altare_tokens = AltareTokens(ALTARE_TOKEN_MARGIN, ALTARE_TOKEN_TTL)
+
+SSE_READ_CHUNK  = 16384
+SSE_IDLE_MIN    = float(os.environ.get('AFK_SSE_IDLE_MIN', 30))
+SSE_IDLE_MAX    = float(os.environ.get('AFK_SSE_IDLE_MAX', 120))
+SSE_IDLE_FACTOR = 3
+SSE_RETRY       = 3
+
+class SSEEvent:
+    __slots__ = ('event', 'data', 'id')
+
+    def __init__(self, event, data, id):
+        self.event = event
+        self.data  = data
+        self.id    = id
+
+class SSEParser:
+    """
+    Parser text/event-stream tăng dần: feed(chunk) nhận nguyên chunk bytes, trả các event
+    vừa hoàn chỉnh. Dòng dở dang giữ lại cho chunk sau; comment (keep-alive) bị bỏ qua.
+    """
+
+    __slots__ = ('buf', 'data', 'event', 'last_id', 'retry')
+
+    def __init__(self):
+        self.buf     = b''
+        self.data    = []
+        self.event   = ''
+        self.last_id = ''
+        self.retry   = None
+
+    def reset(self):
+        """Mất kết nối giữa chừng → bỏ event dở, giữ last_id/retry để resume"""
+        self.buf, self.data, self.event = b'', [], ''
+
+    def feed(self, chunk):
+        lines    = (self.buf + chunk).splitlines(True)
+        self.buf = b''
+        # dòng cuối chưa có xuống dòng, hoặc kết thúc bằng \r (có thể là nửa đầu của \r\n)
+        if lines and not lines[-1].endswith(b'\n'):
+            self.buf = lines.pop()
+        events = []
+        for line in lines:
+            line = line.rstrip(b'\r\n')
+            if not line:
+                if self.data:
+                    events.append(SSEEvent(self.event or 'message', '\n'.join(self.data), self.last_id))
+                self.data, self.event = [], ''
+                continue
+            if line[0] == 0x3a:   # ':' comment
+                continue
+            name, _, value = line.partition(b':')
+            if value[:1] == b' ':
+                value = value[1:]
+            value = value.decode('utf-8', 'replace')
+            if name == b'data':
+                self.data.append(value)
+            elif name == b'event':
+                self.event = value
+            elif name == b'id':
+                if '\0' not in value:
+                    self.last_id = value
+            elif name == b'retry':
+                if value.isdigit():
+                    self.retry = int(value)
+        return events
+
+class SSEClient:
+    """
+    Trạng thái một stream SSE qua các lần reconnect: Last-Event-ID để resume, delay reconnect
+    theo retry: của server, và idle timeout = SSE_IDLE_FACTOR × nhịp keep-alive quan sát được
+    (kẹp trong [AFK_SSE_IDLE_MIN, AFK_SSE_IDLE_MAX]) — stream treo sẽ bị phát hiện.
+    """
+
+    def __init__(self, tool=None, account=None):
+        self.parser  = SSEParser()
+        self.gap     = None
+        self.events  = 0
+        self.tool    = tool
+        self.account = account
+
+    def headers(self, base):
+        h = dict(base)
+        h['Accept']          = 'text/event-stream'
+        h['Cache-Control']   = 'no-cache'
+        h['Accept-Encoding'] = 'identity'
+        if self.parser.last_id:
+            h['Last-Event-ID'] = self.parser.last_id
+        return h
+
+    @property
+    def idle_timeout(self):
+        if self.gap is None:
+            return SSE_IDLE_MAX
+        return min(SSE_IDLE_MAX, max(SSE_IDLE_MIN, self.gap * SSE_IDLE_FACTOR))
+
+    @property
+    def retry_delay(self):
+        return self.parser.retry / 1000 if self.parser.retry is not None else SSE_RETRY
+
+    def _seen(self, last):
+        now = time.monotonic()
+        gap = now - last
+        # tăng ngay theo khoảng lặng dài nhất, giảm dần khi server gửi dày hơn
+        self.gap = gap if self.gap is None or gap > self.gap else self.gap * 0.9 + gap * 0.1
+        return now
+
+    def _dispatch(self, chunk):
+        events = self.parser.feed(chunk)
+        self.events += len(events)
+        if recorder is not None:
+            for event in events:
+                recorder.sse_event(self.tool, self.account, event)
+        return events
+
+    def _opened(self):
+        self.parser.reset()
+        if recorder is not None:
+            recorder.sse_open(self.tool, self.account)
+
+    def read(self, r):
+        """Event từ một requests.Response (stream=True)"""
+        self._opened()
+        raw  = r.raw
+        last = time.monotonic()
+        if hasattr(raw, 'read1'):
+            chunks = iter(lambda: raw.read1(SSE_READ_CHUNK), b'')
+        else:
+            chunks = r.iter_content(chunk_size=None)
+        for chunk in chunks:
+            last = self._seen(last)
+            yield from self._dispatch(chunk)
+
+    async def aread(self, r):
+        """Như read() cho aiohttp.ClientResponse"""
+        self._opened()
+        last = time.monotonic()
+        async for chunk in r.content.iter_any():
+            last = self._seen(last)
+            for event in self._dispatch(chunk):
+                yield event
+
 def altare_worker(account, state):
     """
     Port đầy đủ từ altare_farm.py gốc:
     - SSE stream để giữ kết nối ổn định
     - Heartbeat mỗi 30s
     - Stats + stuck detection mỗi 120s
-    - Token refresh mỗi 30 phút
+    - Token refresh trước khi hết hạn (AltareTokens)
     """
     ident     = account['email']
     password  = account.get('password', '')
     tenant_id = account.get('tenant_id', '')
 
-    BASE_API  = 'https://api.altare.sh'
-    BASE_WEB  = 'https://altare.sh'
+    BASE_API  = ALTARE_API
+    BASE_WEB  = ALTARE_WEB
+    http      = http_pool('altare')
+    stream    = http_pool('altare', stream=True)
 
     def headers(token='', with_tenant=True):
         h = {
-            'Authorization': token or account.get('token', ''),
+            'Authorization': token or altare_tokens.current(ident),
             'Content-Type':  'application/json',
             'Accept':        'application/json',
             'Origin':        BASE_WEB,
@@ -1082,167 +3552,276 @@ def altare_worker(account, state):
     def alive():
         return state['running'] and not state['stop_event'].is_set()
 
-    def get_balance():
-        try:
-            r = requests.get(f'{BASE_API}/api/tenants', headers=headers(), timeout=10)
-            if r.status_code == 200:
-                for item in r.json().get('items', []):
-                    if item.get('id') == tenant_id:
-                        cents = item.get('creditsCents')
-                        return round(cents / 100, 4) if cents is not None else None
-        except Exception:
-            pass
-        return None
+    def post(action):
+        """POST tới rewards/afk/<action>; 401 → refresh token (single-flight) rồi thử lại một lần"""
+        url   = f'{BASE_API}/api/tenants/{tenant_id}/rewards/afk/{action}'
+        token = altare_tokens.current(ident)
+        r     = http.post(url, headers=headers(token), json={}, timeout=10)
+        if r.status_code == 401 and altare_tokens.refresh(ident, token) != token:
+            r = http.post(url, headers=headers(), json={}, timeout=10)
+        return r
 
     def afk_start(retries=3):
         for _ in range(retries):
             try:
-                r = requests.post(f'{BASE_API}/api/tenants/{tenant_id}/rewards/afk/start',
-                                  headers=headers(), json={}, timeout=10)
+                r = post('start')
                 if r.status_code in (200, 201, 204):
                     return True
             except Exception:
                 pass
             afk_stop()
-            time.sleep(5)
+            if not wait_stopped(state, 5):
+                break
         return False
 
     def afk_stop():
         try:
-            requests.post(f'{BASE_API}/api/tenants/{tenant_id}/rewards/afk/stop',
-                          headers=headers(), json={}, timeout=10)
+            post('stop')
         except Exception:
             pass
 
     def heartbeat():
         try:
-            r = requests.post(f'{BASE_API}/api/tenants/{tenant_id}/rewards/afk/heartbeat',
-                              headers=headers(), json={}, timeout=10)
-            return r.status_code in (200, 201, 204)
+            return post('heartbeat').status_code in (200, 201, 204)
         except Exception:
             return False
 
     if not tenant_id:
-        add_log('altare', f'[{ident}] Missing tenant_id — aborting')
+        add_log('altare', 'Missing tenant_id — aborting', account=ident, level=ERROR, event='error')
         state['running'] = False
         return
 
+    altare_tokens.track(ident, password, account.get('token', ''), state['stop_event'])
+
                                                                                
     afk_stop()
     time.sleep(0.5)
     if afk_start():
-        add_log('altare', f'[{ident}] AFK started ✓')
+        add_log('altare', 'AFK started ✓', account=ident, event='afk_start')
     else:
-        add_log('altare', f'[{ident}] AFK start failed')
+        add_log('altare', 'AFK start failed', account=ident, level=WARNING, event='afk_start_failed')
 
                                                                               
     def sse_loop():
         first = True
+        sse   = SSEClient('altare', ident)
         while alive() and state.get('is_farming', True):
             try:
-                token = account.get('token', '')
+                token = altare_tokens.current(ident)
                 raw   = token.replace('Bearer ', '')
                 url   = f'{BASE_API}/subscribe?token={raw}'
-                h     = headers()
-                h['Accept']         = 'text/event-stream'
-                h['Cache-Control']  = 'no-cache'
-                with requests.get(url, headers=h, stream=True, timeout=(10, None)) as r:
+                idle  = sse.idle_timeout
+                with stream.get(url, headers=sse.headers(headers()), stream=True, timeout=(10, idle)) as r:
                     if r.status_code == 200:
+                        state['connection'] = 'connected'
                         if first:
-                            add_log('altare', f'[{ident}] SSE stream connected ✓')
+                            add_log('altare', 'SSE stream connected ✓', account=ident, event='connected')
                             first = False
-                        for _ in r.iter_lines(chunk_size=1):
+                        for _ in sse.read(r):
                             if not alive() or not state.get('is_farming', True):
                                 break
                     else:
                         first = True
-                        time.sleep(10)
+                        if r.status_code == 401:
+                            altare_tokens.refresh(ident, token)
+                        wait_stopped(state, 10)
+            except (requests.exceptions.ReadTimeout, urllib3.exceptions.ReadTimeoutError, socket.timeout):
+                if log_enabled(DEBUG):
+                    add_log('altare', 'SSE idle {idle}s — reconnecting', account=ident, level=DEBUG,
+                            event='sse_idle', idle=round(idle))
             except Exception:
                 first = True
-                time.sleep(10)
-            time.sleep(3)
+                wait_stopped(state, 10)
+            state['connection'] = 'disconnected'
+            wait_stopped(state, sse.retry_delay)
 
                                                                                
-    def heartbeat_loop():
-        while alive():
-            if state.get('is_farming', True):
-                heartbeat()
-            for _ in range(30):
-                if not alive():
-                    break
-                time.sleep(1)
+    def heartbeat_tick():
+        if state.get('is_farming', True):
+            heartbeat()
 
                                                                                
-    def stats_loop():
-        credits_start = None
-        last_balance  = None
-        stuck_count   = 0
-        while alive():
-            if not state.get('is_farming', True):
-                time.sleep(5)
-                continue
-            bal = get_balance()
-            if bal is not None:
-                state['balance'] = bal
-                if credits_start is None:
-                    credits_start = bal
-                earned = round(bal - credits_start, 4)
-                if bal != last_balance:
-                    add_log('altare', f'[{ident}] +{earned:g} CR | Balance: {bal:g}')
-                    stuck_count = 0
-                    last_balance = bal
-                else:
-                    stuck_count += 1
-                    if stuck_count >= 3:
-                        add_log('altare', f'[{ident}] Balance stuck {stuck_count}x — resetting AFK...')
-                        state['is_farming'] = False
-                        afk_stop()
-                        time.sleep(5)
-                        if afk_start():
-                            state['is_farming'] = True
-                            stuck_count = 0
-                            credits_start = bal
-                        else:
-                            add_log('altare', f'[{ident}] Reset failed, retrying next cycle')
-            for _ in range(120):
-                if not alive():
-                    break
-                time.sleep(1)
+    stats = {'credits_start': None, 'last_balance': None, 'stuck_count': 0}
 
-                                                                              
-    def token_refresh_loop():
-        while alive():
-            for _ in range(1800):
-                if not alive():
-                    break
-                time.sleep(1)
-            if not alive() or not password:
-                continue
-            try:
-                r = requests.post(f'{BASE_API}/api/auth/login',
-                                  headers=headers(token=''),
-                                  json={'identifier': ident, 'password': password},
-                                  timeout=10)
-                if r.status_code == 200:
-                    new_tok = f"Bearer {r.json().get('token')}"
-                    account['token'] = new_tok
-            except Exception:
-                pass
+    def on_balance(bal):
+        if not alive() or not state.get('is_farming', True):
+            return
+        state['balance'] = bal
+        if stats['credits_start'] is None:
+            stats['credits_start'] = bal
+        earned = round(bal - stats['credits_start'], 4)
+        if bal != stats['last_balance']:
+            if stats['last_balance'] is not None:
+                REWARD_EVENTS.inc('altare')
+            add_log('altare', '+{delta:g} CR | Balance: {balance:g}', account=ident, event='balance',
+                    balance=bal, delta=earned)
+            stats['stuck_count']  = 0
+            stats['last_balance'] = bal
+            return
+        stats['stuck_count'] += 1
+        if stats['stuck_count'] >= 3:
+            add_log('altare', 'Balance stuck {count}x — resetting AFK...', account=ident, level=WARNING,
+                    event='stuck', count=stats['stuck_count'])
+            state['is_farming'] = False
+            scheduler.call_later(0, lambda: reset_afk(bal), state['stop_event'], name=f'altare.reset:{ident}')
+
+    def reset_afk(bal):
+        afk_stop()
+        if not wait_stopped(state, 5):
+            return
+        if afk_start():
+            state['is_farming'] = True
+            stats['stuck_count']   = 0
+            stats['credits_start'] = bal
+        else:
+            state['is_farming'] = True
+            add_log('altare', 'Reset failed, retrying next cycle', account=ident, level=WARNING, event='afk_start_failed')
 
                                
     state['is_farming'] = True
-    for fn in (sse_loop, heartbeat_loop, stats_loop, token_refresh_loop):
-        threading.Thread(target=fn, daemon=True).start()
+    stop = state['stop_event']
+    threading.Thread(target=sse_loop, daemon=True).start()
+    scheduler.every(30,   heartbeat_tick,     stop, first=0, name=f'altare.heartbeat:{ident}')
+    altare_balances.subscribe(ident, tenant_id, lambda: altare_tokens.current(ident), on_balance, stop)
 
                                           
-    while alive():
-        time.sleep(1)
+    stop.wait()
 
              
     state['is_farming'] = False
     afk_stop()
 
                                                                                 
+RECONNECT_BASE    = float(os.environ.get('AFK_RECONNECT_BASE', 5))
+RECONNECT_CAP     = float(os.environ.get('AFK_RECONNECT_CAP', 300))
+RECONNECT_STABLE  = 60
+RECYCLE_SPREAD    = float(os.environ.get('AFK_RECYCLE_SPREAD', 0.5))
+RECYCLE_INTERVALS = {tool: float(os.environ.get(f'AFK_RECYCLE_{tool.upper()}', secs))
+                     for tool, secs in (('hyperhub', 300), ('overnode', 0))}
+BREAKER_THRESHOLD = int(os.environ.get('AFK_BREAKER_THRESHOLD', 20))
+BREAKER_WINDOW    = 60
+BREAKER_COOLDOWN  = float(os.environ.get('AFK_BREAKER_COOLDOWN', 30))
+
+class CircuitBreaker:
+    """
+    Theo dõi số lần mất kết nối tới một host trong BREAKER_WINDOW giây. Vượt ngưỡng thì
+    mở mạch: mọi account của host chờ hết cooldown (rải đều trong một cooldown nữa) rồi
+    mới thử lại. Lần thử đầu sau cooldown vẫn lỗi → mở lại với cooldown gấp đôi.
+    """
+
+    def __init__(self, tool, host, threshold=BREAKER_THRESHOLD, window=BREAKER_WINDOW, cooldown=BREAKER_COOLDOWN):
+        self.tool       = tool
+        self.host       = host
+        self.threshold  = threshold
+        self.window     = window
+        self.cooldown   = cooldown
+        self._lock      = threading.Lock()
+        self._recent    = deque()
+        self._open_for  = cooldown
+        self.open_until = 0.0
+        self.total      = 0
+        self.opened     = 0
+
+    def failure(self):
+        now = time.monotonic()
+        with self._lock:
+            self.total += 1
+            self._recent.append(now)
+            while self._recent and self._recent[0] < now - self.window:
+                self._recent.popleft()
+            half_open = self.open_until and now >= self.open_until
+            tripped   = half_open or (now >= self.open_until and len(self._recent) >= self.threshold)
+            if tripped:
+                self._open_for  = min(self._open_for * 2, RECONNECT_CAP) if half_open else self.cooldown
+                self.open_until = now + self._open_for
+                self.opened    += 1
+                self._recent.clear()
+        if tripped:
+            add_log(self.tool, 'Circuit mở cho {host} — tạm dừng reconnect {cooldown}s', level=WARNING,
+                    event='circuit', host=self.host, cooldown=round(self._open_for))
+
+    def success(self):
+        with self._lock:
+            self.open_until = 0.0
+            self._open_for  = self.cooldown
+
+    def remaining(self):
+        return max(0.0, self.open_until - time.monotonic())
+
+    def snapshot(self):
+        now = time.monotonic()
+        with self._lock:
+            recent = sum(1 for t in self._recent if t >= now - self.window)
+        return {'reconnects_total': self.total, 'reconnects_per_min': round(recent * 60 / self.window, 1),
+                'state': 'open' if self.remaining() else 'half_open' if self.open_until else 'closed',
+                'open_for': round(self.remaining(), 1), 'opened': self.opened}
+
+_breakers      = {}
+_breakers_lock = threading.Lock()
+
+def circuit(tool, host):
+    b = _breakers.get(host)
+    if b is None:
+        with _breakers_lock:
+            b = _breakers.setdefault(host, CircuitBreaker(tool, host))
+    return b
+
+class ReconnectPolicy:
+    """
+    Backoff "decorrelated jitter": delay = min(cap, uniform(base, delay_trước * 3)), về lại
+    base khi kết nối trụ được RECONNECT_STABLE giây — các account không reconnect cùng nhịp.
+    Thêm circuit breaker theo host và thời điểm recycle được rải ±RECYCLE_SPREAD.
+    """
+
+    def __init__(self, tool, host, account=None, base=RECONNECT_BASE, cap=RECONNECT_CAP):
+        self.tool          = tool
+        self.account       = account
+        self.breaker       = circuit(tool, host)
+        self.base          = base
+        self.cap           = cap
+        self._delay        = base
+        self._connected_at = None
+
+    def connected(self):
+        self._connected_at = time.monotonic()
+        self.breaker.success()
+        WS_CONNECTS.inc(self.tool)
+        if recorder is not None:
+            recorder.ws_open(self.tool, self.account)
+
+    def closed(self, code):
+        WS_CLOSES.inc(self.tool, str(code) if code else 'none')
+        if recorder is not None:
+            recorder.ws_close(self.tool, self.account, code)
+
+    def next_delay(self, floor=0):
+        """Gọi sau mỗi lần rớt kết nối ngoài ý muốn; floor = delay tối thiểu (vd. 4002)"""
+        if self._connected_at is not None and time.monotonic() - self._connected_at >= RECONNECT_STABLE:
+            self._delay = self.base
+        self._connected_at = None
+        self._delay = min(self.cap, random.uniform(self.base, self._delay * 3))
+        self.breaker.failure()
+        wait = self.breaker.remaining()
+        if wait:
+            return wait + random.uniform(0, self.breaker._open_for)
+        return max(self._delay, floor)
+
+    def after_recycle(self):
+        """Recycle chủ động không phải lỗi — chỉ chờ ngắn có jitter"""
+        self._connected_at = None
+        return random.uniform(1, self.base)
+
+    def recycle_after(self):
+        """Giây tới lần recycle kế tiếp của kết nối này, None nếu tắt recycle"""
+        interval = RECYCLE_INTERVALS.get(self.tool, 0)
+        if interval <= 0:
+            return None
+        return interval * random.uniform(1 - RECYCLE_SPREAD, 1 + RECYCLE_SPREAD)
+
+def reconnect_stats():
+    return {host: b.snapshot() for host, b in list(_breakers.items())}
+
+                                                                                
                                                  
                                                            
                                                     
@@ -1257,47 +3836,43 @@ def hyperhub_worker(account, state):
     ident    = account['email']
     password = account['password']
 
-    BASE_URL   = 'https://hyper-hub.nl'
-    WS_URL     = 'wss://hyper-hub.nl/ws'
-    USER_AGENT = ('Mozilla/5.0 (Windows NT 10.0; Win64; x64) '
-                  'AppleWebKit/537.36 (KHTML, like Gecko) '
-                  'Chrome/120.0.0.0 Safari/537.36')
+    BASE_URL   = HYPERHUB_URL
+    WS_URL     = HYPERHUB_WS
+    USER_AGENT = HYPERHUB_UA
 
     pass                
 
-    session     = requests.Session()
+    http        = http_pool('hyperhub')
     cookies_str = ''
+    policy      = ReconnectPolicy('hyperhub', HYPERHUB_HOST, ident)
 
     def sleep_interruptible(secs):
-        for _ in range(secs):
-            if not state['running'] or state['stop_event'].is_set():
-                return False
-            time.sleep(1)
-        return True
+        return wait_stopped(state, secs)
 
     def do_login():
-        nonlocal cookies_str, session
-        session = requests.Session()
+        nonlocal cookies_str
         try:
-            r = session.post(
+            r = http.post(
                 f'{BASE_URL}/auth/login',
                 json={'email': ident, 'password': password},
                 headers={'User-Agent': USER_AGENT, 'Content-Type': 'application/json'},
                 timeout=15, verify=False,
             )
             if r.status_code == 200:
-                cookies_str = '; '.join(f'{c.name}={c.value}' for c in session.cookies)
-                add_log('hyperhub', f'[{ident}] Login successful ✓')
+                cookies_str = '; '.join(f'{c.name}={c.value}' for c in r.cookies)
+                add_log('hyperhub', 'Login successful ✓', account=ident, event='login')
                 return True
-            add_log('hyperhub', f'[{ident}] Login failed — HTTP {r.status_code}')
+            add_log('hyperhub', 'Login failed — HTTP {status}', account=ident, level=WARNING,
+                    event='login_failed', status=r.status_code)
         except Exception as e:
-            add_log('hyperhub', f'[{ident}] Login error: {e}')
+            add_log('hyperhub', 'Login error: {error}', account=ident, level=ERROR, event='login_failed', error=str(e))
         cookies_str = ''
         return False
 
     def get_balance():
         try:
-            r = session.get(f'{BASE_URL}/wallet/balance', timeout=10, verify=False)
+            r = http.get(f'{BASE_URL}/wallet/balance', timeout=10, verify=False,
+                         headers={'User-Agent': USER_AGENT, 'Cookie': cookies_str})
             if r.status_code == 200:
                 return float(r.json().get('XPL', 0.0))
         except Exception:
@@ -1308,6 +3883,7 @@ def hyperhub_worker(account, state):
     if not do_login():
         if not sleep_interruptible(60):
             return
+    balance_reconciler.register('hyperhub', ident, get_balance, state)
 
                                                                                
     while state['running'] and not state['stop_event'].is_set():
@@ -1321,30 +3897,30 @@ def hyperhub_worker(account, state):
         close_info = {'code': None, 'conflict': False, 'expired': False}
 
         def on_open(ws):
-            pass           
+            if state['stop_event'].is_set():
+                ws.close()
+                return
+            state['connection'] = 'connected'
+            policy.connected()
 
-        last_nri  = [99999]  # Khởi tạo cao để detection đầu tiên hoạt động
-        last_bal  = [state.get('balance', 0.0)]
+        state.last_nri = 99999  # Khởi tạo cao để detection đầu tiên hoạt động
 
         def on_message(ws, raw):
             try:
-                data = json.loads(raw)
-                if data.get('type') == 'afk_state':
-                    cpm = data.get('coinsPerMinute', 0)
-                    nri = data.get('nextRewardIn', 0)
+                if recorder is not None:
+                    recorder.ws_frame('hyperhub', ident, raw)
+                frame = decode_afk_frame(raw)
+                if frame is not None:
+                    cpm, nri = frame
                     state['coins_per_min'] = cpm
 
                                                                
-                    if last_nri[0] is not None and last_nri[0] <= 3000 and nri > 5000:
-                        bal = get_balance()
-                        if bal is not None:
-                            state['balance'] = bal
-                            if bal > last_bal[0]:
-                                inc = round(bal - last_bal[0], 2)
-                                add_log('hyperhub', f'[{ident}] +{inc} XPL | Balance: {bal}')
-                            last_bal[0] = bal
-
-                    last_nri[0] = nri
+                    if hyperhub_reward_cycle(state.last_nri, nri):
+                        inc, bal = balance_reconciler.credit(state, cpm, nri)
+                        add_log('hyperhub', '+{delta} XPL | Balance: {balance}', account=ident, event='reward',
+                                balance=bal, delta=inc)
+
+                    state.last_nri = nri
             except Exception:
                 pass
 
@@ -1370,9 +3946,10 @@ def hyperhub_worker(account, state):
                 close_info['conflict'] = True
                 pass        
             else:
-                add_log('hyperhub', f'[{ident}] WS error: {err}')
+                add_log('hyperhub', 'WS error: {error}', account=ident, level=ERROR, event='ws_error', error=str(err))
 
         def on_close(ws, code, msg):
+            close_info['code'] = close_info['code'] or code
             if code == 4002: close_info['conflict'] = True
             elif code == 4001: close_info['expired'] = True
             pass            
@@ -1385,8 +3962,16 @@ def hyperhub_worker(account, state):
         )
 
                                                      
-        recycle_timer = threading.Timer(300, ws_app.close)
-        recycle_timer.daemon = True
+        recycled = [False]
+
+        def recycle():
+            recycled[0] = True
+            ws_app.close()
+
+        recycle_in    = policy.recycle_after()
+        recycle_timer = recycle_in and scheduler.call_later(recycle_in, recycle, state['stop_event'],
+                                                            name=f'hyperhub.recycle:{ident}')
+        state['stop_event'].add_callback(ws_app.close)
 
         wst = threading.Thread(
             target=ws_app.run_forever,
@@ -1394,71 +3979,60 @@ def hyperhub_worker(account, state):
             daemon=True,
         )
         wst.start()
-        recycle_timer.start()
-
-                                                                     
-        bal = get_balance()
-        if bal is not None:
-            state['balance'] = bal
-            last_bal[0] = bal  # sync để lần đầu reward không tính từ 0
 
                                                                                
-        while wst.is_alive() and state['running'] and not state['stop_event'].is_set():
-            time.sleep(1)
+        wst.join()
+        state['connection'] = 'disconnected'
+        policy.closed(close_info['code'])
 
-        recycle_timer.cancel()
+        if recycle_timer:
+            recycle_timer.cancel()
+        state['stop_event'].remove_callback(ws_app.close)
         ws_app.close()
 
         if not state['running'] or state['stop_event'].is_set():
             break
 
                                                                               
-        if close_info['conflict']:
+        if recycled[0] and not close_info['conflict'] and not close_info['expired']:
+            delay = policy.after_recycle()
+        elif close_info['conflict']:
                                                               
                                                                           
                                                                             
-            pass              
-            if not sleep_interruptible(8):
-                break
-        elif close_info['expired']:
-            pass                   
-            cookies_str = ''
-            if not sleep_interruptible(5):
-                break
+            delay = policy.next_delay(floor=8)
         else:
-                                 
-            if not sleep_interruptible(5):
-                break
+            if close_info['expired']:
+                cookies_str = ''
+            delay = policy.next_delay()
+        if not sleep_interruptible(delay):
+            break
 
                                                                                  
 def overnode_worker(account, state):
     ident  = account['email']
     cookie = account['cookie']
-    HOST   = 'console.overnode.fr'
-    WS_URL = f'wss://{HOST}/api/afk/ws'
-    ORIGIN = f'https://{HOST}'
+    HOST   = OVERNODE_HOST
+    WS_URL = OVERNODE_WS
+    ORIGIN = OVERNODE_URL
 
-    http_session = requests.Session()
-    http_session.headers.update({
-        'User-Agent':      'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/124.0.0.0 Safari/537.36',
+    http         = http_pool('overnode')
+    rest_headers = {
+        'User-Agent':      OVERNODE_UA,
         'Accept':          'application/json',
         'Accept-Language': 'vi-VN,vi;q=0.9,en-US;q=0.8,en;q=0.7',
         'Referer':         f'{ORIGIN}/wallet',
         'Origin':          ORIGIN,
         'Cookie':          cookie,
-    })
-    for part in cookie.split(';'):
-        if '=' in part:
-            k, v = part.strip().split('=', 1)
-            http_session.cookies.set(k, v)
+    }
 
-    initial_balance  = [None]
-    last_nri         = [None]   # lastNextRewardIn (ms) — dùng detect reward giống source gốc
-    total_earned     = [0.0]
+    state.last_nri   = None   # lastNextRewardIn (ms) — dùng detect reward giống source gốc
+    state.earned     = 0.0
+    policy           = ReconnectPolicy('overnode', HOST, ident)
 
     def get_balance():
         try:
-            r = http_session.get(f'https://{HOST}/api/wallet/balance', timeout=10, verify=False)
+            r = http.get(f'{ORIGIN}/api/wallet/balance', headers=rest_headers, timeout=10, verify=False)
             if r.status_code == 200:
                 return float(r.json().get('balance', 0.0))
         except Exception:
@@ -1466,65 +4040,61 @@ def overnode_worker(account, state):
         return None
 
     def on_open(ws):
-        add_log('overnode', f'[{ident}] WS connected 🟢')
-        bal = get_balance()
-        if bal is not None:
-            initial_balance[0] = bal
-            state['balance']   = bal
-            add_log('overnode', f'[{ident}] Balance: {bal} coins')
+        if state['stop_event'].is_set():
+            ws.close()
+            return
+        state['connection'] = 'connected'
+        policy.connected()
+        add_log('overnode', 'WS connected 🟢', account=ident, event='connected')
 
     def on_message(ws, message):
         try:
-            data = json.loads(message)
-            if data.get('type') != 'afk_state':
+            if recorder is not None:
+                recorder.ws_frame('overnode', ident, message)
+            frame = decode_afk_frame(message)
+            if frame is None:
                 return
 
-            cpm = data.get('coinsPerMinute', 0)
-            nri = data.get('nextRewardIn', 0)   # milliseconds đến reward kế tiếp
+            cpm, nri = frame   # nri: milliseconds đến reward kế tiếp
 
             # ─ Detect reward: nextRewardIn tăng đột biến (reset sau khi phát thưởng)
             # Logic y hệt source JS gốc:
             #   if (lastNextRewardIn !== null && nextRewardIn > lastNextRewardIn + 5000)
-            if last_nri[0] is not None and nri > last_nri[0] + 5000:
-                total_earned[0] = round(total_earned[0] + cpm, 4)
-                # Lấy balance thực sau mỗi reward
-                bal = get_balance()
-                if bal is not None:
-                    state['balance'] = bal
-                    if initial_balance[0] is None:
-                        initial_balance[0] = bal
-                    gained = round(bal - initial_balance[0], 4)
-                    add_log('overnode', f'[{ident}] +{cpm} coins | Balance: {bal} | Total earned: {total_earned[0]}')
-                else:
-                    add_log('overnode', f'[{ident}] +{cpm} coins/min | Total earned: {total_earned[0]}')
-
-            last_nri[0] = nri
+            if overnode_reward_cycle(state.last_nri, nri):
+                # Balance cộng tại chỗ, balance_reconciler đọc số thật theo lô
+                inc, bal = balance_reconciler.credit(state, cpm, nri)
+                state.earned = round(state.earned + inc, 4)
+                add_log('overnode', '+{delta} coins | Balance: {balance} | Total earned: {total}', account=ident,
+                        event='reward', balance=bal, delta=inc, total=state.earned)
+
+            state.last_nri = nri
         except Exception:
             pass
 
     close_code = [None]
+    balance_reconciler.register('overnode', ident, get_balance, state)
 
     def on_error(ws, error):
-        add_log('overnode', f'[{ident}] WS error: {error}')
+        add_log('overnode', 'WS error: {error}', account=ident, level=ERROR, event='ws_error', error=str(error))
 
     def on_close(ws, code, reason):
         close_code[0] = code
-        add_log('overnode', f'[{ident}] WS closed (code={code})')
+        state['connection'] = 'disconnected'
+        policy.closed(code)
+        add_log('overnode', 'WS closed (code={code})', account=ident, event='disconnected', code=code)
 
     while state['running'] and not state['stop_event'].is_set():
-        close_code[0] = None
-        last_nri[0]   = None
+        close_code[0]  = None
+        state.last_nri = None
 
         ws_headers = {
-            'Host':                     HOST,
             'Origin':                   ORIGIN,
             'Referer':                  f'{ORIGIN}/afk',
             'Cookie':                   cookie,
-            'User-Agent':               'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/124.0.0.0 Safari/537.36',
+            'User-Agent':               OVERNODE_UA,
             'Accept-Language':          'vi-VN,vi;q=0.9,en-US;q=0.8,en;q=0.7',
             'Pragma':                   'no-cache',
             'Cache-Control':            'no-cache',
-            'Sec-WebSocket-Version':    '13',
             'Sec-Fetch-Dest':           'websocket',
             'Sec-Fetch-Mode':           'websocket',
             'Sec-Fetch-Site':           'same-origin',
@@ -1535,51 +4105,1637 @@ def overnode_worker(account, state):
             header=ws_headers,
             on_open=on_open, on_message=on_message, on_error=on_error, on_close=on_close,
         )
+        state['stop_event'].add_callback(ws_app.close)
+        recycled = [False]
+
+        def recycle():
+            recycled[0] = True
+            ws_app.close()
+
+        recycle_in    = policy.recycle_after()
+        recycle_timer = recycle_in and scheduler.call_later(recycle_in, recycle, state['stop_event'],
+                                                            name=f'overnode.recycle:{ident}')
         wst = threading.Thread(
             target=ws_app.run_forever,
             kwargs={'sslopt': {'cert_reqs': ssl.CERT_NONE}, 'ping_interval': 30, 'ping_timeout': 10},
             daemon=True,
         )
         wst.start()
+        wst.join()
 
-        while wst.is_alive() and state['running'] and not state['stop_event'].is_set():
-            time.sleep(1)
-
+        if recycle_timer:
+            recycle_timer.cancel()
+        state['stop_event'].remove_callback(ws_app.close)
         ws_app.close()
         if not state['running'] or state['stop_event'].is_set():
             break
 
         code = close_code[0]
         if code == 4001:
-            add_log('overnode', f'[{ident}] Session hết hạn (4001) — cần cookie mới')
+            add_log('overnode', 'Session hết hạn (4001) — cần cookie mới', account=ident, level=ERROR,
+                    event='session_expired', code=4001)
             break
         elif code == 4003:
-            add_log('overnode', f'[{ident}] Server suspended (4003)')
+            add_log('overnode', 'Server suspended (4003)', account=ident, level=ERROR, event='suspended', code=4003)
             break
         elif code == 4002:
-            add_log('overnode', f'[{ident}] Session trùng (4002) — reconnect sau 15s...')
-            for _ in range(15):
-                if not state['running'] or state['stop_event'].is_set(): break
-                time.sleep(1)
+            delay = policy.next_delay(floor=15)
+            add_log('overnode', 'Session trùng (4002) — reconnect sau {delay}s...', account=ident, level=WARNING,
+                    event='conflict', code=4002, delay=round(delay))
+            wait_stopped(state, delay)
+        elif recycled[0]:
+            wait_stopped(state, policy.after_recycle())
         else:
-            add_log('overnode', f'[{ident}] Reconnecting in 10s...')
-            for _ in range(10):
-                if not state['running'] or state['stop_event'].is_set(): break
-                time.sleep(1)
+            delay = policy.next_delay()
+            add_log('overnode', 'Reconnecting in {delay}s...', account=ident, event='reconnect', delay=round(delay))
+            wait_stopped(state, delay)
 
                                                                                 
-def start_afk_services():
+AFK_ENGINE = os.environ.get('AFK_ENGINE', 'thread').strip().lower()
+
+class AsyncEngine:
+    """
+    Chạy toàn bộ worker dưới dạng coroutine trên MỘT event loop (thread riêng).
+    Mỗi platform dùng chung một aiohttp.ClientSession → connection pool chung,
+    cookie/token được gắn theo từng request nên bộ nhớ mỗi account gần như cố định.
+    """
+
+    def __init__(self):
+        self.loop     = asyncio.new_event_loop()
+        self.sessions = {}
+        self._ready   = threading.Event()
+        self._thread  = threading.Thread(target=self._run, name='afk-asyncio', daemon=True)
+        self._thread.start()
+        self._ready.wait()
+
+    def _run(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_until_complete(self._open_sessions())
+        self._ready.set()
+        self.loop.run_forever()
+
+    async def _open_sessions(self):
+        for tool in ('hyperhub', 'altare', 'overnode'):
+            self.sessions[tool] = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=0, ttl_dns_cache=300,
+                                               keepalive_timeout=HTTP_KEEPALIVE),
+                cookie_jar=aiohttp.DummyCookieJar(),
+                trace_configs=[self._trace(tool)],
+            )
+
+    @staticmethod
+    def _trace(tool):
+        """Đo latency upstream giống PooledAdapter.send cho request đi qua aiohttp"""
+        trace = aiohttp.TraceConfig()
+
+        async def on_start(session, ctx, params):
+            ctx.t0 = time.monotonic()
+
+        async def on_end(session, ctx, params):
+            elapsed = time.monotonic() - ctx.t0
+            observe_upstream(tool, params.url.path, params.response.status, elapsed)
+            if recorder is not None:
+                # body aiohttp chưa đọc ở đây — chỉ ghi status và latency
+                recorder.http(tool, params.method, params.url.path, params.response.status, elapsed)
+
+        async def on_error(session, ctx, params):
+            observe_upstream(tool, params.url.path, 'error', time.monotonic() - ctx.t0)
+
+        trace.on_request_start.append(on_start)
+        trace.on_request_end.append(on_end)
+        trace.on_request_exception.append(on_error)
+        return trace
+
+    def start(self, tool, acc, state):
+        worker = ASYNC_WORKERS[tool]
+        state['task'] = asyncio.run_coroutine_threadsafe(
+            self._supervise(tool, worker(acc, state, self.sessions[tool]), state), self.loop)
+        state['stop_event'].add_callback(lambda: self.stop(state))
+
+    def stop(self, state):
+        task = state.pop('task', None)
+        if task is not None:
+            task.cancel()
+
+    async def _supervise(self, tool, coro, state):
+        try:
+            await coro
+        except asyncio.CancelledError:
+            return
+        except Exception as e:
+            add_log(tool, 'Async worker crashed: {error}', level=ERROR, event='error', error=str(e))
+        finally:
+            state.done.set()
+        state['running'] = False
+
+    def shutdown(self, timeout=5):
+        async def _close():
+            for task in asyncio.all_tasks():
+                if task is not asyncio.current_task():
+                    task.cancel()
+            await asyncio.sleep(0.5)
+            for s in self.sessions.values():
+                await s.close()
+        try:
+            asyncio.run_coroutine_threadsafe(_close(), self.loop).result(timeout)
+        except Exception:
+            pass
+        self.loop.call_soon_threadsafe(self.loop.stop)
+
+_engine      = None
+_engine_lock = threading.Lock()
+
+def get_engine():
+    """AFK_ENGINE=asyncio → AsyncEngine, ngược lại None (thread-per-account)"""
+    global _engine, AFK_ENGINE
+    if AFK_ENGINE != 'asyncio':
+        return None
+    with _engine_lock:
+        if _engine is None:
+            if aiohttp is None:
+                print('[WARN] AFK_ENGINE=asyncio requires aiohttp — falling back to threads')
+                AFK_ENGINE = 'thread'
+                return None
+            _engine = AsyncEngine()
+    return _engine
+
+async def _async_sleep(state, secs):
+    """Giống sleep_interruptible: False nếu account đã bị dừng"""
+    await asyncio.sleep(secs)
+    return state['running'] and not state['stop_event'].is_set()
+
+async def altare_worker_async(account, state, http):
+    ident     = account['email']
+    password  = account.get('password', '')
+    tenant_id = account.get('tenant_id', '')
+    base      = f'{ALTARE_API}/api/tenants/{tenant_id}/rewards/afk'
+    timeout   = aiohttp.ClientTimeout(total=10)
+
+    def headers(token=None):
+        return make_altare_headers(altare_tokens.current(ident) if token is None else token, tenant_id)
+
+    def alive():
+        return state['running'] and not state['stop_event'].is_set()
+
+    async def refresh_token(stale):
+        return await asyncio.get_running_loop().run_in_executor(None, altare_tokens.refresh, ident, stale)
+
+    async def post(url):
+        token = altare_tokens.current(ident)
+        async with http.post(url, headers=headers(token), json={}, timeout=timeout) as r:
+            status = r.status
+        if status == 401 and await refresh_token(token) != token:
+            async with http.post(url, headers=headers(), json={}, timeout=timeout) as r:
+                status = r.status
+        return status
+
+    async def afk_stop():
+        try:
+            await post(f'{base}/stop')
+        except Exception:
+            pass
+
+    async def afk_start(retries=3):
+        for _ in range(retries):
+            try:
+                if await post(f'{base}/start') in (200, 201, 204):
+                    return True
+            except Exception:
+                pass
+            await afk_stop()
+            await asyncio.sleep(5)
+        return False
+
+    async def sse_loop():
+        first = True
+        sse   = SSEClient('altare', ident)
+        while alive() and state.get('is_farming', True):
+            try:
+                token = altare_tokens.current(ident)
+                raw   = token.replace('Bearer ', '')
+                idle  = sse.idle_timeout
+                async with http.get(f'{ALTARE_API}/subscribe', params={'token': raw}, headers=sse.headers(headers(token)),
+                                    timeout=aiohttp.ClientTimeout(total=None, sock_connect=10, sock_read=idle)) as r:
+                    if r.status == 200:
+                        state['connection'] = 'connected'
+                        if first:
+                            add_log('altare', 'SSE stream connected ✓', account=ident, event='connected')
+                            first = False
+                        async for _ in sse.aread(r):
+                            if not alive() or not state.get('is_farming', True):
+                                break
+                    else:
+                        first = True
+                        if r.status == 401:
+                            await refresh_token(token)
+                        await asyncio.sleep(10)
+            except asyncio.CancelledError:
+                raise
+            except asyncio.TimeoutError:
+                if log_enabled(DEBUG):
+                    add_log('altare', 'SSE idle {idle}s — reconnecting', account=ident, level=DEBUG,
+                            event='sse_idle', idle=round(idle))
+            except Exception:
+                first = True
+                await asyncio.sleep(10)
+            state['connection'] = 'disconnected'
+            await asyncio.sleep(sse.retry_delay)
+
+    async def heartbeat_loop():
+        while alive():
+            if state.get('is_farming', True):
+                try:
+                    await post(f'{base}/heartbeat')
+                except Exception:
+                    pass
+            await asyncio.sleep(30)
+
+    loop  = asyncio.get_running_loop()
+    stats = {'credits_start': None, 'last_balance': None, 'stuck_count': 0}
+
+    def on_balance(bal):
+        if not alive() or not state.get('is_farming', True):
+            return
+        state['balance'] = bal
+        if stats['credits_start'] is None:
+            stats['credits_start'] = bal
+        earned = round(bal - stats['credits_start'], 4)
+        if bal != stats['last_balance']:
+            if stats['last_balance'] is not None:
+                REWARD_EVENTS.inc('altare')
+            add_log('altare', '+{delta:g} CR | Balance: {balance:g}', account=ident, event='balance',
+                    balance=bal, delta=earned)
+            stats['stuck_count']  = 0
+            stats['last_balance'] = bal
+            return
+        stats['stuck_count'] += 1
+        if stats['stuck_count'] >= 3:
+            add_log('altare', 'Balance stuck {count}x — resetting AFK...', account=ident, level=WARNING,
+                    event='stuck', count=stats['stuck_count'])
+            state['is_farming'] = False
+            resets.append(asyncio.ensure_future(reset_afk(bal)))
+
+    async def reset_afk(bal):
+        await afk_stop()
+        await asyncio.sleep(5)
+        if await afk_start():
+            stats['stuck_count']   = 0
+            stats['credits_start'] = bal
+        else:
+            add_log('altare', 'Reset failed, retrying next cycle', account=ident, level=WARNING, event='afk_start_failed')
+        state['is_farming'] = True
+
+    if not tenant_id:
+        add_log('altare', 'Missing tenant_id — aborting', account=ident, level=ERROR, event='error')
+        state['running'] = False
+        return
+
+    altare_tokens.track(ident, password, account.get('token', ''), state['stop_event'])
+    await afk_stop()
+    await asyncio.sleep(0.5)
+    if await afk_start():
+        add_log('altare', 'AFK started ✓', account=ident, event='afk_start')
+    else:
+        add_log('altare', 'AFK start failed', account=ident, level=WARNING, event='afk_start_failed')
+
+    state['is_farming'] = True
+    loops  = [asyncio.ensure_future(fn()) for fn in (sse_loop, heartbeat_loop)]
+    resets = []
+    altare_balances.subscribe(ident, tenant_id, lambda: altare_tokens.current(ident),
+                              lambda bal: loop.call_soon_threadsafe(on_balance, bal),
+                              state['stop_event'])
+    try:
+        await asyncio.gather(*loops)
+    finally:
+        for t in loops + resets:
+            t.cancel()
+        state['is_farming'] = False
+        await afk_stop()
+
+async def hyperhub_worker_async(account, state, http):
+    ident    = account['email']
+    password = account['password']
+    timeout  = aiohttp.ClientTimeout(total=15)
+    cookies  = ''
+    policy   = ReconnectPolicy('hyperhub', HYPERHUB_HOST, ident)
+
+    def alive():
+        return state['running'] and not state['stop_event'].is_set()
+
+    async def do_login():
+        nonlocal cookies
+        try:
+            async with http.post(f'{HYPERHUB_URL}/auth/login', json={'email': ident, 'password': password},
+                                 headers={'User-Agent': HYPERHUB_UA}, ssl=False, timeout=timeout) as r:
+                if r.status == 200:
+                    cookies = '; '.join(f'{k}={m.value}' for k, m in r.cookies.items())
+                    add_log('hyperhub', 'Login successful ✓', account=ident, event='login')
+                    return True
+                add_log('hyperhub', 'Login failed — HTTP {status}', account=ident, level=WARNING,
+                        event='login_failed', status=r.status)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            add_log('hyperhub', 'Login error: {error}', account=ident, level=ERROR, event='login_failed', error=str(e))
+        cookies = ''
+        return False
+
+    async def get_balance():
+        try:
+            async with http.get(f'{HYPERHUB_URL}/wallet/balance', ssl=False, timeout=timeout,
+                                headers={'User-Agent': HYPERHUB_UA, 'Cookie': cookies}) as r:
+                if r.status == 200:
+                    return float((await r.json(content_type=None)).get('XPL', 0.0))
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            pass
+        return None
+
+    if not await do_login():
+        if not await _async_sleep(state, 60):
+            return
+    loop = asyncio.get_running_loop()
+    balance_reconciler.register('hyperhub', ident,
+                                lambda: asyncio.run_coroutine_threadsafe(get_balance(), loop).result(30), state)
+
+    while alive():
+        if not cookies:
+            if not await do_login():
+                if not await _async_sleep(state, 60):
+                    break
+                continue
+
+        code     = None
+        recycled = False
+        state.last_nri = 99999
+        try:
+            async with http.ws_connect(HYPERHUB_WS, ssl=False, heartbeat=30,
+                                       headers={'User-Agent': HYPERHUB_UA, 'Cookie': cookies,
+                                                'Origin': 'https://hyper-hub.nl/'}) as ws:
+                state['connection'] = 'connected'
+                policy.connected()
+                recycle_in = policy.recycle_after()
+                recycle_at = time.monotonic() + recycle_in if recycle_in else None
+                while alive():
+                    remaining = recycle_at - time.monotonic() if recycle_at else None
+                    if remaining is not None and remaining <= 0:
+                        recycled = True
+                        break
+                    try:
+                        msg = await ws.receive(timeout=remaining)
+                    except asyncio.TimeoutError:
+                        recycled = True
+                        break
+                    if msg.type != aiohttp.WSMsgType.TEXT:
+                        if msg.type in (aiohttp.WSMsgType.CLOSE, aiohttp.WSMsgType.CLOSING,
+                                        aiohttp.WSMsgType.CLOSED, aiohttp.WSMsgType.ERROR):
+                            break
+                        continue
+                    if recorder is not None:
+                        recorder.ws_frame('hyperhub', ident, msg.data)
+                    frame = decode_afk_frame(msg.data)
+                    if frame is None:
+                        continue
+                    state['coins_per_min'], nri = frame
+                    if hyperhub_reward_cycle(state.last_nri, nri):
+                        inc, bal = balance_reconciler.credit(state, state['coins_per_min'], nri)
+                        add_log('hyperhub', '+{delta} XPL | Balance: {balance}', account=ident, event='reward',
+                                balance=bal, delta=inc)
+                    state.last_nri = nri
+                code = ws.close_code
+        except asyncio.CancelledError:
+            raise
+        except aiohttp.WSServerHandshakeError as e:
+            add_log('hyperhub', 'WS error: {error}', account=ident, level=ERROR, event='ws_error', error=str(e))
+        except Exception as e:
+            if 'already connected' in str(e).lower():
+                code = 4002
+            else:
+                add_log('hyperhub', 'WS error: {error}', account=ident, level=ERROR, event='ws_error', error=str(e))
+        state['connection'] = 'disconnected'
+        policy.closed(code)
+
+        if not alive():
+            break
+        if code == 4002:
+            delay = policy.next_delay(floor=8)
+        elif recycled:
+            delay = policy.after_recycle()
+        else:
+            if code == 4001:
+                cookies = ''
+            delay = policy.next_delay()
+        if not await _async_sleep(state, delay):
+            break
+
+async def overnode_worker_async(account, state, http):
+    ident  = account['email']
+    cookie = account['cookie']
+    origin = OVERNODE_URL
+    base_headers = {
+        'User-Agent':      OVERNODE_UA,
+        'Accept-Language': 'vi-VN,vi;q=0.9,en-US;q=0.8,en;q=0.7',
+        'Origin':          origin,
+        'Cookie':          cookie,
+    }
+    state.earned    = 0.0
+    policy          = ReconnectPolicy('overnode', OVERNODE_HOST, ident)
+
+    def alive():
+        return state['running'] and not state['stop_event'].is_set()
+
+    async def get_balance():
+        try:
+            async with http.get(f'{origin}/api/wallet/balance', ssl=False,
+                                timeout=aiohttp.ClientTimeout(total=10),
+                                headers={**base_headers, 'Accept': 'application/json',
+                                         'Referer': f'{origin}/wallet'}) as r:
+                if r.status == 200:
+                    return float((await r.json(content_type=None)).get('balance', 0.0))
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            pass
+        return None
+
+    loop = asyncio.get_running_loop()
+    balance_reconciler.register('overnode', ident,
+                                lambda: asyncio.run_coroutine_threadsafe(get_balance(), loop).result(30), state)
+
+    while alive():
+        code     = None
+        state.last_nri = None
+        try:
+            async with http.ws_connect(OVERNODE_WS, ssl=False,
+                                       heartbeat=30, receive_timeout=None,
+                                       headers={**base_headers, 'Referer': f'{origin}/afk',
+                                                'Pragma': 'no-cache', 'Cache-Control': 'no-cache'}) as ws:
+                state['connection'] = 'connected'
+                policy.connected()
+                add_log('overnode', 'WS connected 🟢', account=ident, event='connected')
+                async for msg in ws:
+                    if not alive():
+                        break
+                    if msg.type != aiohttp.WSMsgType.TEXT:
+                        continue
+                    if recorder is not None:
+                        recorder.ws_frame('overnode', ident, msg.data)
+                    frame = decode_afk_frame(msg.data)
+                    if frame is None:
+                        continue
+                    cpm, nri = frame
+                    if overnode_reward_cycle(state.last_nri, nri):
+                        inc, bal = balance_reconciler.credit(state, cpm, nri)
+                        state.earned = round(state.earned + inc, 4)
+                        add_log('overnode', '+{delta} coins | Balance: {balance} | Total earned: {total}', account=ident,
+                                event='reward', balance=bal, delta=inc, total=state.earned)
+                    state.last_nri = nri
+                code = ws.close_code
+            add_log('overnode', 'WS closed (code={code})', account=ident, event='disconnected', code=code)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            add_log('overnode', 'WS error: {error}', account=ident, level=ERROR, event='ws_error', error=str(e))
+        state['connection'] = 'disconnected'
+        policy.closed(code)
+
+        if not alive():
+            break
+        if code == 4001:
+            add_log('overnode', 'Session hết hạn (4001) — cần cookie mới', account=ident, level=ERROR,
+                    event='session_expired', code=4001)
+            break
+        elif code == 4003:
+            add_log('overnode', 'Server suspended (4003)', account=ident, level=ERROR, event='suspended', code=4003)
+            break
+        elif code == 4002:
+            delay = policy.next_delay(floor=15)
+            add_log('overnode', 'Session trùng (4002) — reconnect sau {delay}s...', account=ident, level=WARNING,
+                    event='conflict', code=4002, delay=round(delay))
+            if not await _async_sleep(state, delay):
+                break
+        else:
+            delay = policy.next_delay()
+            add_log('overnode', 'Reconnecting in {delay}s...', account=ident, event='reconnect', delay=round(delay))
+            if not await _async_sleep(state, delay):
+                break
+
+ASYNC_WORKERS = {
+    'hyperhub': hyperhub_worker_async,
+    'altare':   altare_worker_async,
+    'overnode': overnode_worker_async,
+}
+
+                                                                                
+WS_REACTORS      = int(os.environ.get('AFK_WS_REACTORS', 2))
+WS_IO_WORKERS    = int(os.environ.get('AFK_WS_IO_WORKERS', 16))
+WS_PING_INTERVAL = 30
+WS_PING_TIMEOUT  = 10
+WS_RECV_CHUNK    = 65536
+
+OP_CONT, OP_TEXT, OP_BINARY, OP_CLOSE, OP_PING, OP_PONG = 0x0, 0x1, 0x2, 0x8, 0x9, 0xA
+WS_WOULD_BLOCK = (BlockingIOError, ssl.SSLWantReadError, ssl.SSLWantWriteError)
+
+class WSConn:
+    """
+    Một WebSocket đã handshake, do reactor quản lý. on_message/on_close chạy trên thread
+    reactor nên không được block — việc chậm (HTTP) đẩy sang pool.io.
+    """
+
+    __slots__ = ('reactor', 'sock', 'name', 'tool', 'on_message', 'on_close', 'inbuf', 'outbuf',
+                 'frag_op', 'frags', 'last_rx', 'last_ping', 'closed')
+
+    def __init__(self, reactor, sock, name, on_message, on_close, tool=None):
+        self.reactor    = reactor
+        self.sock       = sock
+        self.name       = name
+        self.tool       = tool
+        self.on_message = on_message
+        self.on_close   = on_close
+        self.inbuf      = bytearray()
+        self.outbuf     = bytearray()
+        self.frag_op    = OP_TEXT
+        self.frags      = []
+        self.last_rx    = time.monotonic()
+        self.last_ping  = self.last_rx
+        self.closed     = False
+
+    def start(self):
+        self.reactor.call_soon(self.reactor._register, self)
+
+    def send(self, text):
+        self.reactor.call_soon(self._send, OP_TEXT, text.encode('utf-8'))
+
+    def close(self, code=1000):
+        self.reactor.call_soon(self.reactor._close_local, self, code)
+
+    def _send(self, op, payload):
+        if self.closed:
+            return
+        self.outbuf += websocket.ABNF.create_frame(payload, op).format()
+        self._flush()
+
+    def _flush(self):
+        try:
+            while self.outbuf:
+                del self.outbuf[:self.sock.send(self.outbuf)]
+        except WS_WOULD_BLOCK:
+            pass
+        except OSError as e:
+            return self.reactor._drop(self, None, str(e))
+        self.reactor._want_write(self, bool(self.outbuf))
+
+    def _frames(self):
+        """Tách các frame hoàn chỉnh khỏi inbuf → [(fin, opcode, payload)]"""
+        buf, pos, frames = self.inbuf, 0, []
+        while len(buf) - pos >= 2:
+            b0, b1 = buf[pos], buf[pos + 1]
+            size, head = b1 & 0x7f, 2
+            if size == 126:
+                if len(buf) - pos < 4:
+                    break
+                size, head = int.from_bytes(buf[pos + 2:pos + 4], 'big'), 4
+            elif size == 127:
+                if len(buf) - pos < 10:
+                    break
+                size, head = int.from_bytes(buf[pos + 2:pos + 10], 'big'), 10
+            mask = None
+            if b1 & 0x80:
+                if len(buf) - pos < head + 4:
+                    break
+                mask, head = bytes(buf[pos + head:pos + head + 4]), head + 4
+            end = pos + head + size
+            if len(buf) < end:
+                break
+            payload = bytes(buf[pos + head:end])
+            if mask:
+                payload = bytes(b ^ mask[i & 3] for i, b in enumerate(payload))
+            frames.append((b0 & 0x80, b0 & 0x0f, payload))
+            pos = end
+        del buf[:pos]
+        return frames
+
+    def _dispatch(self):
+        for fin, op, payload in self._frames():
+            if op == OP_PING:
+                self._send(OP_PONG, payload)
+            elif op == OP_CLOSE:
+                code = int.from_bytes(payload[:2], 'big') if len(payload) >= 2 else None
+                return self.reactor._drop(self, code, payload[2:].decode('utf-8', 'replace'), reply=code or 1000)
+            elif op in (OP_TEXT, OP_BINARY, OP_CONT):
+                if op != OP_CONT:
+                    self.frag_op, self.frags = op, []
+                self.frags.append(payload)
+                if fin:
+                    data, self.frags = b''.join(self.frags), []
+                    try:
+                        self.on_message(data.decode('utf-8', 'replace') if self.frag_op == OP_TEXT else data)
+                    except Exception as e:
+                        _ws_error(self, 'on_message', e)
+            if self.closed:
+                return
+
+def _ws_error(conn, stage, e):
+    """Callback trên thread reactor lỗi → log theo tool/account của socket, không làm chết reactor"""
+    if conn.tool is None:
+        print(f"[{time.strftime('%H:%M:%S')}] [WS] {conn.name} {stage} failed: {e}")
+        return
+    add_log(conn.tool, 'WS {stage} failed: {error}', account=conn.name, level=ERROR,
+            event='ws_error', stage=stage, error=str(e))
+
+
+class WSReactor:
+    """
+    Một thread + selector (epoll trên Linux) phục vụ nhiều WebSocket cùng lúc: đọc frame,
+    trả pong, gửi ping định kỳ và đóng socket im lặng quá WS_PING_TIMEOUT sau ping.
+    Mọi thao tác trên socket đi qua call_soon → chỉ thread reactor chạm vào socket.
+    """
+
+    def __init__(self, name):
+        self.name     = name
+        self.conns    = set()
+        self._sel     = selectors.DefaultSelector()
+        self._calls   = deque()
+        self._wake_r, self._wake_w = socket.socketpair()
+        self._wake_r.setblocking(False)
+        self._wake_w.setblocking(False)
+        self._sel.register(self._wake_r, selectors.EVENT_READ, None)
+        self._running = True
+        self._thread  = threading.Thread(target=self._run, name=name, daemon=True)
+        self._thread.start()
+
+    def call_soon(self, fn, *args):
+        self._calls.append((fn, args))
+        try:
+            self._wake_w.send(b'\0')
+        except OSError:
+            pass
+
+    def attach(self, sock, name, on_message, on_close, tool=None):
+        sock.settimeout(0)
+        return WSConn(self, sock, name, on_message, on_close, tool)
+
+    def _register(self, conn):
+        if conn.closed:
+            return
+        self._sel.register(conn.sock, selectors.EVENT_READ, conn)
+        self.conns.add(conn)
+        self._readable(conn)   # SSL có thể đã đệm sẵn dữ liệu lúc handshake
+
+    def _want_write(self, conn, flag):
+        if conn.closed or conn not in self.conns:
+            return
+        events = selectors.EVENT_READ | (selectors.EVENT_WRITE if flag else 0)
+        if self._sel.get_key(conn.sock).events != events:
+            self._sel.modify(conn.sock, events, conn)
+
+    def _readable(self, conn):
+        got, lost = False, None
+        try:
+            while True:
+                data = conn.sock.recv(WS_RECV_CHUNK)
+                if not data:
+                    lost = 'connection closed'
+                    break
+                conn.inbuf += data
+                got = True
+        except WS_WOULD_BLOCK:
+            pass
+        except OSError as e:
+            lost = str(e)
+        if got:
+            conn.last_rx = time.monotonic()
+            # close frame đến cùng lượt với EOF vẫn phải tới on_close kèm đúng code
+            conn._dispatch()
+        if lost is not None:
+            self._drop(conn, None, lost)
+
+    def _close_local(self, conn, code):
+        self._drop(conn, None, 'closed locally', reply=code)
+
+    def _drop(self, conn, code, reason, reply=None):
+        """Đóng conn đúng một lần; reply = close code gửi lại cho server (best-effort)"""
+        if conn.closed:
+            return
+        conn.closed = True
+        if conn in self.conns:
+            self.conns.discard(conn)
+            self._sel.unregister(conn.sock)
+        if reply is not None:
+            # gửi thẳng, không qua _flush — lỗi lúc này không được quay lại _drop lần nữa
+            try:
+                conn.sock.send(bytes(conn.outbuf) +
+                               websocket.ABNF.create_frame(reply.to_bytes(2, 'big'), OP_CLOSE).format())
+            except OSError:
+                pass
+        try:
+            conn.sock.close()
+        except OSError:
+            pass
+        try:
+            conn.on_close(code, reason)
+        except Exception as e:
+            _ws_error(conn, 'on_close', e)
+
+    def _sweep(self, now):
+        for conn in list(self.conns):
+            if conn.last_rx < conn.last_ping and now - conn.last_ping > WS_PING_TIMEOUT:
+                self._drop(conn, None, 'ping timeout')
+            elif now - conn.last_ping >= WS_PING_INTERVAL:
+                conn.last_ping = now
+                conn._send(OP_PING, b'')
+
+    def _run(self):
+        next_sweep = time.monotonic() + 1
+        while self._running:
+            for key, events in self._sel.select(max(0.0, next_sweep - time.monotonic())):
+                conn = key.data
+                if conn is None:
+                    try:
+                        while self._wake_r.recv(4096):
+                            pass
+                    except OSError:
+                        pass
+                    continue
+                if events & selectors.EVENT_WRITE:
+                    conn._flush()
+                if events & selectors.EVENT_READ and not conn.closed:
+                    self._readable(conn)
+            while self._calls:
+                fn, args = self._calls.popleft()
+                try:
+                    fn(*args)
+                except Exception as e:
+                    conn = getattr(fn, '__self__', None)
+                    if not isinstance(conn, WSConn):
+                        conn = next((a for a in args if isinstance(a, WSConn)), None)
+                    if conn is not None:
+                        _ws_error(conn, 'call', e)
+                    else:
+                        print(f"[{time.strftime('%H:%M:%S')}] [WS] {self.name} call failed: {e}")
+            now = time.monotonic()
+            if now >= next_sweep:
+                self._sweep(now)
+                next_sweep = now + 1
+
+    def shutdown(self):
+        def _stop():
+            for conn in list(self.conns):
+                self._close_local(conn, 1001)
+            self._running = False
+        self.call_soon(_stop)
+
+class WSReactorPool:
+    """
+    AFK_ENGINE=reactor: mọi socket hyperhub/overnode chia cho AFK_WS_REACTORS thread reactor;
+    handshake, login và gọi HTTP chạy trên pool.io (AFK_WS_IO_WORKERS thread).
+    Số thread cố định, không phụ thuộc số account.
+    """
+
+    def __init__(self, reactors=WS_REACTORS, io_workers=WS_IO_WORKERS):
+        self.reactors = [WSReactor(f'afk-ws-{i}') for i in range(max(1, reactors))]
+        self.io       = ThreadPoolExecutor(max_workers=io_workers, thread_name_prefix='afk-ws-io')
+
+    def connect(self, url, header, on_message, on_close, name='', tool=None):
+        """Handshake (blocking — gọi từ pool.io), trả WSConn chưa start() trên reactor ít socket nhất"""
+        ws = websocket.create_connection(url, header=header, sslopt={'cert_reqs': ssl.CERT_NONE}, timeout=15)
+        reactor = min(self.reactors, key=lambda r: len(r.conns))
+        return reactor.attach(ws.sock, name, on_message, on_close, tool)
+
+    def stats(self):
+        return {'reactors': [{'name': r.name, 'sockets': len(r.conns)} for r in self.reactors],
+                'sockets':  sum(len(r.conns) for r in self.reactors),
+                'io_workers': self.io._max_workers}
+
+    def shutdown(self):
+        for r in self.reactors:
+            r.shutdown()
+        self.io.shutdown(wait=False)
+
+_reactor      = None
+_reactor_lock = threading.Lock()
+
+def get_reactor():
+    global _reactor
+    with _reactor_lock:
+        if _reactor is None:
+            _reactor = WSReactorPool()
+    return _reactor
+
+def _reactor_retry(pool, state, delay, fn, name):
+    scheduler.call_later(delay, lambda: pool.io.submit(fn), state['stop_event'], name=name)
+
+def _ws_handshake_error(tool, ident, err):
+    """→ (status HTTP của handshake hoặc None, có phải lỗi 'already connected')"""
+    status = getattr(err, 'status_code', None)
+    if 'already connected' in str(err).lower():
+        return status, True
+    add_log(tool, 'WS error: {error}', account=ident, level=ERROR, event='ws_error', error=str(err))
+    return status, False
+
+def hyperhub_worker_reactor(account, state, pool):
+    ident    = account['email']
+    password = account['password']
+    http     = http_pool('hyperhub')
+    cookies  = ''
+    policy   = ReconnectPolicy('hyperhub', HYPERHUB_HOST, ident)
+
+    def alive():
+        return state['running'] and not state['stop_event'].is_set()
+
+    def do_login():
+        nonlocal cookies
+        try:
+            r = http.post(
+                f'{HYPERHUB_URL}/auth/login',
+                json={'email': ident, 'password': password},
+                headers={'User-Agent': HYPERHUB_UA, 'Content-Type': 'application/json'},
+                timeout=15, verify=False,
+            )
+            if r.status_code == 200:
+                cookies = '; '.join(f'{c.name}={c.value}' for c in r.cookies)
+                add_log('hyperhub', 'Login successful ✓', account=ident, event='login')
+                return True
+            add_log('hyperhub', 'Login failed — HTTP {status}', account=ident, level=WARNING,
+                    event='login_failed', status=r.status_code)
+        except Exception as e:
+            add_log('hyperhub', 'Login error: {error}', account=ident, level=ERROR, event='login_failed', error=str(e))
+        cookies = ''
+        return False
+
+    def get_balance():
+        try:
+            r = http.get(f'{HYPERHUB_URL}/wallet/balance', timeout=10, verify=False,
+                         headers={'User-Agent': HYPERHUB_UA, 'Cookie': cookies})
+            if r.status_code == 200:
+                return float(r.json().get('XPL', 0.0))
+        except Exception:
+            pass
+        return None
+
+    def retry(delay):
+        _reactor_retry(pool, state, delay, connect, f'hyperhub.reconnect:{ident}')
+
+    def connect():
+        nonlocal cookies
+        if not alive():
+            return
+        if not cookies:
+            if not do_login():
+                return retry(60)
+            balance_reconciler.reconcile('hyperhub', ident)
+
+        state.last_nri = 99999
+        recycled = [False]
+        timer    = [None]
+
+        def on_message(raw):
+            if recorder is not None:
+                recorder.ws_frame('hyperhub', ident, raw)
+            frame = decode_afk_frame(raw)
+            if frame is None:
+                return
+            cpm, nri = frame
+            state['coins_per_min'] = cpm
+            if hyperhub_reward_cycle(state.last_nri, nri):
+                inc, bal = balance_reconciler.credit(state, cpm, nri)
+                add_log('hyperhub', '+{delta} XPL | Balance: {balance}', account=ident, event='reward',
+                        balance=bal, delta=inc)
+            state.last_nri = nri
+
+        def on_close(code, reason):
+            nonlocal cookies
+            state['connection'] = 'disconnected'
+            policy.closed(code)
+            if timer[0]:
+                timer[0].cancel()
+            state['stop_event'].remove_callback(conn.close)
+            if not alive():
+                return
+            if code == 4002:
+                delay = policy.next_delay(floor=8)
+            elif recycled[0]:
+                delay = policy.after_recycle()
+            else:
+                if code == 4001:
+                    cookies = ''
+                delay = policy.next_delay()
+            retry(delay)
+
+        try:
+            conn = pool.connect(HYPERHUB_WS, {'User-Agent': HYPERHUB_UA, 'Cookie': cookies,
+                                              'Origin': 'https://hyper-hub.nl/'},
+                                on_message, on_close, name=ident, tool='hyperhub')
+        except Exception as e:
+            status, conflict = _ws_handshake_error('hyperhub', ident, e)
+            if status == 401:
+                cookies = ''
+            return retry(policy.next_delay(floor=8 if conflict else 0))
+
+        def recycle():
+            recycled[0] = True
+            conn.close()
+
+        recycle_in = policy.recycle_after()
+        if recycle_in:
+            timer[0] = scheduler.call_later(recycle_in, recycle, state['stop_event'], name=f'hyperhub.recycle:{ident}')
+        state['stop_event'].add_callback(conn.close)
+        state['connection'] = 'connected'
+        policy.connected()
+        conn.start()
+
+    balance_reconciler.register('hyperhub', ident, get_balance, state)
+    pool.io.submit(connect)
+
+def overnode_worker_reactor(account, state, pool):
+    ident   = account['email']
+    cookie  = account['cookie']
+    ORIGIN  = OVERNODE_URL
+    policy  = ReconnectPolicy('overnode', OVERNODE_HOST, ident)
+    state.earned = 0.0
+
+    http         = http_pool('overnode')
+    rest_headers = {
+        'User-Agent':      OVERNODE_UA,
+        'Accept':          'application/json',
+        'Accept-Language': 'vi-VN,vi;q=0.9,en-US;q=0.8,en;q=0.7',
+        'Referer':         f'{ORIGIN}/wallet',
+        'Origin':          ORIGIN,
+        'Cookie':          cookie,
+    }
+    ws_headers = {
+        'Origin':          ORIGIN,
+        'Referer':         f'{ORIGIN}/afk',
+        'Cookie':          cookie,
+        'User-Agent':      OVERNODE_UA,
+        'Accept-Language': 'vi-VN,vi;q=0.9,en-US;q=0.8,en;q=0.7',
+        'Pragma':          'no-cache',
+        'Cache-Control':   'no-cache',
+        'Sec-Fetch-Dest':  'websocket',
+        'Sec-Fetch-Mode':  'websocket',
+        'Sec-Fetch-Site':  'same-origin',
+    }
+
+    def alive():
+        return state['running'] and not state['stop_event'].is_set()
+
+    def get_balance():
+        try:
+            r = http.get(f'{ORIGIN}/api/wallet/balance', headers=rest_headers, timeout=10, verify=False)
+            if r.status_code == 200:
+                return float(r.json().get('balance', 0.0))
+        except Exception:
+            pass
+        return None
+
+    def finish():
+        state['running']    = False
+        state['connection'] = 'disconnected'
+
+    def retry(delay):
+        _reactor_retry(pool, state, delay, connect, f'overnode.reconnect:{ident}')
+
+    def connect():
+        if not alive():
+            return
+        state.last_nri = None
+        recycled = [False]
+        timer    = [None]
+
+        def on_message(raw):
+            if recorder is not None:
+                recorder.ws_frame('overnode', ident, raw)
+            frame = decode_afk_frame(raw)
+            if frame is None:
+                return
+            cpm, nri = frame
+            if overnode_reward_cycle(state.last_nri, nri):
+                inc, bal = balance_reconciler.credit(state, cpm, nri)
+                state.earned = round(state.earned + inc, 4)
+                add_log('overnode', '+{delta} coins | Balance: {balance} | Total earned: {total}', account=ident,
+                        event='reward', balance=bal, delta=inc, total=state.earned)
+            state.last_nri = nri
+
+        def on_close(code, reason):
+            state['connection'] = 'disconnected'
+            policy.closed(code)
+            if timer[0]:
+                timer[0].cancel()
+            state['stop_event'].remove_callback(conn.close)
+            add_log('overnode', 'WS closed (code={code})', account=ident, event='disconnected', code=code)
+            if not alive():
+                return
+            if code == 4001:
+                add_log('overnode', 'Session hết hạn (4001) — cần cookie mới', account=ident, level=ERROR,
+                        event='session_expired', code=4001)
+                return finish()
+            if code == 4003:
+                add_log('overnode', 'Server suspended (4003)', account=ident, level=ERROR, event='suspended', code=4003)
+                return finish()
+            if code == 4002:
+                delay = policy.next_delay(floor=15)
+                add_log('overnode', 'Session trùng (4002) — reconnect sau {delay}s...', account=ident, level=WARNING,
+                        event='conflict', code=4002, delay=round(delay))
+            elif recycled[0]:
+                delay = policy.after_recycle()
+            else:
+                delay = policy.next_delay()
+                add_log('overnode', 'Reconnecting in {delay}s...', account=ident, event='reconnect', delay=round(delay))
+            retry(delay)
+
+        try:
+            conn = pool.connect(OVERNODE_WS, ws_headers, on_message, on_close, name=ident, tool='overnode')
+        except Exception as e:
+            status, conflict = _ws_handshake_error('overnode', ident, e)
+            delay = policy.next_delay(floor=15 if conflict else 0)
+            add_log('overnode', 'Reconnecting in {delay}s...', account=ident, event='reconnect', delay=round(delay))
+            return retry(delay)
+
+        def recycle():
+            recycled[0] = True
+            conn.close()
+
+        recycle_in = policy.recycle_after()
+        if recycle_in:
+            timer[0] = scheduler.call_later(recycle_in, recycle, state['stop_event'], name=f'overnode.recycle:{ident}')
+        state['stop_event'].add_callback(conn.close)
+        state['connection'] = 'connected'
+        policy.connected()
+        add_log('overnode', 'WS connected 🟢', account=ident, event='connected')
+        conn.start()
+
+    balance_reconciler.register('overnode', ident, get_balance, state)
+    pool.io.submit(connect)
+
+REACTOR_WORKERS = {
+    'hyperhub': hyperhub_worker_reactor,
+    'overnode': overnode_worker_reactor,
+}
+
+                                                                                
+COORDINATION   = os.environ.get('AFK_COORDINATION', '').strip().lower() in ('1', 'true', 'yes', 'sqlite')
+COORD_DB       = os.environ.get('AFK_COORD_DB') or os.path.join(DATA_DIR, 'coordination.db')
+COORD_INTERVAL = float(os.environ.get('AFK_COORD_INTERVAL', 2))
+LEASE_TTL      = float(os.environ.get('AFK_LEASE_TTL', 15))
+
+class Coordinator:
+    """
+    Điều phối nhiều process (gunicorn --workers N) qua một file SQLite dùng chung:
+    - leases:   mỗi account chỉ thuộc về đúng một process (lease có TTL, gia hạn định kỳ)
+    - status:   running/balance của account do process sở hữu ghi, process khác đọc
+    - logs:     log của mọi process, mỗi process tail để SSE thấy đủ
+    - commands: toggle gửi tới process đang sở hữu account
+    Process nào chết thì lease hết hạn và process khác nhận lại account.
+    """
+
+    def __init__(self, path):
+        self.path     = path
+        self.node     = f'{socket.gethostname()}:{os.getpid()}'
+        self._db      = None
+        self._pid     = None
+        self._lock    = threading.Lock()
+        self._owned   = set()
+        self._remote  = {tool: {} for tool in FILES}
+        self._outbox  = deque()
+        self._last_log = 0
+        self._last_gen = None
+        self._job     = None
+
+    def db(self):
+        if self._db is None or self._pid != os.getpid():
+            self.node = f'{socket.gethostname()}:{os.getpid()}'
+            self._pid = os.getpid()
+            self._db  = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None, timeout=10)
+            self._db.execute('PRAGMA journal_mode=WAL')
+            self._db.execute('PRAGMA synchronous=NORMAL')
+            self._db.executescript("""
+                CREATE TABLE IF NOT EXISTS nodes    (node TEXT PRIMARY KEY, seen REAL);
+                CREATE TABLE IF NOT EXISTS leases   (tool TEXT, email TEXT, owner TEXT, expires REAL,
+                                                     PRIMARY KEY (tool, email));
+                CREATE TABLE IF NOT EXISTS status   (tool TEXT, email TEXT, owner TEXT, running INTEGER,
+                                                     balance REAL, coins_per_min REAL, updated REAL,
+                                                     connection TEXT, version INTEGER, error TEXT,
+                                                     last_reward REAL, PRIMARY KEY (tool, email));
+                CREATE TABLE IF NOT EXISTS logs     (id INTEGER PRIMARY KEY AUTOINCREMENT, origin TEXT,
+                                                     tool TEXT, ts REAL, message TEXT);
+                CREATE TABLE IF NOT EXISTS commands (id INTEGER PRIMARY KEY AUTOINCREMENT, target TEXT,
+                                                     tool TEXT, email TEXT, action TEXT);
+                CREATE TABLE IF NOT EXISTS meta     (key TEXT PRIMARY KEY, value TEXT);
+                CREATE TABLE IF NOT EXISTS jobs     (id TEXT PRIMARY KEY, data TEXT, updated REAL);
+            """)
+            cols = {row[1] for row in self._db.execute('PRAGMA table_info(status)')}
+            for col, decl in (('connection', 'TEXT'), ('version', 'INTEGER'), ('error', 'TEXT'),
+                              ('last_reward', 'REAL')):
+                if col not in cols:
+                    self._db.execute(f'ALTER TABLE status ADD COLUMN {col} {decl}')
+        return self._db
+
+    def start(self):
+        with self._lock:
+            db = self.db()
+            self._last_log = db.execute('SELECT COALESCE(MAX(id), 0) FROM logs').fetchone()[0]
+            db.execute('INSERT OR REPLACE INTO nodes (node, seen) VALUES (?, ?)', (self.node, time.time()))
+        registry.on_flush.append(self.bump_generation)
+        self._job = scheduler.every(COORD_INTERVAL, self.tick, first=0, name='coordinator')
+
+    def acquire(self, tool, email):
+        now = time.time()
+        with self._lock:
+            cur = self.db().execute(
+                'INSERT INTO leases (tool, email, owner, expires) VALUES (?, ?, ?, ?) '
+                'ON CONFLICT (tool, email) DO UPDATE SET owner = excluded.owner, expires = excluded.expires '
+                'WHERE leases.owner = excluded.owner OR leases.expires < ?',
+                (tool, email, self.node, now + LEASE_TTL, now))
+            if cur.rowcount == 1:
+                self._owned.add((tool, email))
+                return True
+        return False
+
+    def release(self, tool, email):
+        with self._lock:
+            self._owned.discard((tool, email))
+            db = self.db()
+            db.execute('DELETE FROM leases WHERE tool = ? AND email = ? AND owner = ?', (tool, email, self.node))
+            db.execute('DELETE FROM status WHERE tool = ? AND email = ?', (tool, email))
+
+    def owns(self, tool, email):
+        return (tool, email) in self._owned
+
+    def send(self, tool, email, action):
+        with self._lock:
+            row = self.db().execute('SELECT owner FROM leases WHERE tool = ? AND email = ? AND expires > ?',
+                                    (tool, email, time.time())).fetchone()
+            if row is None:
+                return False
+            self._db.execute('INSERT INTO commands (target, tool, email, action) VALUES (?, ?, ?, ?)',
+                             (row[0], tool, email, action))
+        return True
+
+    def remote_status(self, tool, email):
+        return self._remote[tool].get(email, {})
+
+    def export_log(self, entry):
+        self._outbox.append((self.node, entry.tool, entry.timestamp, json.dumps(entry.record())))
+
+    def put_job(self, job):
+        with self._lock:
+            self.db().execute('INSERT OR REPLACE INTO jobs (id, data, updated) VALUES (?, ?, ?)',
+                              (job['id'], json.dumps(job), job['updated']))
+
+    def get_job(self, job_id):
+        with self._lock:
+            row = self.db().execute('SELECT data FROM jobs WHERE id = ?', (job_id,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def bump_generation(self):
+        gen = f'{self.node}:{time.time()}'
+        with self._lock:
+            self.db().execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('generation', ?)", (gen,))
+            self._last_gen = gen
+
+    def tick(self):
+        now = time.time()
+        with self._lock:
+            db = self.db()
+            db.execute('BEGIN IMMEDIATE')
+            try:
+                db.execute('INSERT OR REPLACE INTO nodes (node, seen) VALUES (?, ?)', (self.node, now))
+                db.execute('DELETE FROM nodes WHERE seen < ?', (now - LEASE_TTL,))
+                db.execute('UPDATE leases SET expires = ? WHERE owner = ?', (now + LEASE_TTL, self.node))
+                owned = {(t, e) for t, e in db.execute('SELECT tool, email FROM leases WHERE owner = ?',
+                                                       (self.node,))}
+                nodes = db.execute('SELECT COUNT(*) FROM nodes').fetchone()[0]
+                gen   = (db.execute("SELECT value FROM meta WHERE key = 'generation'").fetchone() or [None])[0]
+                cmds  = db.execute('SELECT id, tool, email, action FROM commands WHERE target = ?',
+                                   (self.node,)).fetchall()
+                if cmds:
+                    db.execute('DELETE FROM commands WHERE target = ?', (self.node,))
+                db.execute('DELETE FROM commands WHERE target NOT IN (SELECT node FROM nodes)')
+                rows = []
+                for tool, email in owned:
+                    st = app_state[tool].get(email)
+                    if st is not None:
+                        rows.append((tool, email, self.node, int(bool(st.get('running'))),
+                                     st.get('balance', 0.0), st.get('coins_per_min', 0), now,
+                                     st.get('connection'), st.version, st.get('error'), st.get('last_reward')))
+                db.executemany('INSERT OR REPLACE INTO status (tool, email, owner, running, balance, coins_per_min, '
+                               'updated, connection, version, error, last_reward) '
+                               'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', rows)
+                remote = db.execute('SELECT s.tool, s.email, s.running, s.balance, s.coins_per_min, s.connection, '
+                                    's.version, s.error, s.last_reward FROM status s '
+                                    'JOIN leases l ON l.tool = s.tool AND l.email = s.email '
+                                    'WHERE l.owner != ? AND l.expires > ?', (self.node, now)).fetchall()
+                db.execute('DELETE FROM status WHERE NOT EXISTS (SELECT 1 FROM leases l WHERE '
+                           'l.tool = status.tool AND l.email = status.email AND l.expires > ?)', (now,))
+                outbox = []
+                while self._outbox:
+                    outbox.append(self._outbox.popleft())
+                db.executemany('INSERT INTO logs (origin, tool, ts, message) VALUES (?, ?, ?, ?)', outbox)
+                logs = db.execute('SELECT id, tool, ts, message FROM logs WHERE id > ? AND origin != ? ORDER BY id',
+                                  (self._last_log, self.node)).fetchall()
+                self._last_log = db.execute('SELECT COALESCE(MAX(id), 0) FROM logs').fetchone()[0]
+                db.execute('DELETE FROM logs WHERE id < ?', (self._last_log - MAX_LOGS * 10,))
+                db.execute('DELETE FROM jobs WHERE updated < ?', (now - JOB_TTL,))
+                db.execute('COMMIT')
+            except Exception:
+                db.execute('ROLLBACK')
+                raise
+            lost, self._owned = self._owned - owned, owned
+
+        for tool, email in lost:
+            stop_worker_thread(tool, email)
+            drop_account_state(tool, email)
+        previous, self._remote = self._remote, {tool: {} for tool in FILES}
+        for tool, email, running, balance, cpm, conn, version, error, last_reward in remote:
+            st = {'running': bool(running), 'balance': balance, 'coins_per_min': cpm, 'connection': conn,
+                  'error': error, 'last_reward': last_reward, 'version': version or 0}
+            self._remote[tool][email] = st
+            old = previous[tool].get(email)
+            if old is None or old['version'] != st['version']:
+                changes = {k: st[k] for k in STATUS_FIELDS if old is None or old.get(k) != st[k]}
+                if changes:
+                    publish_status(tool, email, st['version'], changes)
+        for _, tool, ts, record in logs:
+            publish_log(json.loads(record))
+        if gen is not None and gen != self._last_gen:
+            self._last_gen = gen
+            registry.reload()
+        for _, tool, email, action in cmds:
+            self._run_command(tool, email, action)
+        self._reconcile(nodes)
+
+    def _run_command(self, tool, email, action):
+        st = app_state[tool].get(email)
+        if action == 'toggle' and (st is not None or rampup.is_pending(tool, email)):
+            set_running(tool, email, not (rampup.is_pending(tool, email) or st['running']))
+        elif action == 'toggle':
+            acc = registry.get(tool, email)
+            if acc:
+                add_log(tool, 'AFK resumed by user.', account=email, event='resumed')
+                start_worker_thread(tool, acc)
+
+    def _handoff(self, tool, email):
+        stop_worker_thread(tool, email)
+        drop_account_state(tool, email)
+        self.release(tool, email)
+
+    def _reconcile(self, nodes):
+        """Dừng account đã bị xoá; trả bớt / nhận thêm account để mỗi node giữ khoảng total/nodes"""
+        total = sum(registry.count(t) for t in FILES)
+        share = -(-total // max(nodes, 1))
+        for tool, email in list(self._owned):
+            if registry.get(tool, email) is None:
+                self._handoff(tool, email)
+        # trả account không chạy (đã pause) trước, thứ tự ổn định thay vì thứ tự của set
+        owned = sorted(self._owned, key=lambda key: (not app_state[key[0]].get(key[1], {}).get('running'), key))
+        for tool, email in owned[share:]:
+            self._handoff(tool, email)
+        claim = share - len(self._owned) - rampup.pending()
+        for tool in FILES:
+            if claim <= 0:
+                return
+            # account user đã pause không được node khác tự nhận rồi chạy lại
+            free = [acc for acc in registry.list(tool)
+                    if acc.get('email') and not acc.get('paused') and (tool, acc['email']) not in self._owned
+                    and acc['email'] not in self._remote[tool] and not rampup.is_pending(tool, acc['email'])]
+            free = sorted(free, key=RampUp.priority)[:claim]
+            rampup.submit(tool, free)
+            claim -= len(free)
+
+coordinator = Coordinator(COORD_DB) if COORDINATION else None
+
+                                                                                
+AFK_MODE   = os.environ.get('AFK_MODE', '').strip().lower()
+AFK_SHARDS = int(os.environ.get('AFK_SHARDS') or os.cpu_count() or 2)
+
+class HashRing:
+    """Consistent hash với virtual node — thêm/bớt shard chỉ dời ~1/K account"""
+
+    def __init__(self, nodes, vnodes=64):
+        self._ring = sorted((self._hash(f'{node}#{i}'), node) for node in nodes for i in range(vnodes))
+        self._keys = [h for h, _ in self._ring]
+
+    @staticmethod
+    def _hash(key):
+        return int.from_bytes(hashlib.md5(key.encode()).digest()[:8], 'big')
+
+    def owner(self, key):
+        i = bisect.bisect(self._keys, self._hash(key)) % len(self._keys)
+        return self._ring[i][1]
+
+FARM_METRICS_INTERVAL = float(os.environ.get('AFK_FARM_METRICS_INTERVAL', 5))
+
+class FarmLink:
+    """Phía farm process: gom log + thay đổi trạng thái (và định kỳ snapshot metrics) rồi gửi về web process"""
+
+    def __init__(self, conn):
+        self.conn    = conn
+        self._outbox = deque()
+        self._updates = deque()
+        self._sent   = {}
+        self._lock   = threading.Lock()
+
+    def export_log(self, entry):
+        self._outbox.append(entry.record())
+
+    def export_update(self, tool, email, fields):
+        self._updates.append((tool, email, fields))
+
+    def flush(self):
+        logs = []
+        while self._outbox:
+            logs.append(self._outbox.popleft())
+        changes = []
+        for tool, accounts in app_state.items():
+            for email, st in list(accounts.items()):
+                snap = tuple(st.get(k) for k in STATUS_FIELDS)
+                if self._sent.get((tool, email)) != snap:
+                    self._sent[(tool, email)] = snap
+                    changes.append((tool, email, dict(zip(STATUS_FIELDS, snap)), st.version))
+        updates = []
+        while self._updates:
+            updates.append(self._updates.popleft())
+        records = recorder.drain() if recorder is not None else []
+        if logs or changes or updates or records:
+            with self._lock:
+                self.conn.send(('batch', logs, changes, updates, records))
+
+    def send_metrics(self):
+        snapshot = export_metrics()
+        with self._lock:
+            self.conn.send(('metrics', snapshot))
+
+    def serve(self):
+        scheduler.every(0.5, self.flush, name='farm.flush')
+        scheduler.every(FARM_METRICS_INTERVAL, self.send_metrics, first=1, name='farm.metrics')
+        while True:
+            try:
+                msg = self.conn.recv()
+            except (EOFError, OSError):
+                cleanup()
+            kind = msg[0]
+            if kind == 'start':
+                start_worker_thread(msg[1], msg[2])
+            elif kind == 'stop':
+                _, tool, email, forget = msg
+                stop_worker_thread(tool, email)
+                if forget:
+                    drop_account_state(tool, email)
+                    self._sent.pop((tool, email), None)
+
+def farm_main(shard, conn):
+    """Entry point của farm process: chạy worker engine cho các account được chia về shard này"""
+    global coordinator, farm_link, recorder
+    coordinator = None
+    farm_link   = FarmLink(conn)
+    if RECORD_PATH and os.environ.get('AFK_RECORD_EPOCH'):
+        recorder = TrafficRecorder(None, float(os.environ['AFK_RECORD_EPOCH']))
+    print(f'[INFO] Farm shard {shard} started (pid {os.getpid()})')
+    farm_link.serve()
+
+class Supervisor:
+    """
+    AFK_MODE=supervisor: web process chỉ phục vụ UI/API, account được chia theo
+    consistent hash cho AFK_SHARDS farm process. Trạng thái, log và metrics đi về qua Pipe
+    (/metrics của web process là tổng của mọi farm, trễ tối đa AFK_FARM_METRICS_INTERVAL giây).
+    Farm chết thì được spawn lại và nhận lại đúng các account của nó.
+    """
+
+    def __init__(self, shards):
+        self.shards   = list(range(shards))
+        self.ring     = HashRing(self.shards)
+        self._ctx     = multiprocessing.get_context('spawn')
+        self._procs   = {}
+        self._conns   = {}
+        self._locks   = {shard: threading.Lock() for shard in self.shards}
+        self.assigned = {shard: {} for shard in self.shards}
+
+    def shard_of(self, tool, email):
+        return self.ring.owner(f'{tool}:{email}')
+
+    def launch(self):
+        for shard in self.shards:
+            self._spawn(shard)
+
+    def _spawn(self, shard):
+        parent, child = self._ctx.Pipe()
+        proc = self._ctx.Process(target=farm_main, args=(shard, child), name=f'afk-farm-{shard}', daemon=True)
+        proc.start()
+        child.close()
+        self._procs[shard] = proc
+        self._conns[shard] = parent
+        threading.Thread(target=self._reader, args=(shard, parent), name=f'afk-farm-reader-{shard}',
+                         daemon=True).start()
+        for (tool, email), acc in list(self.assigned[shard].items()):
+            if app_state[tool].get(email, {}).get('running'):
+                # token/cookie farm cũ đã persist sau lần start đầu nằm trong registry, không phải trong acc
+                fresh = registry.get(tool, email)
+                if fresh is not None:
+                    acc = self.assigned[shard][(tool, email)] = fresh
+                self._send(shard, ('start', tool, acc))
+
+    def _send(self, shard, msg):
+        with self._locks[shard]:
+            try:
+                self._conns[shard].send(msg)
+            except (OSError, ValueError):
+                pass
+
+    def _reader(self, shard, conn):
+        while True:
+            try:
+                msg = conn.recv()
+            except (EOFError, OSError, TypeError):
+                break
+            if msg[0] == 'metrics':
+                absorb_metrics(shard, msg[1])
+                continue
+            _, logs, changes, updates, records = msg
+            for record in logs:
+                publish_log(record)
+            for tool, email, fields, version in changes:
+                if (tool, email) in self.assigned[shard]:
+                    get_account_state(tool, email).apply(fields, version)
+            for tool, email, fields in updates:
+                registry.update(tool, email, fields)
+            if records and recorder is not None:
+                recorder.extend(records)
+        retire_metrics(shard)
+        if self._conns.get(shard) is conn:
+            print(f'[WARN] Farm shard {shard} exited — respawning')
+            time.sleep(1)
+            self._spawn(shard)
+
+    def start(self, tool, acc):
+        shard = self.shard_of(tool, acc['email'])
+        self.assigned[shard][(tool, acc['email'])] = acc
+        self._send(shard, ('start', tool, acc))
+
+    def stop(self, tool, email, forget=False):
+        shard = self.shard_of(tool, email)
+        if forget:
+            self.assigned[shard].pop((tool, email), None)
+        self._send(shard, ('stop', tool, email, forget))
+
+    def shutdown(self):
+        for shard, conn in list(self._conns.items()):
+            self._conns[shard] = None
+            conn.close()
+        for proc in self._procs.values():
+            proc.join(timeout=2)
+            if proc.is_alive():
+                proc.terminate()
+
+    def stats(self):
+        return {str(shard): {'pid': self._procs[shard].pid, 'alive': self._procs[shard].is_alive(),
+                             'accounts': len(self.assigned[shard])} for shard in self.shards}
+
+supervisor = None
+farm_link  = None
+
+                                                                                
+RAMP_RATES  = {tool: float(os.environ.get(f'AFK_RAMP_RATE_{tool.upper()}', rate))
+               for tool, rate in (('hyperhub', 2), ('altare', 2), ('overnode', 5))}
+RAMP_BURST  = int(os.environ.get('AFK_RAMP_BURST', 5))
+RAMP_JITTER = float(os.environ.get('AFK_RAMP_JITTER', 0.5))
+
+class TokenBucket:
+    """rate token/giây, tích luỹ tối đa burst. rate <= 0 → không giới hạn"""
+
+    def __init__(self, rate, burst):
+        self.rate    = rate
+        self.burst   = burst
+        self._tokens = float(burst)
+        self._stamp  = time.monotonic()
+        self._lock   = threading.Lock()
+
+    def reserve(self):
+        """Giữ chỗ một token, trả về số giây phải chờ tới lượt (token âm = đã hẹn trước)"""
+        if self.rate <= 0:
+            return 0.0
+        with self._lock:
+            now          = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._stamp) * self.rate)
+            self._stamp  = now
+            self._tokens -= 1
+            return 0.0 if self._tokens >= 0 else -self._tokens / self.rate
+
+class RampUp:
+    """
+    Khởi động account theo nhịp thay vì tất cả trong cùng một giây: mỗi platform một
+    token bucket (AFK_RAMP_RATE_<TOOL> account/giây, burst AFK_RAMP_BURST) cộng jitter.
+    Account ưu tiên đi trước: chưa bị user pause, rồi field 'priority' cao hơn.
+    """
+
+    def __init__(self, rates, burst, jitter):
+        self.buckets  = {tool: TokenBucket(rate, burst) for tool, rate in rates.items()}
+        self.jitter   = jitter
+        self._lock    = threading.Lock()
+        self._pending = {}
+        self._stats   = {tool: {'queued': 0, 'started': 0, 'skipped': 0, 'began': None, 'finished': None}
+                         for tool in rates}
+
+    @staticmethod
+    def priority(acc):
+        return bool(acc.get('paused')), -int(acc.get('priority') or 0)
+
+    def submit(self, tool, accounts):
+        for acc in sorted(accounts, key=self.priority):
+            email = acc.get('email')
+            if not email:
+                continue
+            with self._lock:
+                if (tool, email) in self._pending:
+                    continue
+                stats = self._stats[tool]
+                if not any(t == tool for t, _ in self._pending):
+                    stats.update(began=time.time(), finished=None)
+                delay = self.buckets[tool].reserve() + random.uniform(0, self.jitter)
+                stats['queued'] += 1
+                self._pending[(tool, email)] = scheduler.call_later(
+                    delay, lambda acc=acc: self._launch(tool, acc), name=f'rampup:{tool}:{email}')
+
+    def pending(self, tool=None):
+        with self._lock:
+            return sum(1 for t, _ in self._pending if tool is None or t == tool)
+
+    def is_pending(self, tool, email):
+        return (tool, email) in self._pending
+
+    def cancel(self, tool, email):
+        with self._lock:
+            job = self._pending.pop((tool, email), None)
+            if job is not None:
+                job.cancel()
+                self._stats[tool]['skipped'] += 1
+        return job is not None
+
+    def _launch(self, tool, acc):
+        email = acc['email']
+        with self._lock:
+            if self._pending.pop((tool, email), None) is None:
+                return
+        fresh = registry.get(tool, email)
+        if fresh is not None:
+            start_worker_thread(tool, fresh)
+        with self._lock:
+            stats = self._stats[tool]
+            stats['started' if fresh is not None else 'skipped'] += 1
+            done = not any(t == tool for t, _ in self._pending)
+            if done:
+                stats['finished'] = time.time()
+        if done:
+            add_log(tool, 'Ramp-up complete: {started} account(s) in {secs:.1f}s', event='rampup',
+                    started=stats['started'], secs=stats['finished'] - stats['began'])
+
+    def progress(self):
+        with self._lock:
+            out = {}
+            for tool, stats in self._stats.items():
+                pending = sum(1 for t, _ in self._pending if t == tool)
+                bucket  = self.buckets[tool]
+                out[tool] = {**stats, 'pending': pending, 'rate': bucket.rate,
+                             'eta': round(pending / bucket.rate, 1) if bucket.rate > 0 else 0}
+            return out
+
+rampup = RampUp(RAMP_RATES, RAMP_BURST, RAMP_JITTER)
+
+                                                                                
+def start_afk_services(workers=1):
+    global supervisor, coordinator
+    open_recorder(per_process=workers > 1)
     for tool in ('hyperhub', 'altare', 'overnode'):
-        add_log(tool, 'AutoLab server started.')
-        for acc in read_data(tool):
-            start_worker_thread(tool, acc)
+        add_log(tool, 'AutoLab server started.', event='system')
+    if AFK_MODE == 'supervisor' and supervisor is None:
+        if coordinator is not None:
+            print('[WARN] AFK_MODE=supervisor ignores AFK_COORDINATION — run a single web worker')
+            coordinator = None
+        supervisor = Supervisor(AFK_SHARDS)
+        supervisor.launch()
+    if coordinator is not None:
+        coordinator.start()
+        return
+    for tool in ('hyperhub', 'altare', 'overnode'):
+        rampup.submit(tool, registry.list(tool))
 
 def cleanup(*_):
     print('\n[SYSTEM] Shutting down...')
     for tool, accounts in app_state.items():
-        for email, st in accounts.items():
-            st['running'] = False
-            st['stop_event'].set()
+        for email in list(accounts):
+            stop_worker_thread(tool, email)
+    if _engine is not None:
+        _engine.shutdown()
+    if _reactor is not None:
+        _reactor.shutdown()
+    if supervisor is not None:
+        supervisor.shutdown()
+    if recorder is not None:
+        recorder.close()
+    try:
+        registry.flush()
+    except Exception as e:
+        print(f'[SYSTEM] Failed to flush accounts: {e}')
     time.sleep(1)
     sys.exit(0)
 
@@ -1592,6 +5748,19 @@ def on_starting(server=None):
     """Gunicorn server hook"""
     start_afk_services()
 
+def post_worker_init(worker=None):
+    """Gunicorn worker hook (gunicorn.conf.py) — mỗi worker tự claim phần account của mình"""
+    workers = worker.cfg.workers if worker is not None else 1
+    if AFK_MODE == 'supervisor' and workers > 1:
+        # mỗi worker sẽ spawn bộ farm process riêng → mọi account bị farm {workers} lần
+        print(f'[ERROR] AFK_MODE=supervisor needs a single gunicorn worker (got --workers {workers}) '
+              f'— not starting farm processes')
+        return
+    if coordinator is None and workers > 1:
+        print('[WARN] Multiple gunicorn workers without AFK_COORDINATION=1 — not starting stored accounts')
+        return
+    start_afk_services(workers)
+
 if __name__ == '__main__':
                                          
                                                                              